@@ -0,0 +1 @@
+"""Benchmarks for Etsin Finder backend"""
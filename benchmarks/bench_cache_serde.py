@@ -0,0 +1,103 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2020 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""
+Compare size and encode/decode time of cache serialization formats on catalog records.
+
+Usage: python -m benchmarks.bench_cache_serde [number of files]
+"""
+
+import sys
+import timeit
+
+from pymemcache import serde
+
+from etsin_finder.cache_serde import CompactSerializer, JSONSerializer, PickleSerializer
+
+
+def create_catalog_record(file_count):
+    """
+    Create a catalog record with file_details for file_count files.
+
+    :param file_count:
+    :return:
+    """
+    files = []
+    for i in range(file_count):
+        files.append({
+            'identifier': 'pid:urn:file:{0}'.format(i),
+            'title': 'File {0}'.format(i),
+            'description': 'Measurement data file number {0}'.format(i),
+            'use_category': {'identifier': 'http://uri.suomi.fi/codelist/fairdata/use_category/code/source',
+                             'pref_label': {'en': 'Source material', 'fi': 'Lähdeaineisto'}},
+            'file_type': {'identifier': 'http://uri.suomi.fi/codelist/fairdata/file_type/code/text',
+                          'pref_label': {'en': 'Text', 'fi': 'Teksti'}},
+            'details': {
+                'identifier': 'pid:urn:file:{0}'.format(i),
+                'file_name': 'file_{0}.csv'.format(i),
+                'file_path': '/project/data/{0}/file_{1}.csv'.format(i // 100, i),
+                'byte_size': 1024 * i,
+                'checksum': {'value': '{0:064x}'.format(i), 'algorithm': 'SHA-256',
+                             'checked': '2019-05-23T13:07:22+03:00'},
+                'file_frozen': '2019-05-23T13:07:22+03:00',
+                'project_identifier': 'project_x',
+                'date_modified': '2019-06-23T13:07:22+03:00',
+                'file_storage': {'identifier': 'urn:nbn:fi:att:file-storage-ida', 'id': 1}
+            }
+        })
+    return {
+        'identifier': 'cr_1',
+        'date_modified': '2020-01-23T14:12:44+02:00',
+        'research_dataset': {
+            'title': {'en': 'Benchmark dataset'},
+            'description': {'en': 'Dataset for benchmarking cache serialization. ' * 20},
+            'files': files
+        }
+    }
+
+
+class _PymemcacheSerde:
+    """The pickle based serde previously used by BaseCache"""
+
+    def dumps(self, value):
+        return serde.python_memcache_serializer(None, value)
+
+    def loads(self, data):
+        return serde.python_memcache_deserializer(None, data[0], data[1])
+
+
+def _size(serializer, data):
+    return len(data[0]) if isinstance(serializer, _PymemcacheSerde) else len(data)
+
+
+def run(file_count, repeat=5):
+    """
+    Run benchmark and print results.
+
+    :param file_count:
+    :param repeat:
+    """
+    cr = create_catalog_record(file_count)
+    serializers = [
+        ('pymemcache pickle', _PymemcacheSerde()),
+        ('pickle + zlib', PickleSerializer()),
+        ('json + zlib', JSONSerializer()),
+        ('marshal + zlib', CompactSerializer())
+    ]
+    print('Catalog record with {0} files'.format(file_count))
+    print('{0:<22}{1:>14}{2:>14}{3:>14}'.format('format', 'size (kB)', 'encode (ms)', 'decode (ms)'))
+    for name, serializer in serializers:
+        data = serializer.dumps(cr)
+        assert serializer.loads(data) == cr
+        encode = min(timeit.repeat(lambda: serializer.dumps(cr), number=1, repeat=repeat))
+        decode = min(timeit.repeat(lambda: serializer.loads(data), number=1, repeat=repeat))
+        print('{0:<22}{1:>14.1f}{2:>14.2f}{3:>14.2f}'.format(
+            name, _size(serializer, data) / 1024, encode * 1000, decode * 1000))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
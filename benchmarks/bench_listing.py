@@ -0,0 +1,77 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2020 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""
+Compare cutting the first page of an unsorted directory listing with heap selection and with sorting it whole.
+
+Usage: python -m benchmarks.bench_listing [number of files]
+"""
+
+import random
+import sys
+import timeit
+
+from etsin_finder.utils import \
+    paginate_directory_listing, \
+    slice_array_on_limit, \
+    sort_array_of_obj_by_key, \
+    sort_directory_listing
+
+TOTAL_ITEM_LIMIT = 1000
+
+
+def create_listing(file_count):
+    """
+    Create a directory listing with files in random order.
+
+    :param file_count:
+    :return:
+    """
+    files = [{'identifier': 'file_{0}'.format(i), 'file_name': 'File_{0}.csv'.format(i)} for i in range(file_count)]
+    random.Random(0).shuffle(files)
+    return {'directories': [], 'files': files}
+
+
+def _previous_page(dir_obj):
+    """The sort-then-slice previously done by the Qvain directory endpoints"""
+    sort_array_of_obj_by_key(dir_obj.get('directories', []), 'directory_name')
+    sort_array_of_obj_by_key(dir_obj.get('files', []), 'file_name')
+    dir_obj['directories'] = slice_array_on_limit(dir_obj['directories'], TOTAL_ITEM_LIMIT)
+    dir_obj['files'] = slice_array_on_limit(dir_obj['files'], TOTAL_ITEM_LIMIT)
+    return dir_obj
+
+
+def _sorted_page(dir_obj):
+    return paginate_directory_listing(sort_directory_listing(dir_obj), 0, 100, TOTAL_ITEM_LIMIT)
+
+
+def _selected_page(dir_obj):
+    return paginate_directory_listing(dir_obj, 0, 100, TOTAL_ITEM_LIMIT, is_sorted=False)
+
+
+def run(file_count, repeat=5):
+    """
+    Run benchmark and print results.
+
+    :param file_count:
+    :param repeat:
+    """
+    listing = create_listing(file_count)
+    print('Directory listing with {0} files'.format(file_count))
+    pages = [
+        ('previous sort and slice', _previous_page),
+        ('collated sort, page 100', _sorted_page),
+        ('heap select, page 100', _selected_page)
+    ]
+    for name, page in pages:
+        elapsed = min(timeit.repeat(lambda: page(dict(listing, files=list(listing['files']))), number=1,
+                                    repeat=repeat))
+        print('{0:<28}{1:>12.2f} ms'.format(name, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,60 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2020 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""
+Compare the compiled single-pass stripping of catalog records with the previous multi-pass stripping.
+
+Usage: TESTING=True python -m benchmarks.bench_strip [number of files]
+"""
+
+import sys
+import timeit
+
+from benchmarks.bench_cache_serde import create_catalog_record
+from etsin_finder import finder  # noqa: F401 The app has to be created before importing authorization
+from etsin_finder.authorization import _CR_STRIP_PLANS, SENSITIVE_KEYS, IDA_DATA_KEYS
+from etsin_finder.utils import leave_keys_in_dict, remove_keys_recursively
+
+
+def _previous_strip(cr, visibility):
+    """The stripping previously done by authorization.strip_information_from_catalog_record"""
+    cr = remove_keys_recursively(cr, SENSITIVE_KEYS)
+    if visibility == 'none':
+        return remove_keys_recursively(cr, IDA_DATA_KEYS)
+    if visibility == 'partial':
+        for file in cr['research_dataset'].get('files', []):
+            leave_keys_in_dict(file, set(['use_category', 'file_type', 'identifier', 'details']))
+            if 'details' in file:
+                leave_keys_in_dict(file['details'], set(['file_name', 'file_path', 'byte_size', 'identifier']))
+        for dir in cr['research_dataset'].get('directories', []):
+            leave_keys_in_dict(dir, set(['identifier', 'use_category', 'details']))
+            if 'details' in dir:
+                leave_keys_in_dict(dir['details'], set(['directory_name', 'directory_path', 'byte_size',
+                                                        'file_count', 'identifier']))
+    return cr
+
+
+def run(file_count, repeat=5):
+    """
+    Run benchmark and print results.
+
+    :param file_count:
+    :param repeat:
+    """
+    cr = create_catalog_record(file_count)
+    print('Catalog record with {0} files'.format(file_count))
+    print('{0:<14}{1:>16}{2:>16}'.format('visibility', 'previous (ms)', 'compiled (ms)'))
+    for visibility in ['full', 'partial', 'none']:
+        plan = _CR_STRIP_PLANS[visibility]
+        assert plan(cr) == _previous_strip(cr, visibility)
+        previous = min(timeit.repeat(lambda: _previous_strip(cr, visibility), number=1, repeat=repeat))
+        compiled = min(timeit.repeat(lambda: plan(cr), number=1, repeat=repeat))
+        print('{0:<14}{1:>16.2f}{2:>16.2f}'.format(visibility, previous * 1000, compiled * 1000))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -67,6 +67,10 @@ def get_memcached_config(is_testing):
     """
     Get memcached config.
 
+    Either a single memcached node is given with HOST and PORT, or several nodes with SERVERS, a list
+    of 'host:port' strings or of dicts with HOST and PORT. The nodes are returned in SERVERS as
+    (host, port) tuples. POOL_SIZE is the maximum number of connections per node per worker.
+
     :return:
     """
     if executing_travis() or is_testing:
@@ -76,12 +80,123 @@ def get_memcached_config(is_testing):
     if not memcached_conf or not isinstance(memcached_conf, dict):
         return None
 
-    if 'PORT' not in memcached_conf or 'HOST' not in memcached_conf:
-        return None
+    servers = _parse_memcached_servers(memcached_conf.get('SERVERS', []))
+    if not servers:
+        if 'PORT' not in memcached_conf or 'HOST' not in memcached_conf:
+            return None
+        servers = [(memcached_conf['HOST'], int(memcached_conf['PORT']))]
 
+    memcached_conf = dict(memcached_conf)
+    memcached_conf['SERVERS'] = servers
     return memcached_conf
 
 
+def _parse_memcached_servers(servers_conf):
+    servers = []
+    if not isinstance(servers_conf, list):
+        return servers
+    for server in servers_conf:
+        if isinstance(server, dict) and 'HOST' in server and 'PORT' in server:
+            servers.append((server['HOST'], int(server['PORT'])))
+        elif isinstance(server, str) and ':' in server:
+            host, port = server.rsplit(':', 1)
+            servers.append((host, int(port)))
+    return servers
+
+
+def get_http_pool_config(is_testing):
+    """
+    Get configuration for the keep-alive connection pools used towards upstream services.
+
+    POOL_CONNECTIONS is the number of host pools to cache, POOL_MAXSIZE the maximum number of keep-alive
+    connections per host, POOL_BLOCK whether to wait for a free connection instead of opening a
+    throwaway one when the pool is exhausted and MAX_RETRIES the number of connection retries.
+
+    :return:
+    """
+    pool_conf = {
+        'POOL_CONNECTIONS': 4,
+        'POOL_MAXSIZE': 20,
+        'POOL_BLOCK': False,
+        'MAX_RETRIES': 0
+    }
+    if executing_travis() or is_testing:
+        return pool_conf
+
+    http_pool_conf = get_app_config(is_testing).get('HTTP_POOL', False)
+    if http_pool_conf and isinstance(http_pool_conf, dict):
+        pool_conf.update({key: value for key, value in http_pool_conf.items() if key in pool_conf})
+
+    return pool_conf
+
+
+def get_cache_l1_config(is_testing):
+    """
+    Get configuration for the optional in-process L1 cache in front of memcached.
+
+    MAX_ENTRIES and MAX_BYTES bound the cache per worker and cache type, TTL is the time in seconds
+    an entry is served from the L1 cache before it is read from memcached again.
+
+    :return:
+    """
+    if executing_travis() or is_testing:
+        return None
+
+    l1_conf = get_app_config(is_testing).get('CACHE_L1', False)
+    if not l1_conf or not isinstance(l1_conf, dict) or not l1_conf.get('ENABLED', False):
+        return None
+
+    return {
+        'MAX_ENTRIES': l1_conf.get('MAX_ENTRIES', 100),
+        'MAX_BYTES': l1_conf.get('MAX_BYTES', 64 * 1024 * 1024),
+        'TTL': l1_conf.get('TTL', 10)
+    }
+
+
+def get_stats_log_config(is_testing):
+    """
+    Get configuration for periodically logging the cache statistics of each worker.
+
+    INTERVAL is the time in seconds between the log lines of a worker.
+
+    :return:
+    """
+    if executing_travis() or is_testing:
+        return None
+
+    stats_conf = get_app_config(is_testing).get('STATS_LOG', False)
+    if not stats_conf or not isinstance(stats_conf, dict) or not stats_conf.get('ENABLED', False):
+        return None
+
+    return {
+        'INTERVAL': stats_conf.get('INTERVAL', 300)
+    }
+
+
+def get_prefetch_config(is_testing):
+    """
+    Get configuration for the optional background prefetch of child directory listings.
+
+    CHILDREN is the number of subdirectories prefetched after serving a directory, MAX_CONCURRENT the maximum
+    number of prefetches running at the same time and MAX_BYTES_PER_MINUTE the maximum size of the listings
+    prefetched per minute, per worker and listing type.
+
+    :return:
+    """
+    if executing_travis() or is_testing:
+        return None
+
+    prefetch_conf = get_app_config(is_testing).get('PREFETCH', False)
+    if not prefetch_conf or not isinstance(prefetch_conf, dict) or not prefetch_conf.get('ENABLED', False):
+        return None
+
+    return {
+        'CHILDREN': prefetch_conf.get('CHILDREN', 3),
+        'MAX_CONCURRENT': prefetch_conf.get('MAX_CONCURRENT', 4),
+        'MAX_BYTES_PER_MINUTE': prefetch_conf.get('MAX_BYTES_PER_MINUTE', 16 * 1024 * 1024)
+    }
+
+
 def get_download_api_config(is_testing):
     """
     Get download API config.
@@ -14,17 +14,49 @@ from etsin_finder.cr_service import \
     get_catalog_record_embargo_available
 from etsin_finder.finder import app
 from etsin_finder import rems_service
-from etsin_finder.utils import tz_now_is_later_than_timestamp_str, remove_keys_recursively, leave_keys_in_dict, \
+from etsin_finder.stripping import Rule, compile_plan
+from etsin_finder.utils import tz_now_is_later_than_timestamp_str, memoize_for_request, \
     ACCESS_TYPES, DATA_CATALOG_IDENTIFIERS
 
 log = app.logger
 
-
-def user_has_rems_permission_for_catalog_record(cr_id):
+# Confidential/private information not supposed to be sent to frontend
+SENSITIVE_KEYS = ['email', 'telephone', 'phone']
+IDA_DATA_KEYS = ['files', 'directories', 'remote_resources']
+
+# Keys left in files and directories of a catalog record when ida data is stripped partially
+_CR_FILE_RULE = Rule(keep=['use_category', 'file_type', 'identifier', 'details'],
+                     children={'details': Rule(keep=['file_name', 'file_path', 'byte_size', 'identifier'])})
+_CR_DIRECTORY_RULE = Rule(keep=['identifier', 'use_category', 'details'],
+                          children={'details': Rule(keep=['directory_name', 'directory_path', 'byte_size',
+                                                          'file_count', 'identifier'])})
+_CR_IDA_DATA_PARTIAL_RULE = Rule(children={
+    'research_dataset': Rule(children={'files': Rule(items=_CR_FILE_RULE),
+                                       'directories': Rule(items=_CR_DIRECTORY_RULE)})
+})
+
+# Stripping plans for catalog records, by how much of the ida data the user may see
+_CR_STRIP_PLANS = {
+    'full': compile_plan(Rule(), SENSITIVE_KEYS),
+    'partial': compile_plan(_CR_IDA_DATA_PARTIAL_RULE, SENSITIVE_KEYS),
+    'none': compile_plan(Rule(), SENSITIVE_KEYS + IDA_DATA_KEYS)
+}
+
+# Keys left in files and directories of a directory listing when it is stripped partially
+_DIR_API_OBJ_PARTIAL_PLAN = compile_plan(Rule(children={
+    'files': Rule(items=Rule(keep=['identifier', 'file_name', 'file_path', 'byte_size'])),
+    'directories': Rule(items=Rule(keep=['identifier', 'directory_name', 'directory_path', 'byte_size', 'file_count']))
+}), in_place=True)
+
+
+def user_has_rems_permission_for_catalog_record(cr_id, catalog_record=None):
     """
     Use Fairdata REMS API to check whether user has 'entitlement' for the specified catalog record
 
-    :param catalog_record:
+    The decision is made once per request for each catalog record and user.
+
+    :param cr_id:
+    :param catalog_record: The catalog record if already fetched
     :return:
     """
     if not is_authenticated():
@@ -32,7 +64,9 @@ def user_has_rems_permission_for_catalog_record(cr_id):
     user_id = get_user_id()
     if not cr_id or not user_id:
         return False
-    return rems_service.get_user_rems_permission_for_catalog_record(cr_id, user_id)
+    return memoize_for_request(('rems_permission', cr_id, user_id),
+                               rems_service.get_user_rems_permission_for_catalog_record,
+                               cr_id, user_id, catalog_record)
 
 
 def user_is_allowed_to_download_from_ida(catalog_record, is_authd):
@@ -62,7 +96,7 @@ def user_is_allowed_to_download_from_ida(catalog_record, is_authd):
     elif access_type_id == ACCESS_TYPES.get('restricted'):
         return False
     elif access_type_id == ACCESS_TYPES.get('permit'):
-        return user_has_rems_permission_for_catalog_record(catalog_record.get('identifier'))
+        return user_has_rems_permission_for_catalog_record(catalog_record.get('identifier'), catalog_record)
     elif access_type_id == ACCESS_TYPES.get('login'):
         if is_authd:
             return True
@@ -92,7 +126,7 @@ def strip_dir_api_object(dir_api_obj, is_authd, catalog_record):
     elif access_type_id == ACCESS_TYPES.get('restricted'):
         _strip_directory_api_obj_partially(dir_api_obj)
     elif access_type_id == ACCESS_TYPES.get('permit'):
-        if not user_has_rems_permission_for_catalog_record(catalog_record.get('identifier', None)):
+        if not user_has_rems_permission_for_catalog_record(catalog_record.get('identifier', None), catalog_record):
             _strip_directory_api_obj_partially(dir_api_obj)
     elif access_type_id == ACCESS_TYPES.get('login'):
         if not is_authd:
@@ -108,30 +142,59 @@ def strip_information_from_catalog_record(catalog_record, is_authd):
     decide whether to strip ida-related file and directory data partially or not. In any case, strip sensitive
     information.
 
+    The record is stripped in a single pass with a precompiled plan, see stripping. The given catalog record
+    is not modified.
+
+    :param catalog_record:
+    :param is_authd: Is the user authenticated
+    :return: stripped copy of catalog_record
+    """
+    return _CR_STRIP_PLANS[_get_ida_data_visibility(catalog_record, is_authd)](catalog_record)
+
+
+def is_view_public(catalog_record, is_authd):
+    """
+    Is what the user may see of the catalog record the same for all users in the same authentication state.
+
+    Views of permit datasets depend on the user's entitlements, and views of datasets under embargo change
+    when the embargo ends.
+
+    :param catalog_record:
+    :param is_authd: Is the user authenticated
+    :return:
+    """
+    access_type_id = get_catalog_record_access_type(catalog_record)
+    if access_type_id == ACCESS_TYPES.get('permit'):
+        return not is_authd
+    if access_type_id == ACCESS_TYPES.get('embargo'):
+        return _embargo_time_passed(catalog_record)
+    return True
+
+
+def _get_ida_data_visibility(catalog_record, is_authd):
+    """
+    Decide how much of the ida-related file and directory data of a catalog record the user may see.
+
     :param catalog_record:
     :param is_authd: Is the user authenticated
-    :return: catalog_record after possible modifications
+    :return: 'full', 'partial' or 'none'
     """
-    catalog_record = _strip_sensitive_information_from_catalog_record(catalog_record)
     access_type_id = get_catalog_record_access_type(catalog_record)
     if not access_type_id:
-        return remove_keys_recursively(catalog_record, ['files', 'directories', 'remote_resources'])
+        return 'none'
 
-    if access_type_id == ACCESS_TYPES.get('open'):
-        pass
-    elif access_type_id == ACCESS_TYPES.get('embargo'):
+    if access_type_id == ACCESS_TYPES.get('embargo'):
         if not _embargo_time_passed(catalog_record):
-            _strip_catalog_record_ida_data_partially(catalog_record)
+            return 'partial'
     elif access_type_id == ACCESS_TYPES.get('restricted'):
-        _strip_catalog_record_ida_data_partially(catalog_record)
+        return 'partial'
     elif access_type_id == ACCESS_TYPES.get('permit'):
-        if not user_has_rems_permission_for_catalog_record(catalog_record.get('identifier')):
-            _strip_catalog_record_ida_data_partially(catalog_record)
+        if not user_has_rems_permission_for_catalog_record(catalog_record.get('identifier'), catalog_record):
+            return 'partial'
     elif access_type_id == ACCESS_TYPES.get('login'):
         if not is_authd:
-            _strip_catalog_record_ida_data_partially(catalog_record)
-
-    return catalog_record
+            return 'partial'
+    return 'full'
 
 
 def _embargo_time_passed(catalog_record):
@@ -151,85 +214,13 @@ def _embargo_time_passed(catalog_record):
     return embargo_time_passed
 
 
-def _strip_sensitive_information_from_catalog_record(catalog_record):
-    """
-    This method should strip catalog record of any confidential/private information not supposed to be sent to frontend
-
-    :param catalog_record:
-    :return:
-    """
-    return remove_keys_recursively(catalog_record, ['email', 'telephone', 'phone'])
-
-
-def _strip_catalog_record_ida_data_partially(catalog_record):
-    _strip_catalog_record_files(catalog_record)
-    _strip_catalog_record_directories(catalog_record)
-
-
 def _strip_directory_api_obj_partially(dir_api_obj):
-    _strip_dir_api_obj_files(dir_api_obj)
-    _strip_dir_api_obj_directories(dir_api_obj)
-
-
-def _strip_catalog_record_files(catalog_record):
-    """
-    Keys to leave:
-
-    'use_category', 'file_type', 'identifier', 'details.file_name', 'details.file_path', 'details.byte_size,
-    details.identifier'
-
-    :param catalog_record:
-    :return:
-    """
-    file_keys_to_leave = set(['use_category', 'file_type', 'identifier', 'details'])
-    details_keys_to_leave = set(['file_name', 'file_path', 'byte_size', 'identifier'])
-
-    if 'research_dataset' in catalog_record:
-        for file in catalog_record.get('research_dataset', {}).get('files', []):
-            leave_keys_in_dict(file, file_keys_to_leave)
-            if 'details' in file:
-                leave_keys_in_dict(file.get('details'), details_keys_to_leave)
-
-
-def _strip_catalog_record_directories(catalog_record):
     """
-    Keys to leave:
+    Keys to leave in files: 'identifier', 'file_name', 'file_path', 'byte_size'
 
-    'identifier', 'use_category', 'details.byte_size', 'details.directory_name', 'details.directory_path',
-    'details.byte_size', 'details.file_count'
-
-    :param catalog_record:
-    :return:
-    """
-    dir_keys_to_leave = set(['identifier', 'use_category', 'details'])
-    details_keys_to_leave = set(['directory_name', 'directory_path', 'byte_size', 'file_count', 'identifier'])
-
-    if 'research_dataset' in catalog_record:
-        for dir in catalog_record.get('research_dataset', {}).get('directories', []):
-            leave_keys_in_dict(dir, dir_keys_to_leave)
-            if 'details' in dir:
-                leave_keys_in_dict(dir.get('details'), details_keys_to_leave)
-
-
-def _strip_dir_api_obj_files(dir_api_obj):
-    """
-    Keys to leave: 'identifier', 'file_name', 'file_path', 'byte_size'
-
-    :param dir_api_obj:
-    :return:
-    """
-    file_keys_to_leave = set(['identifier', 'file_name', 'file_path', 'byte_size'])
-    for file in dir_api_obj.get('files', []):
-        leave_keys_in_dict(file, file_keys_to_leave)
-
-
-def _strip_dir_api_obj_directories(dir_api_obj):
-    """
-    Keys to leave: 'identifier', 'directory_name', 'directory_path', 'byte_size', 'file_count'
+    Keys to leave in directories: 'identifier', 'directory_name', 'directory_path', 'byte_size', 'file_count'
 
     :param dir_api_obj:
     :return:
     """
-    dir_keys_to_leave = set(['identifier', 'directory_name', 'directory_path', 'byte_size', 'file_count'])
-    for dir in dir_api_obj.get('directories', []):
-        leave_keys_in_dict(dir, dir_keys_to_leave)
+    _DIR_API_OBJ_PARTIAL_PLAN(dir_api_obj)
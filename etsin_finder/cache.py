@@ -7,29 +7,266 @@
 
 """Etsin Finder cache related functionalities"""
 
-from pymemcache import serde
+import gzip
+import hashlib
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
 from pymemcache.client import base
+from pymemcache.client.hash import HashClient
+from pymemcache.exceptions import MemcacheUnexpectedCloseError
 
-from etsin_finder.app_config import get_memcached_config
+from etsin_finder.app_config import get_memcached_config, get_cache_l1_config
+from etsin_finder.cache_serde import get_serializer, UnknownFormatError
+from etsin_finder.concurrency import spawn_background
+from etsin_finder.metrics import metrics
 from etsin_finder.utils import FlaskService
 
 
+class LRUCache:
+    """
+    In-process least recently used cache bounded by entry count and approximate size in bytes
+
+    Values are returned as such, without copying. Callers that modify values should store them serialized.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl):
+        """
+        Init LRU cache.
+
+        :param max_entries:
+        :param max_bytes:
+        :param ttl: Seconds an entry is kept
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """
+        Get value, or None if not found or expired.
+
+        :param key:
+        :return:
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, size, expires_at = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, size):
+        """
+        Add value to cache, evicting least recently used entries if needed.
+
+        Values larger than max_bytes are not cached.
+
+        :param key:
+        :param value:
+        :param size: Approximate size of value in bytes
+        """
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size, time.monotonic() + self.ttl)
+            self.size += size
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        """
+        Remove value from cache.
+
+        :param key:
+        """
+        with self._lock:
+            self._remove(key)
+
+    def __len__(self):
+        """Number of entries in cache"""
+        with self._lock:
+            return len(self._entries)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+
+# Errors telling that memcached is unreachable, as opposed to errors about a single key or value
+BACKEND_ERRORS = (OSError, MemcacheUnexpectedCloseError)
+
+
+class BackendHealth:
+    """
+    Track availability of a memcached backend so that a dead backend can be skipped.
+
+    After FAILURE_THRESHOLD consecutive failures the backend is considered down and is not used for a
+    backoff period. After that, a single background probe checks whether it is up again. The backoff
+    doubles on each failed probe up to MAX_BACKOFF. State changes are logged once.
+    """
+
+    FAILURE_THRESHOLD = 3
+    MIN_BACKOFF = 5
+    MAX_BACKOFF = 60
+
+    def __init__(self, name, probe):
+        """
+        Init backend health.
+
+        :param name: Backend name for logging
+        :param probe: Function raising an exception if the backend is not available
+        """
+        self.name = name
+        self.probe = probe
+        self.available = True
+        self.failures = 0
+        self.backoff = self.MIN_BACKOFF
+        self.retry_at = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def is_available(self):
+        """
+        Should the backend be used. Starts a background probe if the backoff period has passed.
+
+        :return:
+        """
+        if self.available:
+            return True
+        with self._lock:
+            start_probe = not self._probing and time.monotonic() >= self.retry_at
+            if start_probe:
+                self._probing = True
+        if start_probe:
+            spawn_background(self._probe)
+        return False
+
+    def record_success(self):
+        """Record successful operation."""
+        self.failures = 0
+
+    def record_failure(self):
+        """Record failed operation, marking the backend down after too many consecutive failures."""
+        with self._lock:
+            self.failures += 1
+            if not self.available or self.failures < self.FAILURE_THRESHOLD:
+                return
+            self.available = False
+            self.backoff = self.MIN_BACKOFF
+            self.retry_at = time.monotonic() + self.backoff
+        self._log('warning', 'Memcached {0} is not responding, skipping it for {1} s'.format(self.name, self.backoff))
+
+    def _probe(self):
+        try:
+            self.probe()
+        except Exception as e:
+            with self._lock:
+                self.backoff = min(self.backoff * 2, self.MAX_BACKOFF)
+                self.retry_at = time.monotonic() + self.backoff
+                self._probing = False
+            self._log('debug', 'Memcached {0} probe failed, retrying in {1} s\n{2}'.format(self.name, self.backoff, e))
+            return
+        with self._lock:
+            self.available = True
+            self.failures = 0
+            self._probing = False
+        self._log('info', 'Memcached {0} is available again'.format(self.name))
+
+    @staticmethod
+    def _log(level, message):
+        from etsin_finder.finder import app
+        getattr(app.logger, level)(message)
+
+
+_backend_healths = {}
+_backend_healths_lock = threading.Lock()
+
+
+def _get_backend_health(servers, client):
+    """Get health tracker shared by all caches using the same memcached server"""
+    name = ','.join('{0}:{1}'.format(host, port) for host, port in servers)
+    with _backend_healths_lock:
+        if name not in _backend_healths:
+            _backend_healths[name] = BackendHealth(name, lambda: client.get('health_check'))
+        return _backend_healths[name]
+
+
 class BaseCache(FlaskService):
-    """Base class for various caches used in the app"""
+    """
+    Base class for various caches used in the app
+
+    If the L1 cache is enabled in config, recently used values are additionally kept in an in-process
+    LRU cache in front of memcached. The L1 cache holds values in serialized form and every read decodes
+    a new copy, so callers are free to modify the values they get. The price is that every L1 hit pays
+    for deserialization as a memcached hit does, and the L1 cache only saves the network round trip.
+
+    Deleting a value drops it from the L1 cache of this worker only, and other workers may serve it until
+    their L1 entry expires. Caches whose entries are invalidated by deleting them must therefore set l1 to
+    None. Entries that are invalidated by starting a new generation, see CacheGenerations, may use L1.
+
+    Values are serialized with the serializer named by SERIALIZER in memcached config, see cache_serde.
+
+    Each worker uses a pool of connections to memcached, so greenlets do not share a socket. With several
+    memcached nodes configured, keys are distributed between them with rendezvous hashing and a node that
+    stops responding is left out of the hash ring until it recovers, while the other nodes stay in use.
+
+    When a single memcached node stops responding, it is skipped until it is available again, see
+    BackendHealth.
+
+    Serialized values larger than memcached's item size limit are split into chunks stored under separate
+    keys. The key itself then holds a manifest naming the chunks, written only after all chunks have been
+    stored, so readers see either the complete previous value or the complete new one.
+    """
+
+    CACHE_NAME = 'base'
+    MAX_ITEM_SIZE = 1000 * 1000
+    MAX_CHUNKS = 32
+    POOL_SIZE = 10
+    CHUNK_MANIFEST_PREFIX = b'\x00chunks:'
 
     def __init__(self, app):
         """Setup cache"""
         super().__init__(app)
 
+        l1_config = get_cache_l1_config(self.is_testing)
+        self.l1 = LRUCache(l1_config['MAX_ENTRIES'], l1_config['MAX_BYTES'], l1_config['TTL']) if l1_config else None
+
+        self.max_item_size = self.MAX_ITEM_SIZE
+        self.health = None
         memcached_config = get_memcached_config(self.is_testing)
 
         if memcached_config:
-            self.cache = base.Client((memcached_config['HOST'], memcached_config['PORT']),
-                                     serializer=serde.python_memcache_serializer,
-                                     deserializer=serde.python_memcache_deserializer, connect_timeout=1, timeout=1)
+            self.serializer = get_serializer(memcached_config.get('SERIALIZER', 'compact'),
+                                             memcached_config.get('COMPRESS_THRESHOLD', 16 * 1024))
+            self.max_item_size = memcached_config.get('MAX_ITEM_SIZE', self.MAX_ITEM_SIZE)
+            self.cache = self._create_client(memcached_config['SERVERS'],
+                                             memcached_config.get('POOL_SIZE', self.POOL_SIZE))
+            if len(memcached_config['SERVERS']) == 1:
+                # HashClient tracks the health of each node itself
+                self.health = _get_backend_health(memcached_config['SERVERS'], self.cache)
         elif not self.is_testing:
             app.logger.error("Unable to initialize Cache due to missing config")
 
+    @staticmethod
+    def _create_client(servers, pool_size):
+        if len(servers) > 1:
+            return HashClient(servers, use_pooling=True, max_pool_size=pool_size, connect_timeout=1, timeout=1,
+                              retry_attempts=1, retry_timeout=1, dead_timeout=30)
+        return base.PooledClient(servers[0], max_pool_size=pool_size, connect_timeout=1, timeout=1)
+
     def do_update(self, key, value, ttl):
         """
         Update cache with new key and specific time-to-live.
@@ -40,8 +277,18 @@ class BaseCache(FlaskService):
         :return:
         """
         try:
-            self.cache.set(key, value, expire=ttl)
+            data, size = self.serializer.encode(value)
+            if self.l1 is not None:
+                self.l1.set(key, data, len(data))
+            if not self._backend_available():
+                return value
+            if len(data) > self.max_item_size:
+                self._set_chunked(key, data, ttl)
+            else:
+                self.cache.set(key, data, expire=ttl)
+            self._record_backend_result()
         except Exception as e:
+            self._record_backend_result(e)
             from etsin_finder.finder import app
             app.logger.debug("Insert to cache failed")
             app.logger.debug(e)
@@ -57,19 +304,179 @@ class BaseCache(FlaskService):
         if self.is_testing:
             return None
 
+        if self.l1 is not None:
+            data = self.l1.get(key)
+            self._count_lookup('l1', data)
+            if data is not None:
+                return self.serializer.decode(data)[0]
+
+        value = None
+        if not self._backend_available():
+            self._count_lookup('l2', value)
+            return value
+
         try:
-            return self.cache.get(key, None)
+            data = self.cache.get(key, None)
+            if data is not None and data.startswith(self.CHUNK_MANIFEST_PREFIX):
+                data = self._get_chunked(key, data)
+            self._record_backend_result()
+            if data is not None:
+                value = self.serializer.decode(data)[0]
+                if self.l1 is not None:
+                    self.l1.set(key, data, len(data))
+        except UnknownFormatError:
+            pass
         except Exception as e:
+            self._record_backend_result(e)
             from etsin_finder.finder import app
             app.logger.debug("Get from cache failed")
             app.logger.debug(e)
-        return None
+
+        self._count_lookup('l2', value)
+        return value
+
+    def do_delete(self, key):
+        """
+        Delete entry from cache.
+
+        :param key:
+        :return:
+        """
+        if self.is_testing:
+            return
+
+        if self.l1 is not None:
+            self.l1.delete(key)
+        if not self._backend_available():
+            return
+        try:
+            self.cache.delete(key)
+            self._record_backend_result()
+        except Exception as e:
+            self._record_backend_result(e)
+            from etsin_finder.finder import app
+            app.logger.debug("Delete from cache failed")
+            app.logger.debug(e)
+
+    def _backend_available(self):
+        return self.health is None or self.health.is_available()
+
+    def _record_backend_result(self, error=None):
+        if self.health is None:
+            return
+        if error is None:
+            self.health.record_success()
+        elif isinstance(error, BACKEND_ERRORS):
+            self.health.record_failure()
+
+    def _set_chunked(self, key, data, ttl):
+        """
+        Store data in chunks and write a manifest naming them under key.
+
+        Chunk keys contain a unique id, so chunks of the previous value stay intact until the manifest
+        has been replaced. Chunks are kept slightly longer than the manifest.
+
+        :param key:
+        :param data:
+        :param ttl:
+        :return:
+        """
+        chunk_count = -(-len(data) // self.max_item_size)
+        if chunk_count > self.MAX_CHUNKS:
+            from etsin_finder.finder import app
+            app.logger.warning("Value for key {0} is too large to cache: {1} bytes".format(key, len(data)))
+            return
+
+        chunk_id = uuid.uuid4().hex
+        chunks = {
+            self._get_chunk_key(key, chunk_id, i): data[i * self.max_item_size:(i + 1) * self.max_item_size]
+            for i in range(chunk_count)
+        }
+        failed = self.cache.set_many(chunks, expire=ttl + 60 if ttl else 0)
+        if failed and failed is not True:
+            from etsin_finder.finder import app
+            app.logger.warning("Storing chunks for key {0} failed".format(key))
+            return
+
+        manifest = {'id': chunk_id, 'count': chunk_count, 'size': len(data)}
+        self.cache.set(key, self.CHUNK_MANIFEST_PREFIX + json.dumps(manifest).encode('utf-8'), expire=ttl)
+        metrics.incr('cache.{0}.chunked_writes'.format(self.CACHE_NAME))
+
+    def _get_chunked(self, key, manifest_data):
+        """
+        Read all chunks named in manifest with a single get_many and join them.
+
+        :param key:
+        :param manifest_data:
+        :return: Joined data, or None if any chunk is missing
+        """
+        manifest = json.loads(manifest_data[len(self.CHUNK_MANIFEST_PREFIX):].decode('utf-8'))
+        keys = [self._get_chunk_key(key, manifest['id'], i) for i in range(manifest['count'])]
+        chunks = self.cache.get_many(keys)
+        if len(chunks) != len(keys):
+            return None
+        data = b''.join(chunks[chunk_key] for chunk_key in keys)
+        return data if len(data) == manifest['size'] else None
+
+    @staticmethod
+    def _get_chunk_key(key, chunk_id, index):
+        return '{0}:{1}:{2}'.format(key, chunk_id, index)
+
+    def get_stats(self):
+        """
+        Get hit ratios of the L1 and memcached (L2) cache tiers in this worker.
+
+        :return: dict
+        """
+        prefix = 'cache.{0}.'.format(self.CACHE_NAME)
+        return {
+            'l1_hit_ratio': metrics.ratio(prefix + 'l1.hit', prefix + 'l1.miss'),
+            'l2_hit_ratio': metrics.ratio(prefix + 'l2.hit', prefix + 'l2.miss'),
+            'l1_entries': len(self.l1) if self.l1 is not None else None,
+            'l1_bytes': self.l1.size if self.l1 is not None else None,
+            'counters': metrics.snapshot(prefix)
+        }
+
+    def _count_lookup(self, tier, value):
+        metrics.incr('cache.{0}.{1}.{2}'.format(self.CACHE_NAME, tier, 'miss' if value is None else 'hit'))
 
 
 class CatalogRecordCache(BaseCache):
-    """Catalog record related cache"""
+    """
+    Catalog record related cache.
 
-    CACHE_ITEM_TTL = 1200
+    Records are stored in an entry together with the time they were last validated against Metax, so
+    that cached records can be revalidated with conditional requests instead of being downloaded again.
+
+    Entries have a soft and a hard expiry. Entries validated more than CACHE_ITEM_SOFT_TTL ago are stale and
+    should be revalidated, but can still be served meanwhile. Entries downloaded more than CACHE_ITEM_TTL ago
+    are expired. Metax tells whether a record is modified by its own modification time only, so changes to
+    its files do not show, and expired entries are downloaded again instead of being revalidated. Validating
+    an entry does not extend its hard expiry.
+
+    Records that do not exist in Metax are stored as not found entries for NOT_FOUND_TTL seconds. Entries
+    of removed records are marked as such, so that they can be told apart without inspecting the record.
+    If revalidation fails, the entry is kept and revalidated again after REVALIDATE_RETRY_INTERVAL seconds.
+
+    Records are not kept in the L1 cache. Invalidating a record deletes it in this worker only, and views
+    cached under a new response generation must not be built from a record another worker still holds.
+
+    Invalidating a record also replaces its write token for INVALIDATION_TTL seconds. Fetches read the token
+    before requesting the record from Metax and write the record to cache only if the token is unchanged,
+    so that a fetch started before the record was modified cannot write the old record back.
+    """
+
+    CACHE_NAME = 'cr'
+    CACHE_ITEM_SOFT_TTL = 1200
+    CACHE_ITEM_TTL = 3600
+    NOT_FOUND_TTL = 60
+    REVALIDATE_RETRY_INTERVAL = 60
+    INVALIDATION_TTL = 300
+
+    def __init__(self, app):
+        """Setup catalog record cache"""
+        super().__init__(app)
+        self.l1 = None
 
     def update_cache(self, cr_id, cr_json):
         """
@@ -80,9 +487,51 @@ class CatalogRecordCache(BaseCache):
         :return:
         """
         if cr_id and cr_json:
-            return self.do_update(self._get_cache_key(cr_id), cr_json, self.CACHE_ITEM_TTL)
+            self.do_update(self._get_cache_key(cr_id), self._create_entry(cr_json), self.CACHE_ITEM_TTL)
         return cr_json
 
+    def update_cache_not_found(self, cr_id, removed_checked):
+        """
+        Remember that catalog record does not exist in Metax.
+
+        :param cr_id:
+        :param removed_checked: Removed catalog records were checked as well
+        :return:
+        """
+        if cr_id:
+            entry = {'catalog_record': None, 'not_found': True, 'removed_checked': bool(removed_checked),
+                     'validated_at': time.time()}
+            self.do_update(self._get_cache_key(cr_id), entry, self.NOT_FOUND_TTL)
+
+    def mark_validated(self, cr_id, entry):
+        """
+        Mark cache entry as validated against Metax, keeping the time it was downloaded.
+
+        :param cr_id:
+        :param entry: Cache entry from get_cache_entry
+        :return: catalog record json of the entry
+        """
+        if cr_id and entry:
+            ttl = int(self.CACHE_ITEM_TTL - (time.time() - entry.get('fetched_at', 0)))
+            if ttl > 0:
+                self.do_update(self._get_cache_key(cr_id), dict(entry, validated_at=time.time()), ttl)
+            return entry['catalog_record']
+        return None
+
+    def postpone_revalidation(self, cr_id, entry):
+        """
+        Keep serving a cache entry that could not be revalidated, and retry revalidation later.
+
+        :param cr_id:
+        :param entry: Cache entry from get_cache_entry
+        :return: catalog record json of the entry
+        """
+        if cr_id and entry:
+            entry = dict(entry, validated_at=time.time() - self.CACHE_ITEM_SOFT_TTL + self.REVALIDATE_RETRY_INTERVAL)
+            self.do_update(self._get_cache_key(cr_id), entry, self.CACHE_ITEM_TTL)
+            return entry['catalog_record']
+        return None
+
     def get_from_cache(self, cr_id):
         """
         Get catalog record json from catalog record cache.
@@ -90,41 +539,603 @@ class CatalogRecordCache(BaseCache):
         :param cr_id:
         :return:
         """
-        return self.do_get(self._get_cache_key(cr_id))
+        entry = self.get_cache_entry(cr_id)
+        return entry['catalog_record'] if entry else None
+
+    def get_cache_entry(self, cr_id):
+        """
+        Get cache entry containing the catalog record json and the time it was validated.
+
+        :param cr_id:
+        :return: dict with keys 'catalog_record', 'validated_at' and 'fetched_at', or None. Not found entries have
+            catalog_record None and keys 'not_found' and 'removed_checked', removed records key 'removed'.
+        """
+        entry = self.do_get(self._get_cache_key(cr_id))
+        if isinstance(entry, dict) and 'catalog_record' in entry:
+            return entry
+        return None
+
+    def is_stale(self, entry):
+        """
+        Is cache entry past its soft expiry.
+
+        :param entry:
+        :return:
+        """
+        return time.time() - entry.get('validated_at', 0) > self.CACHE_ITEM_SOFT_TTL
+
+    def is_expired(self, entry):
+        """
+        Is cache entry past its hard expiry, so that it must be downloaded again instead of revalidated.
+
+        :param entry:
+        :return:
+        """
+        return time.time() - entry.get('fetched_at', 0) > self.CACHE_ITEM_TTL
+
+    def delete_from_cache(self, cr_id):
+        """
+        Delete catalog record from cache.
+
+        :param cr_id:
+        :return:
+        """
+        if cr_id:
+            self.do_delete(self._get_cache_key(cr_id))
+
+    def invalidate(self, cr_id):
+        """
+        Delete catalog record from cache and replace its write token, so that fetches in flight do not store it.
+
+        :param cr_id:
+        :return:
+        """
+        if cr_id:
+            self.do_update(self._get_write_token_key(cr_id), uuid.uuid4().hex, self.INVALIDATION_TTL)
+            self.delete_from_cache(cr_id)
+
+    def get_write_token(self, cr_id):
+        """
+        Get write token of catalog record. Read it before fetching the record from Metax.
+
+        :param cr_id:
+        :return: token, or None if the record has not been invalidated lately
+        """
+        return self.do_get(self._get_write_token_key(cr_id))
+
+    def is_write_allowed(self, cr_id, write_token):
+        """
+        May a catalog record fetched after reading the write token be stored, i.e. has it not been invalidated since.
+
+        :param cr_id:
+        :param write_token: Token from get_write_token
+        :return:
+        """
+        return self.do_get(self._get_write_token_key(cr_id)) == write_token
 
     @staticmethod
-    def _get_cache_key(cr_id):
-        return cr_id
+    def _create_entry(cr_json):
+        now = time.time()
+        return {'catalog_record': cr_json, 'removed': bool(cr_json.get('removed', False)),
+                'validated_at': now, 'fetched_at': now}
+
+    def _get_cache_key(self, cr_id):
+        return '{0}_{1}'.format(self.CACHE_NAME, cr_id)
+
+    def _get_write_token_key(self, cr_id):
+        return '{0}_write_token_{1}'.format(self.CACHE_NAME, cr_id)
+
+
+class CatalogRecordSummaryCache(CatalogRecordCache):
+    """
+    Cache for catalog records fetched without file_details.
+
+    Views that do not show the file and directory sections of a record are served from these much smaller
+    records. Entries work like in CatalogRecordCache.
+    """
+
+    CACHE_NAME = 'cr_summary'
+
+
+class QvainDirectoryCache(BaseCache):
+    """
+    Cache for prefetched and paged Qvain directory listings.
+
+    Qvain listings change when files are frozen in IDA, so they are not cached for requests. Prefetched
+    listings are kept for a short time and served only once. They are not kept in the L1 cache, so that a
+    listing served by one worker is not served again by another.
+
+    Listings read in pages are kept sorted for SORTED_LISTING_TTL seconds after their first page was
+    fetched, so that the following pages are cut from the same listing instead of downloading it again.
+    """
+
+    CACHE_NAME = 'qvain_dir'
+    CACHE_ITEM_TTL = 60
+    SORTED_LISTING_TTL = 60
+
+    def __init__(self, app):
+        """Setup Qvain directory cache"""
+        super().__init__(app)
+        self.l1 = None
+
+    def update_cache(self, dir_id, dir_obj):
+        """
+        Update cache with prefetched directory listing.
+
+        :param dir_id:
+        :param dir_obj:
+        :return:
+        """
+        if dir_id and dir_obj:
+            self.do_update(self._get_cache_key(dir_id), dir_obj, self.CACHE_ITEM_TTL)
+        return dir_obj
+
+    def pop(self, dir_id):
+        """
+        Get prefetched directory listing from cache and drop it, counting a prefetch hit.
+
+        :param dir_id:
+        :return: Listing, or None if not prefetched
+        """
+        key = self._get_cache_key(dir_id)
+        dir_obj = self.do_get(key)
+        if dir_obj is not None:
+            self.do_delete(key)
+            metrics.incr('prefetch.{0}.hit'.format(self.CACHE_NAME))
+        return dir_obj
+
+    def is_cached(self, dir_id):
+        """
+        Is directory listing in cache.
+
+        :param dir_id:
+        :return:
+        """
+        return self.do_get(self._get_cache_key(dir_id)) is not None
+
+    def update_sorted_listing(self, listing_id, dir_obj):
+        """
+        Update cache with a directory listing sorted by name, for reading its following pages.
+
+        :param listing_id: Identifier of the directory or project
+        :param dir_obj: Sorted listing
+        :return:
+        """
+        if listing_id and dir_obj:
+            self.do_update(self._get_sorted_listing_key(listing_id), dir_obj, self.SORTED_LISTING_TTL)
+        return dir_obj
+
+    def get_sorted_listing(self, listing_id):
+        """
+        Get directory listing sorted by name from cache.
+
+        :param listing_id: Identifier of the directory or project
+        :return: Listing, or None if not cached
+        """
+        return self.do_get(self._get_sorted_listing_key(listing_id))
+
+    def _get_cache_key(self, dir_id):
+        return '{0}_{1}'.format(self.CACHE_NAME, dir_id)
+
+    def _get_sorted_listing_key(self, listing_id):
+        return '{0}_sorted_{1}'.format(self.CACHE_NAME, listing_id)
+
+
+class ResponseCache(BaseCache):
+    """
+    Cache for serialized responses of views that are the same for all users in the same authentication state.
+
+    Responses of a catalog record belong to a generation of the record, see CacheGenerations, so that
+    invalidating the record drops them. Responses expire when the catalog record they were built from
+    becomes stale, so that changes made outside Etsin are seen as soon as when building the response
+    from the cached record.
+
+    Bodies of at least GZIP_MIN_SIZE bytes are stored gzip compressed, so that they can be sent as is to
+    clients accepting gzip.
+
+    Catalog records whose views depend on the user, such as permit datasets for authenticated users,
+    are remembered in process for UNCACHEABLE_TTL seconds, so that their views are not looked up in vain.
+    """
+
+    CACHE_NAME = 'response'
+    CACHE_ITEM_TTL = CatalogRecordCache.CACHE_ITEM_SOFT_TTL
+    GZIP_MIN_SIZE = 1024
+    UNCACHEABLE_TTL = 300
+    UNCACHEABLE_MAX_ENTRIES = 10000
+
+    def __init__(self, app):
+        """Setup response cache"""
+        super().__init__(app)
+        self.generations = CacheGenerations(app, 'response_gen', self.CACHE_ITEM_TTL)
+        self.uncacheable = LRUCache(self.UNCACHEABLE_MAX_ENTRIES, self.UNCACHEABLE_MAX_ENTRIES, self.UNCACHEABLE_TTL)
+
+    def get_generation(self, cr_id):
+        """
+        Get current generation of the responses of a catalog record.
+
+        :param cr_id:
+        :return:
+        """
+        return self.generations.get_generation(cr_id)
+
+    def update_cache(self, cr_id, generation, view_key, body, ttl=None):
+        """
+        Update cache with response body of a view of a catalog record.
+
+        :param cr_id:
+        :param generation: Generation read before the response was built
+        :param view_key: json serializable key identifying the view
+        :param body: Response body bytes
+        :param ttl: Seconds until the catalog record becomes stale, at most CACHE_ITEM_TTL is used
+        :return:
+        """
+        ttl = self.CACHE_ITEM_TTL if ttl is None else min(int(ttl), self.CACHE_ITEM_TTL)
+        if cr_id and body and ttl > 0:
+            is_gzip = len(body) >= self.GZIP_MIN_SIZE
+            entry = {'body': gzip.compress(body) if is_gzip else body, 'gzip': is_gzip}
+            self.do_update(self._get_cache_key(cr_id, generation, view_key), entry, ttl)
+        return body
+
+    def get_from_cache(self, cr_id, generation, view_key):
+        """
+        Get response of a view of a catalog record from cache.
+
+        :param cr_id:
+        :param generation:
+        :param view_key:
+        :return: dict with response body in 'body' and 'gzip' telling whether it is gzip compressed, or None
+        """
+        return self.do_get(self._get_cache_key(cr_id, generation, view_key))
+
+    def invalidate(self, cr_id):
+        """
+        Drop all cached responses of a catalog record.
+
+        :param cr_id:
+        :return:
+        """
+        if cr_id:
+            self.generations.new_generation(cr_id)
+            for is_authd in (False, True):
+                self.uncacheable.delete((cr_id, is_authd))
+
+    def mark_uncacheable(self, cr_id, is_authd):
+        """
+        Remember that the views of a catalog record are not cached for users in the authentication state.
+
+        :param cr_id:
+        :param is_authd:
+        :return:
+        """
+        if cr_id:
+            self.uncacheable.set((cr_id, is_authd), True, 1)
+
+    def is_uncacheable(self, cr_id, is_authd):
+        """
+        Are the views of a catalog record known not to be cached for users in the authentication state.
+
+        :param cr_id:
+        :param is_authd:
+        :return:
+        """
+        return self.uncacheable.get((cr_id, is_authd)) is not None
+
+    @staticmethod
+    def _get_cache_key(cr_id, generation, view_key):
+        view = json.dumps(view_key).encode('utf-8')
+        return 'response_{0}_{1}_{2}'.format(cr_id, generation, hashlib.sha1(view).hexdigest())
 
 
 class RemsCache(BaseCache):
-    """Rems entitlements related cache"""
+    """
+    Rems entitlements related cache
 
+    Entitlements are cached per user as the set of resources the user is entitled to, so that a single
+    REMS request answers entitlement checks for all datasets. Users without entitlements are likely waiting
+    for their first application to be approved, so an empty set is cached only for EMPTY_ENTITLEMENTS_TTL
+    seconds. Applications of a user are cached as an index from resource to the newest application for
+    APPLICATIONS_TTL seconds.
+
+    Users created in REMS are remembered for USERS_TTL seconds and catalogue items of resources are cached
+    for CATALOGUE_ITEMS_TTL seconds, as they rarely change.
+
+    Applications are deleted when the user applies for access, so that all workers see the new
+    application at once. Therefore the REMS cache is not kept in the L1 cache.
+    """
+
+    CACHE_NAME = 'rems'
     CACHE_ITEM_TTL = 300
+    EMPTY_ENTITLEMENTS_TTL = 10
+    APPLICATIONS_TTL = 60
+    USERS_TTL = 24 * 3600
+    CATALOGUE_ITEMS_TTL = 3600
+
+    def __init__(self, app):
+        """Setup REMS cache"""
+        super().__init__(app)
+        self.l1 = None
 
-    def update_cache(self, cr_id, user_id, permission=False):
+    def update_entitlements(self, user_id, resources):
         """
-        Update cache with user entitlement for a specific catalog record.
+        Update cache with the resources a user is entitled to.
 
-        :param cr_id:
         :param user_id:
-        :param permission:
+        :param resources: Preferred identifiers of entitled resources
         :return:
         """
-        if cr_id and user_id:
-            return self.do_update(self._get_cache_key(cr_id, user_id), permission, self.CACHE_ITEM_TTL)
-        return permission
+        if user_id and resources is not None:
+            ttl = self.CACHE_ITEM_TTL if resources else self.EMPTY_ENTITLEMENTS_TTL
+            self.do_update(self._get_entitlements_key(user_id), sorted(resources), ttl)
+        return resources
 
-    def get_from_cache(self, cr_id, user_id):
+    def get_entitlements(self, user_id):
         """
-        Get entitlement for a user related to a specific catalog record from cache.
+        Get the resources a user is entitled to from cache.
+
+        :param user_id:
+        :return: set of preferred identifiers, or None if not cached
+        """
+        resources = self.do_get(self._get_entitlements_key(user_id))
+        return set(resources) if isinstance(resources, list) else None
+
+    def update_applications(self, user_id, application_index):
+        """
+        Update cache with the applications of a user.
+
+        :param user_id:
+        :param application_index: dict from resource ext-id to the newest application for the resource
+        :return:
+        """
+        if user_id and application_index is not None:
+            self.do_update(self._get_applications_key(user_id), application_index, self.APPLICATIONS_TTL)
+        return application_index
+
+    def get_applications(self, user_id):
+        """
+        Get the applications of a user from cache.
+
+        :param user_id:
+        :return: dict from resource ext-id to the newest application for the resource, or None if not cached
+        """
+        return self.do_get(self._get_applications_key(user_id))
+
+    def delete_applications(self, user_id):
+        """
+        Delete the applications of a user from cache.
 
-        :param cr_id:
         :param user_id:
         :return:
         """
-        return self.do_get(self._get_cache_key(cr_id, user_id))
+        if user_id:
+            self.do_delete(self._get_applications_key(user_id))
+
+    def update_user_created(self, userdata):
+        """
+        Remember that a user has been created in REMS with the given data.
+
+        :param userdata:
+        :return:
+        """
+        self.do_update(self._get_user_key(userdata), True, self.USERS_TTL)
+
+    def is_user_created(self, userdata):
+        """
+        Has a user been created in REMS with the given data.
+
+        :param userdata:
+        :return:
+        """
+        return self.do_get(self._get_user_key(userdata)) is True
+
+    def update_catalogue_items(self, resource, catalogue_items):
+        """
+        Update cache with the catalogue items of a REMS resource.
+
+        :param resource:
+        :param catalogue_items:
+        :return:
+        """
+        if resource and catalogue_items:
+            self.do_update(self._get_catalogue_items_key(resource), catalogue_items, self.CATALOGUE_ITEMS_TTL)
+        return catalogue_items
+
+    def get_catalogue_items(self, resource):
+        """
+        Get the catalogue items of a REMS resource from cache.
+
+        :param resource:
+        :return:
+        """
+        return self.do_get(self._get_catalogue_items_key(resource))
+
+    @staticmethod
+    def _get_user_key(userdata):
+        # Changed user data is sent to REMS again
+        data = json.dumps(userdata, sort_keys=True).encode('utf-8')
+        return 'rems_user_{0}'.format(hashlib.sha1(data).hexdigest())
+
+    @staticmethod
+    def _get_catalogue_items_key(resource):
+        return 'rems_catalogue_items_{0}'.format(hashlib.sha1(resource.encode('utf-8')).hexdigest())
+
+    @staticmethod
+    def _get_applications_key(user_id):
+        return 'rems_applications_{0}'.format(user_id)
+
+    @staticmethod
+    def _get_entitlements_key(user_id):
+        return 'rems_entitlements_{0}'.format(user_id)
+
+
+class CacheGenerations(BaseCache):
+    """
+    Generation tokens of groups of cache entries.
+
+    Entries of a group are stored under keys containing the current generation of the group, so that the
+    whole group is invalidated at once by starting a new generation. Orphaned entries expire by themselves.
+    Generations are not kept in the L1 cache, so that all workers see an invalidation immediately.
+    """
+
+    CACHE_NAME = 'generation'
+    CACHE_ITEM_TTL = 3600
+
+    def __init__(self, app, name, ttl):
+        """
+        Setup generation cache.
+
+        :param app:
+        :param name: Name of the cache using the generations
+        :param ttl: Time-to-live of the entries in the groups
+        """
+        super().__init__(app)
+        self.l1 = None
+        self.CACHE_NAME = name
+        self.CACHE_ITEM_TTL = ttl
+
+    def get_generation(self, group):
+        """
+        Get current generation of a group, starting a new one if there is none.
+
+        :param group:
+        :return:
+        """
+        generation = self.do_get(self._get_cache_key(group))
+        if generation is None:
+            generation = self.new_generation(group)
+        return generation
+
+    def new_generation(self, group):
+        """
+        Start a new generation of a group, invalidating the entries of the previous ones.
+
+        :param group:
+        :return:
+        """
+        return self.do_update(self._get_cache_key(group), uuid.uuid4().hex, self.CACHE_ITEM_TTL)
+
+    def _get_cache_key(self, group):
+        return '{0}_{1}'.format(self.CACHE_NAME, group)
+
+
+class DirectoryListingCache(BaseCache):
+    """
+    Cache for directory listings of catalog records.
+
+    Listings of a catalog record belong to a generation of the record, see CacheGenerations. Invalidating
+    the record starts a new generation, dropping all its cached listings. The generation should be read
+    before fetching a listing from Metax and the listing stored under that generation, so that a listing
+    fetched before an invalidation is never stored under the new generation.
+    """
+
+    CACHE_NAME = 'dir'
+    CACHE_ITEM_TTL = 1200
+
+    def __init__(self, app):
+        """Setup directory listing cache"""
+        super().__init__(app)
+        self.generations = CacheGenerations(app, 'dir_gen', self.CACHE_ITEM_TTL)
+
+    def get_generation(self, cr_id):
+        """
+        Get current generation of the directory listings of a catalog record.
+
+        :param cr_id:
+        :return:
+        """
+        return self.generations.get_generation(cr_id)
+
+    def update_cache(self, cr_id, generation, dir_id, file_fields, directory_fields, dir_api_obj, prefetched=False):
+        """
+        Update cache with directory listing of a catalog record.
+
+        :param cr_id:
+        :param generation: Generation read before the listing was fetched
+        :param dir_id:
+        :param file_fields:
+        :param directory_fields:
+        :param dir_api_obj:
+        :param prefetched: Was the listing fetched by the prefetcher instead of for a request
+        :return:
+        """
+        if cr_id and dir_api_obj:
+            key = self._get_cache_key(cr_id, generation, dir_id, file_fields, directory_fields)
+            self.do_update(key, {'listing': dir_api_obj, 'prefetched': prefetched}, self.CACHE_ITEM_TTL)
+        return dir_api_obj
+
+    def get_from_cache(self, cr_id, generation, dir_id, file_fields, directory_fields):
+        """
+        Get directory listing of a catalog record from cache.
+
+        A prefetched listing served for the first time is counted as a prefetch hit.
+
+        :param cr_id:
+        :param generation:
+        :param dir_id:
+        :param file_fields:
+        :param directory_fields:
+        :return:
+        """
+        key = self._get_cache_key(cr_id, generation, dir_id, file_fields, directory_fields)
+        entry = self.do_get(key)
+        if not entry or 'listing' not in entry:
+            return None
+        if entry['prefetched']:
+            metrics.incr('prefetch.{0}.hit'.format(self.CACHE_NAME))
+            self.do_update(key, {'listing': entry['listing'], 'prefetched': False}, self.CACHE_ITEM_TTL)
+        return entry['listing']
+
+    def is_cached(self, cr_id, generation, dir_id, file_fields, directory_fields):
+        """
+        Is directory listing of a catalog record in cache.
+
+        :param cr_id:
+        :param generation:
+        :param dir_id:
+        :param file_fields:
+        :param directory_fields:
+        :return:
+        """
+        return self.do_get(self._get_cache_key(cr_id, generation, dir_id, file_fields, directory_fields)) is not None
+
+    def update_path_index(self, cr_id, generation, index):
+        """
+        Update cache with the path index of a catalog record.
+
+        :param cr_id:
+        :param generation: Generation read before the files of the record were fetched
+        :param index:
+        :return:
+        """
+        if cr_id and index is not None:
+            self.do_update(self._get_path_index_key(cr_id, generation), index, self.CACHE_ITEM_TTL)
+        return index
+
+    def get_path_index(self, cr_id, generation):
+        """
+        Get path index of a catalog record from cache.
+
+        :param cr_id:
+        :param generation:
+        :return:
+        """
+        return self.do_get(self._get_path_index_key(cr_id, generation))
+
+    def invalidate(self, cr_id):
+        """
+        Drop all cached directory listings and the path index of a catalog record.
+
+        :param cr_id:
+        :return:
+        """
+        if cr_id:
+            self.generations.new_generation(cr_id)
+
+    @staticmethod
+    def _get_cache_key(cr_id, generation, dir_id, file_fields, directory_fields):
+        # Field lists may be long, so the listing parameters are hashed to keep the key within memcached limits
+        params = json.dumps([dir_id, file_fields, directory_fields]).encode('utf-8')
+        return 'dir_{0}_{1}_{2}'.format(cr_id, generation, hashlib.sha1(params).hexdigest())
 
     @staticmethod
-    def _get_cache_key(cr_id, user_id):
-        return cr_id + user_id
+    def _get_path_index_key(cr_id, generation):
+        return 'dir_index_{0}_{1}'.format(cr_id, generation)
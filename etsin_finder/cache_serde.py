@@ -0,0 +1,162 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2020 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""Serialization formats for values stored in memcached"""
+
+import json
+import marshal
+import pickle
+import zlib
+
+# Payload header is two bytes: format version and codec. Payloads with another format version are
+# treated as cache misses, so the format can be changed without flushing the cache.
+FORMAT_VERSION = 1
+
+CODEC_JSON = 1
+CODEC_BYTES = 2
+CODEC_PICKLE = 3
+CODEC_MARSHAL = 4
+CODEC_FLAG_ZLIB = 0x80
+
+
+class UnknownFormatError(ValueError):
+    """Raised when a cached payload is not in a supported format"""
+
+
+class BaseSerializer:
+    """
+    Base class for cache serializers.
+
+    Subclasses choose how values are encoded, decoding supports payloads written by any serializer in
+    this module. Bodies larger than compress_threshold bytes are zlib compressed.
+    """
+
+    def __init__(self, compress_threshold=16 * 1024, compress_level=1):
+        """
+        Init serializer.
+
+        :param compress_threshold: Minimum body size in bytes to compress
+        :param compress_level: zlib compression level
+        """
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def encode(self, value):
+        """
+        Serialize value.
+
+        :param value:
+        :return: Tuple of payload bytes and uncompressed body size
+        """
+        if isinstance(value, bytes):
+            codec, body = CODEC_BYTES, value
+        else:
+            codec, body = self._encode_body(value)
+        body_size = len(body)
+        if body_size >= self.compress_threshold:
+            body = zlib.compress(body, self.compress_level)
+            codec |= CODEC_FLAG_ZLIB
+        return bytes((FORMAT_VERSION, codec)) + body, body_size
+
+    def decode(self, data):
+        """
+        Deserialize payload.
+
+        :param data:
+        :return: Tuple of value and uncompressed body size
+        """
+        if not isinstance(data, bytes) or len(data) < 2 or data[0] != FORMAT_VERSION:
+            raise UnknownFormatError('Unsupported cache payload format')
+
+        codec = data[1]
+        body = data[2:]
+        if codec & CODEC_FLAG_ZLIB:
+            body = zlib.decompress(body)
+            codec &= ~CODEC_FLAG_ZLIB
+
+        if codec == CODEC_MARSHAL:
+            try:
+                value = marshal.loads(body)
+            except (EOFError, ValueError, TypeError):
+                # Written by an incompatible Python version
+                raise UnknownFormatError('Unsupported marshal data')
+        elif codec == CODEC_JSON:
+            value = json.loads(body.decode('utf-8'))
+        elif codec == CODEC_BYTES:
+            value = body
+        elif codec == CODEC_PICKLE:
+            value = pickle.loads(body)
+        else:
+            raise UnknownFormatError('Unsupported cache payload codec: {0}'.format(codec))
+        return value, len(body)
+
+    def dumps(self, value):
+        """
+        Serialize value to payload bytes.
+
+        :param value:
+        :return:
+        """
+        return self.encode(value)[0]
+
+    def loads(self, data):
+        """
+        Deserialize payload bytes to value.
+
+        :param data:
+        :return:
+        """
+        return self.decode(data)[0]
+
+    def _encode_body(self, value):
+        return CODEC_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+class CompactSerializer(BaseSerializer):
+    """
+    Serialize values with marshal, which is the fastest to encode and the smallest after compression.
+
+    Values marshal does not support are pickled.
+    """
+
+    def _encode_body(self, value):
+        try:
+            return CODEC_MARSHAL, marshal.dumps(value)
+        except ValueError:
+            return super()._encode_body(value)
+
+
+class JSONSerializer(BaseSerializer):
+    """Serialize values as compact JSON. Values that can not be represented as JSON are pickled."""
+
+    def _encode_body(self, value):
+        try:
+            return CODEC_JSON, json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        except (TypeError, ValueError):
+            return super()._encode_body(value)
+
+
+class PickleSerializer(BaseSerializer):
+    """Serialize values with pickle"""
+
+
+SERIALIZERS = {
+    'compact': CompactSerializer,
+    'json': JSONSerializer,
+    'pickle': PickleSerializer
+}
+
+
+def get_serializer(name='compact', compress_threshold=16 * 1024):
+    """
+    Get serializer by name.
+
+    :param name: 'compact', 'json' or 'pickle'
+    :param compress_threshold:
+    :return:
+    """
+    return SERIALIZERS.get(name, CompactSerializer)(compress_threshold=compress_threshold)
@@ -0,0 +1,185 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2020 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""Concurrency helpers. Plain threading primitives are used, which gevent monkey patches in gunicorn workers."""
+
+import copy
+import threading
+import time
+from collections import deque
+
+from flask import copy_current_request_context, g, has_request_context
+
+from etsin_finder.metrics import metrics
+from etsin_finder.utils import get_request_memo
+
+FAN_OUT_MAX_WORKERS = 4
+
+
+def spawn_background(fn, *args, **kwargs):
+    """
+    Run fn(*args, **kwargs) in the background without waiting for it.
+
+    Under gevent the thread is a greenlet. Exceptions are logged, not raised.
+
+    :param fn:
+    :return: The started thread
+    """
+    def run():
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            from etsin_finder.finder import app
+            app.logger.error("Background task {0} failed\n{1}".format(getattr(fn, '__name__', fn), e))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def fan_out(calls, timeout=None, max_workers=FAN_OUT_MAX_WORKERS):
+    """
+    Run independent calls concurrently and return their results.
+
+    Each call is a tuple of a function and its positional arguments. The calls are run in threads, which
+    under gevent are greenlets, at most max_workers at a time. When called during a request, each thread
+    runs in a copy of the request context and sees the attributes of flask.g of the request, including the
+    results memoized for the request. Attributes set on g and changes to the session in the calls are not
+    seen by the request, so calls should return what the request needs instead. An exception raised by a
+    call is raised to the caller.
+
+    A call not completed within timeout seconds from the start of the fan-out is left to finish in the
+    background, and None is returned as its result.
+
+    :param calls: list of (fn, *args) tuples
+    :param timeout: Seconds to wait for the calls, or None to wait until they complete
+    :param max_workers: Maximum number of calls run at the same time
+    :return: list of results in the order of the calls
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    pending = [_Call() for _ in calls]
+    queue = deque(zip(calls, pending))
+    lock = threading.Lock()
+    shared_g = {}
+    if has_request_context():
+        # The memo is created before copying, so that the threads and the request share it
+        get_request_memo()
+        shared_g = dict(vars(g._get_current_object()))
+
+    def work():
+        for name, value in shared_g.items():
+            setattr(g, name, value)
+        while True:
+            with lock:
+                if not queue:
+                    return
+                (fn, *args), call = queue.popleft()
+            try:
+                call.result = fn(*args)
+            except Exception as e:
+                call.error = e
+            finally:
+                call.done.set()
+
+    for _ in range(min(max_workers, len(calls))):
+        # The request context is copied separately for each thread, as a context can be pushed in one thread only
+        target = copy_current_request_context(work) if has_request_context() else work
+        threading.Thread(target=target, daemon=True).start()
+
+    results = []
+    for (fn, *args), call in zip(calls, pending):
+        remaining = max(deadline - time.monotonic(), 0) if deadline is not None else None
+        if not call.done.wait(remaining):
+            from etsin_finder.finder import app
+            app.logger.warning("Call {0} did not complete in {1} seconds".format(getattr(fn, '__name__', fn), timeout))
+            metrics.incr('fan_out.timeout')
+            results.append(None)
+        elif call.error is not None:
+            raise call.error
+        else:
+            results.append(call.result)
+    return results
+
+
+class _Call:
+    """An in-flight call whose result is shared with concurrent callers"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls made with the same key into a single call.
+
+    The first caller for a key executes the function. Callers arriving while it runs wait for it and
+    get the same result (or exception) instead of executing the function again. Results are not kept
+    after the call completes, caching is left to the caller.
+
+    With copy_result, each waiting caller gets its own deep copy of the result, so that callers may
+    modify the results they get. Otherwise the callers share the result object.
+    """
+
+    def __init__(self, name, copy_result=False):
+        """
+        Init SingleFlight.
+
+        :param name: Name used in metrics
+        :param copy_result: Give each waiting caller a copy of the result
+        """
+        self.name = name
+        self.copy_result = copy_result
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Execute fn(*args, **kwargs), or wait for an already running call with the same key.
+
+        Unless copy_result is set, waiting callers get the very same result object as the executing caller.
+
+        :param key: Hashable key identifying the call
+        :param fn:
+        :return: Result of fn
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not is_leader:
+            metrics.incr('singleflight.{0}.shared'.format(self.name))
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result) if self.copy_result else call.result
+
+        metrics.incr('singleflight.{0}.executed'.format(self.name))
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def in_flight(self, key):
+        """
+        Is a call with the given key currently executing.
+
+        :param key:
+        :return:
+        """
+        with self._lock:
+            return key in self._calls
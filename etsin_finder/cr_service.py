@@ -7,14 +7,28 @@
 
 """Used for performing operations related to Metax"""
 
+import json
+import time
+
 import requests
+from flask import has_request_context
 
 from etsin_finder.finder import app
 from etsin_finder.app_config import get_metax_api_config
-from etsin_finder.utils import json_or_empty, FlaskService
+from etsin_finder.concurrency import SingleFlight, spawn_background
+from etsin_finder.http_pool import get_pooled_session
+from etsin_finder.metrics import metrics
+from etsin_finder.path_index import build_path_index
+from etsin_finder.utils import \
+    json_or_empty, datetime_to_header, get_request_memo, sort_directory_listing, FlaskService
 
 log = app.logger
 
+# Returned by MetaxAPIService when a conditional request tells the record has not changed
+NOT_MODIFIED = object()
+# Returned by MetaxAPIService when Metax tells the record does not exist, as opposed to other failures
+NOT_FOUND = object()
+
 
 class MetaxAPIService(FlaskService):
     """Metax API Service"""
@@ -33,14 +47,18 @@ class MetaxAPIService(FlaskService):
             METAX_GET_CATALOG_RECORD_URL = 'https://{0}/rest/datasets'.format(metax_api_config['HOST']) + \
                                            '/{0}?expand_relation=data_catalog'
 
+            self.METAX_GET_CATALOG_RECORD_URL = METAX_GET_CATALOG_RECORD_URL
             self.METAX_GET_CATALOG_RECORD_WITH_FILE_DETAILS_URL = METAX_GET_CATALOG_RECORD_URL + '&file_details'
             self.METAX_GET_REMOVED_CATALOG_RECORD_URL = METAX_GET_CATALOG_RECORD_URL + '&removed=true'
             self.METAX_GET_DIRECTORY_FOR_CR_URL = 'https://{0}/rest/directories'.format(metax_api_config['HOST']) + \
                                                   '/{0}/files?cr_identifier={1}'
+            self.METAX_GET_FILES_FOR_CR_URL = 'https://{0}/rest/datasets'.format(metax_api_config['HOST']) + \
+                '/{0}/files?file_fields=identifier,file_name,file_path,byte_size,parent_directory'
 
             self.user = metax_api_config['USER']
             self.pw = metax_api_config['PASSWORD']
             self.verify_ssl = metax_api_config.get('VERIFY_SSL', True)
+            self.session = get_pooled_session(metax_api_config['HOST'], self.is_testing)
         elif not self.is_testing:
             log.error("Unable to initialize MetaxAPIService due to missing config")
 
@@ -61,11 +79,11 @@ class MetaxAPIService(FlaskService):
             req_url = req_url + '&directory_fields={0}'.format(directory_fields)
 
         try:
-            metax_api_response = requests.get(req_url,
-                                              headers={'Accept': 'application/json'},
-                                              auth=(self.user, self.pw),
-                                              verify=self.verify_ssl,
-                                              timeout=10)
+            metax_api_response = self.session.get(req_url,
+                                                  headers={'Accept': 'application/json'},
+                                                  auth=(self.user, self.pw),
+                                                  verify=self.verify_ssl,
+                                                  timeout=10)
             metax_api_response.raise_for_status()
         except Exception as e:
             if isinstance(e, requests.HTTPError):
@@ -86,18 +104,67 @@ class MetaxAPIService(FlaskService):
 
         return metax_api_response.json()
 
-    def get_catalog_record_with_file_details(self, identifier):
+    def get_files_for_catalog_record(self, cr_identifier):
+        """
+        Get the names and paths of all files of a specific catalog record
+
+        :param cr_identifier:
+        :return:
+        """
+        try:
+            metax_api_response = self.session.get(self.METAX_GET_FILES_FOR_CR_URL.format(cr_identifier),
+                                                  headers={'Accept': 'application/json'},
+                                                  auth=(self.user, self.pw),
+                                                  verify=self.verify_ssl,
+                                                  timeout=30)
+            metax_api_response.raise_for_status()
+        except Exception as e:
+            if isinstance(e, requests.HTTPError):
+                log.warning(
+                    "Failed to get files of catalog record {0} from Metax API\n\
+                    Response status code: {1}\n\
+                    Response text: {2}"
+                    .format(
+                        cr_identifier,
+                        metax_api_response.status_code,
+                        json_or_empty(metax_api_response) or metax_api_response.text
+                    ))
+            else:
+                log.error("Failed to get files of catalog record {0} from Metax API\n{1}".format(cr_identifier, e))
+            return None
+
+        return metax_api_response.json()
+
+    def get_catalog_record_with_file_details(self, identifier, if_modified_since=None):
         """
         Get a catalog record with a given identifier from MetaX API.
 
-        :return: Metax catalog record as json
+        :param identifier:
+        :param if_modified_since: HTTP datetime string (RFC2616). If given, NOT_MODIFIED is returned when
+            the record has not been modified since.
+        :return: Metax catalog record as json, NOT_FOUND if it does not exist or None on other errors
+        """
+        return self._get_catalog_record(self.METAX_GET_CATALOG_RECORD_WITH_FILE_DETAILS_URL, identifier,
+                                        if_modified_since)
+
+    def get_catalog_record_without_file_details(self, identifier, if_modified_since=None):
         """
+        Get a catalog record with a given identifier from MetaX API, without the details of its files and directories.
+
+        :param identifier:
+        :param if_modified_since: HTTP datetime string (RFC2616). If given, NOT_MODIFIED is returned when
+            the record has not been modified since.
+        :return: Metax catalog record as json, NOT_FOUND if it does not exist or None on other errors
+        """
+        return self._get_catalog_record(self.METAX_GET_CATALOG_RECORD_URL, identifier, if_modified_since)
+
+    def _get_catalog_record(self, url, identifier, if_modified_since):
         try:
-            metax_api_response = requests.get(self.METAX_GET_CATALOG_RECORD_WITH_FILE_DETAILS_URL.format(identifier),
-                                              headers={'Accept': 'application/json'},
-                                              auth=(self.user, self.pw),
-                                              verify=self.verify_ssl,
-                                              timeout=3)
+            metax_api_response = self.session.get(url.format(identifier),
+                                                  headers=self._get_headers(if_modified_since),
+                                                  auth=(self.user, self.pw),
+                                                  verify=self.verify_ssl,
+                                                  timeout=3)
             metax_api_response.raise_for_status()
         except Exception as e:
             if isinstance(e, requests.HTTPError):
@@ -112,23 +179,30 @@ class MetaxAPIService(FlaskService):
                 )
             else:
                 log.error("Failed to get catalog record {0} from Metax API\n{1}".format(identifier, e))
+            if isinstance(e, requests.HTTPError) and metax_api_response.status_code == 404:
+                return NOT_FOUND
             return None
+        if metax_api_response.status_code == 304:
+            return NOT_MODIFIED
         return metax_api_response.json()
 
-    def get_removed_catalog_record(self, identifier):
+    def get_removed_catalog_record(self, identifier, if_modified_since=None):
         """
         Get a catalog record with a given identifier from MetaX API
 
         Should return only datasets that are removed.
 
-        :return: Metax catalog record as json
+        :param identifier:
+        :param if_modified_since: HTTP datetime string (RFC2616). If given, NOT_MODIFIED is returned when
+            the record has not been modified since.
+        :return: Metax catalog record as json, NOT_FOUND if it does not exist or None on other errors
         """
         try:
-            metax_api_response = requests.get(self.METAX_GET_REMOVED_CATALOG_RECORD_URL.format(identifier),
-                                              headers={'Accept': 'application/json'},
-                                              auth=(self.user, self.pw),
-                                              verify=self.verify_ssl,
-                                              timeout=3)
+            metax_api_response = self.session.get(self.METAX_GET_REMOVED_CATALOG_RECORD_URL.format(identifier),
+                                                  headers=self._get_headers(if_modified_since),
+                                                  auth=(self.user, self.pw),
+                                                  verify=self.verify_ssl,
+                                                  timeout=3)
             metax_api_response.raise_for_status()
         except Exception as e:
             if isinstance(e, requests.HTTPError):
@@ -142,47 +216,196 @@ class MetaxAPIService(FlaskService):
                     ))
             else:
                 log.error("Failed to get removed catalog record {0} from Metax API\n{1}".format(identifier, e))
+            if isinstance(e, requests.HTTPError) and metax_api_response.status_code == 404:
+                return NOT_FOUND
             return None
+        if metax_api_response.status_code == 304:
+            return NOT_MODIFIED
 
         return metax_api_response.json()
 
+    @staticmethod
+    def _get_headers(if_modified_since=None):
+        headers = {'Accept': 'application/json'}
+        if if_modified_since:
+            headers['If-Modified-Since'] = if_modified_since
+        return headers
+
 
 _metax_api = MetaxAPIService(app)
+_cr_fetches = SingleFlight('catalog_record', copy_result=True)
+_path_index_builds = SingleFlight('path_index')
 
 
-def get_catalog_record(cr_id, check_removed_if_not_exist, refresh_cache=False):
+def get_catalog_record(cr_id, check_removed_if_not_exist, refresh_cache=False, file_details=True):
     """
     Get single catalog record.
 
-    If it does not exist, try checking/fetching from deleted catalog records.
+    If it does not exist, try checking/fetching from deleted catalog records. Concurrent cache misses
+    for the same record share a single Metax fetch, and each caller gets its own copy of the record.
+
+    With refresh_cache, a cached record is revalidated with a conditional request to Metax and
+    downloaded again only if it has been modified. Without it, a stale cached record is returned
+    immediately and revalidated in the background.
+
+    Records Metax reports as not existing are remembered for a short while, so that repeated lookups
+    for unknown ids do not reach Metax. Cached removed records are returned only when
+    check_removed_if_not_exist is set, as they would be when fetched from Metax.
+
+    Records fetched without file_details are cached separately from the records with file details.
+
+    The time the record was last validated is remembered for the request, see get_remaining_soft_ttl.
 
     :param cr_id:
     :param check_removed_if_not_exist:
     :param refresh_cache:
+    :param file_details: Include the details of the files and directories of the record
     :return:
     """
     if refresh_cache:
-        return app.cr_cache.update_cache(cr_id, _get_cr_from_metax(cr_id, check_removed_if_not_exist))
-
-    cr = app.cr_cache.get_from_cache(cr_id)
-    if cr is None:
-        cr = _get_cr_from_metax(cr_id, check_removed_if_not_exist)
-        return app.cr_cache.update_cache(cr_id, cr)
-    else:
+        cr = _cr_fetches.do((cr_id, check_removed_if_not_exist, file_details, 'revalidate'),
+                            _revalidate_cr, cr_id, check_removed_if_not_exist, file_details)
+        _remember_validated_at(cr_id, file_details, time.time())
         return cr
 
+    cache = _get_cr_cache(file_details)
+    entry = cache.get_cache_entry(cr_id)
+    if entry is not None:
+        if entry.get('not_found'):
+            return _get_cr_for_not_found_entry(cr_id, check_removed_if_not_exist, entry, file_details)
+        if entry.get('removed') and not check_removed_if_not_exist:
+            return None
+        if cache.is_stale(entry):
+            _revalidate_cr_in_background(cr_id, check_removed_if_not_exist, file_details)
+        _remember_validated_at(cr_id, file_details, entry['validated_at'])
+        return entry['catalog_record']
+
+    cr = _cr_fetches.do((cr_id, check_removed_if_not_exist, file_details),
+                        _fetch_and_cache_cr, cr_id, check_removed_if_not_exist, False, file_details)
+    _remember_validated_at(cr_id, file_details, time.time())
+    return cr
+
+
+def get_remaining_soft_ttl(cr_id, file_details=True):
+    """
+    Get the number of seconds until the catalog record got during the current request becomes stale.
+
+    Anything built from the record should not be cached for longer, as the record is not revalidated
+    before that.
+
+    :param cr_id:
+    :param file_details:
+    :return: Seconds, or None if the record has not been got during the request
+    """
+    if not has_request_context():
+        return None
+    validated_at = get_request_memo().get(('cr_validated_at', cr_id, file_details))
+    if validated_at is None:
+        return None
+    return _get_cr_cache(file_details).CACHE_ITEM_SOFT_TTL - (time.time() - validated_at)
+
+
+def _remember_validated_at(cr_id, file_details, validated_at):
+    if has_request_context():
+        get_request_memo()[('cr_validated_at', cr_id, file_details)] = validated_at
+
+
+def invalidate_catalog_record(cr_id):
+    """
+    Drop catalog record, its directory listings and responses from cache after it has been modified in Metax.
+
+    The other versions of the dataset known from the cached record are dropped as well, since their
+    version sets change when versions are created or deleted. Fetches of the records still in flight do not
+    write them back to cache, see CatalogRecordCache.
+
+    :param cr_id:
+    :return:
+    """
+    if not cr_id:
+        return
+    cr = app.cr_cache.get_from_cache(cr_id) or app.cr_summary_cache.get_from_cache(cr_id)
+    identifiers = {cr_id}
+    if cr:
+        identifiers.update(version.get('identifier') for version in cr.get('dataset_version_set', [])
+                           if version.get('identifier'))
+    for identifier in identifiers:
+        app.cr_cache.invalidate(identifier)
+        app.cr_summary_cache.invalidate(identifier)
+        app.dir_cache.invalidate(identifier)
+        app.response_cache.invalidate(identifier)
+    metrics.incr('catalog_record.invalidated', len(identifiers))
+
 
 def get_directory_data_for_catalog_record(cr_id, dir_id, file_fields, directory_fields):
     """
     Get data related to file/directory browsing view in the frontend.
 
+    Listings are sorted by name and cached sorted until the catalog record is invalidated, so that pages of
+    a listing can be cut without sorting it again.
+
     :param cr_id:
     :param dir_id:
     :param file_fields:
     :param directory_fields:
     :return:
     """
-    return _metax_api.get_directory_for_catalog_record(cr_id, dir_id, file_fields, directory_fields)
+    generation = app.dir_cache.get_generation(cr_id)
+    dir_api_obj = app.dir_cache.get_from_cache(cr_id, generation, dir_id, file_fields, directory_fields)
+    if dir_api_obj is None:
+        dir_api_obj = _fetch_directory_listing(cr_id, dir_id, file_fields, directory_fields)
+        app.dir_cache.update_cache(cr_id, generation, dir_id, file_fields, directory_fields, dir_api_obj)
+    return dir_api_obj
+
+
+def prefetch_directory_data_for_catalog_record(cr_id, dir_id, file_fields, directory_fields):
+    """
+    Fetch directory listing of a catalog record into cache, unless it is cached already.
+
+    :param cr_id:
+    :param dir_id:
+    :param file_fields:
+    :param directory_fields:
+    :return: Size of the fetched listing in bytes, or None if nothing was fetched
+    """
+    generation = app.dir_cache.get_generation(cr_id)
+    if app.dir_cache.is_cached(cr_id, generation, dir_id, file_fields, directory_fields):
+        return None
+    dir_api_obj = _fetch_directory_listing(cr_id, dir_id, file_fields, directory_fields)
+    if not dir_api_obj:
+        return None
+    app.dir_cache.update_cache(cr_id, generation, dir_id, file_fields, directory_fields, dir_api_obj, prefetched=True)
+    return len(json.dumps(dir_api_obj))
+
+
+def get_path_index(cr_id):
+    """
+    Get index of the file and directory names of a catalog record, see path_index.
+
+    The index is built from the files of the record in Metax once and cached with the directory listings
+    of the record, until the record is invalidated. Concurrent builds of the same index share one build.
+
+    :param cr_id:
+    :return: Path index, or None if the files could not be fetched
+    """
+    generation = app.dir_cache.get_generation(cr_id)
+    index = app.dir_cache.get_path_index(cr_id, generation)
+    if index is None:
+        index = _path_index_builds.do((cr_id, generation), _build_and_cache_path_index, cr_id, generation)
+    return index
+
+
+def _build_and_cache_path_index(cr_id, generation):
+    files = _metax_api.get_files_for_catalog_record(cr_id)
+    if files is None:
+        return None
+    return app.dir_cache.update_path_index(cr_id, generation, build_path_index(files))
+
+
+def _fetch_directory_listing(cr_id, dir_id, file_fields, directory_fields):
+    dir_api_obj = _metax_api.get_directory_for_catalog_record(cr_id, dir_id, file_fields, directory_fields)
+    if dir_api_obj:
+        sort_directory_listing(dir_api_obj)
+    return dir_api_obj
 
 
 def get_catalog_record_access_type(cr):
@@ -247,8 +470,146 @@ def is_rems_catalog_record(catalog_record):
     return False
 
 
-def _get_cr_from_metax(cr_id, check_removed_if_not_exist):
-    cr = _metax_api.get_catalog_record_with_file_details(cr_id)
-    if not cr and check_removed_if_not_exist:
-        cr = _metax_api.get_removed_catalog_record(cr_id)
+def _get_cr_cache(file_details):
+    return app.cr_cache if file_details else app.cr_summary_cache
+
+
+def _get_active_cr_from_metax(cr_id, file_details, if_modified_since=None):
+    if file_details:
+        return _metax_api.get_catalog_record_with_file_details(cr_id, if_modified_since)
+    return _metax_api.get_catalog_record_without_file_details(cr_id, if_modified_since)
+
+
+def _get_cr_from_metax(cr_id, check_removed_if_not_exist, known_missing=False, file_details=True):
+    """
+    Fetch catalog record from Metax, falling back to removed records if requested.
+
+    :param cr_id:
+    :param check_removed_if_not_exist:
+    :param known_missing: The record is already known not to exist as an active record
+    :param file_details:
+    :return: catalog record, NOT_FOUND if Metax tells it does not exist or None on other errors
+    """
+    cr = NOT_FOUND if known_missing else _get_active_cr_from_metax(cr_id, file_details)
+    if check_removed_if_not_exist:
+        cr = _fall_back_to_removed_cr(cr_id, cr)
     return cr
+
+
+def _fall_back_to_removed_cr(cr_id, cr):
+    if cr is not None and cr is not NOT_FOUND:
+        return cr
+    removed_cr = _metax_api.get_removed_catalog_record(cr_id)
+    # Only tell the record does not exist when both lookups say so
+    return cr if removed_cr is NOT_FOUND else removed_cr
+
+
+def _fetch_and_cache_cr(cr_id, check_removed_if_not_exist, known_missing=False, file_details=True):
+    cache = _get_cr_cache(file_details)
+    write_token = cache.get_write_token(cr_id)
+    cr = _get_cr_from_metax(cr_id, check_removed_if_not_exist, known_missing, file_details)
+    if cache.is_write_allowed(cr_id, write_token):
+        return _cache_fetched_cr(cr_id, cr, check_removed_if_not_exist, file_details)
+
+    # Record was modified during the fetch, which may have returned it as it was before
+    metrics.incr('catalog_record.fetch.invalidated')
+    write_token = cache.get_write_token(cr_id)
+    cr = _get_cr_from_metax(cr_id, check_removed_if_not_exist, False, file_details)
+    if cache.is_write_allowed(cr_id, write_token):
+        return _cache_fetched_cr(cr_id, cr, check_removed_if_not_exist, file_details)
+    return None if cr is NOT_FOUND else cr
+
+
+def _cache_fetched_cr(cr_id, cr, check_removed_if_not_exist, file_details=True):
+    if cr is NOT_FOUND:
+        metrics.incr('catalog_record.not_found')
+        _get_cr_cache(file_details).update_cache_not_found(cr_id, check_removed_if_not_exist)
+        return None
+    return _get_cr_cache(file_details).update_cache(cr_id, cr)
+
+
+def _get_cr_for_not_found_entry(cr_id, check_removed_if_not_exist, entry, file_details=True):
+    if entry.get('removed_checked') or not check_removed_if_not_exist:
+        metrics.incr('catalog_record.not_found_served')
+        return None
+    # Only removed records still need to be checked
+    return _cr_fetches.do((cr_id, check_removed_if_not_exist, file_details, 'removed'),
+                          _fetch_and_cache_cr, cr_id, check_removed_if_not_exist, True, file_details)
+
+
+def _revalidate_cr_in_background(cr_id, check_removed_if_not_exist, file_details=True):
+    key = (cr_id, check_removed_if_not_exist, file_details, 'revalidate')
+    if _cr_fetches.in_flight(key):
+        return
+    metrics.incr('catalog_record.stale_served')
+    spawn_background(_cr_fetches.do, key, _revalidate_cr, cr_id, check_removed_if_not_exist, file_details)
+
+
+def _revalidate_cr(cr_id, check_removed_if_not_exist, file_details=True):
+    cache = _get_cr_cache(file_details)
+    write_token = cache.get_write_token(cr_id)
+    entry = cache.get_cache_entry(cr_id)
+    if entry is not None and entry.get('not_found'):
+        # Not found entries are short-lived, so they are trusted without revalidation
+        return _get_cr_for_not_found_entry(cr_id, check_removed_if_not_exist, entry, file_details)
+    if entry is not None and entry.get('removed') and not check_removed_if_not_exist:
+        return None
+
+    cached_cr = entry['catalog_record'] if entry else None
+    if cached_cr and cache.is_expired(entry):
+        # Changes to the files of the record do not change its modification time, so it is downloaded again
+        metrics.incr('catalog_record.revalidate.expired')
+        cr = _get_cr_from_metax(cr_id, check_removed_if_not_exist, False, file_details)
+        if not cache.is_write_allowed(cr_id, write_token):
+            return _fetch_and_cache_cr(cr_id, check_removed_if_not_exist, False, file_details)
+        if cr is None:
+            metrics.incr('catalog_record.revalidate.failed')
+            return cache.postpone_revalidation(cr_id, entry)
+        if cr != cached_cr:
+            app.dir_cache.invalidate(cr_id)
+            app.response_cache.invalidate(cr_id)
+        return _cache_fetched_cr(cr_id, cr, check_removed_if_not_exist, file_details)
+
+    if_modified_since = _get_cr_last_modified_header(cached_cr) if cached_cr else None
+    if not if_modified_since:
+        return _fetch_and_cache_cr(cr_id, check_removed_if_not_exist, False, file_details)
+
+    if cached_cr.get('removed', False):
+        cr = _metax_api.get_removed_catalog_record(cr_id, if_modified_since)
+    else:
+        cr = _get_active_cr_from_metax(cr_id, file_details, if_modified_since)
+        if check_removed_if_not_exist:
+            cr = _fall_back_to_removed_cr(cr_id, cr)
+
+    if not cache.is_write_allowed(cr_id, write_token):
+        # Record was invalidated during revalidation, so neither the entry nor the response may be stored
+        return _fetch_and_cache_cr(cr_id, check_removed_if_not_exist, False, file_details)
+
+    if cr is NOT_MODIFIED:
+        metrics.incr('catalog_record.revalidate.not_modified')
+        return cache.mark_validated(cr_id, entry)
+
+    if cr is None:
+        # Metax could not be reached, which tells nothing about the record
+        metrics.incr('catalog_record.revalidate.failed')
+        return cache.postpone_revalidation(cr_id, entry)
+
+    metrics.incr('catalog_record.revalidate.modified')
+    app.dir_cache.invalidate(cr_id)
+    app.response_cache.invalidate(cr_id)
+    return _cache_fetched_cr(cr_id, cr, check_removed_if_not_exist, file_details)
+
+
+def _get_cr_last_modified_header(cr):
+    """
+    Get the modification time of a catalog record as HTTP datetime.
+
+    If date_modified is not present, the record has not been modified after it was created.
+
+    :param cr:
+    :return:
+    """
+    last_edit = cr.get('date_modified') or cr.get('date_created')
+    if not last_edit:
+        return None
+    return datetime_to_header(last_edit)
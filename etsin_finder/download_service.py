@@ -11,6 +11,7 @@ from flask import Response, stream_with_context
 import requests
 
 from etsin_finder.app_config import get_download_api_config
+from etsin_finder.http_pool import get_pooled_session
 from etsin_finder.finder import app
 from etsin_finder.utils import json_or_empty, FlaskService
 
@@ -35,6 +36,7 @@ class DownloadAPIService(FlaskService):
                 dl_api_config['HOST'], dl_api_config['PORT']) + '/{0}'
             self.USER = dl_api_config['USER']
             self.PASSWORD = dl_api_config['PASSWORD']
+            self.session = get_pooled_session(dl_api_config['HOST'], self.is_testing)
         elif not self.is_testing:
             log.error('Unable to initialize DownloadAPIService due to missing config')
 
@@ -52,8 +54,8 @@ class DownloadAPIService(FlaskService):
 
         url = self._create_url(cr_id, file_ids, dir_ids)
         try:
-            dl_api_response = requests.get(url, stream=True, timeout=15, auth=(self.USER,
-                                                                               self.PASSWORD.encode('utf-8')))
+            dl_api_response = self.session.get(url, stream=True, timeout=15, auth=(self.USER,
+                                                                                   self.PASSWORD.encode('utf-8')))
             dl_api_response.raise_for_status()
         except requests.Timeout as t:
             log.error('Request to Download API timed out\n{0}'.format(t))
@@ -17,7 +17,15 @@ from flask_restful import Api
 from flask.logging import default_handler
 
 from etsin_finder.app_config import get_app_config
-from etsin_finder.cache import CatalogRecordCache, RemsCache
+from etsin_finder.cache import \
+    CatalogRecordCache, \
+    CatalogRecordSummaryCache, \
+    DirectoryListingCache, \
+    QvainDirectoryCache, \
+    RemsCache, \
+    ResponseCache
+from etsin_finder.prefetch import Prefetcher
+from etsin_finder.stats import StatsReporter
 from etsin_finder.utils import executing_travis, get_log_config
 
 
@@ -36,7 +44,17 @@ def create_app():
         app.config.update({'SAML_PATH': '/home/etsin-user'})
     app.mail = Mail(app)
     app.cr_cache = CatalogRecordCache(app)
+    app.cr_summary_cache = CatalogRecordSummaryCache(app)
+    app.dir_cache = DirectoryListingCache(app)
+    app.response_cache = ResponseCache(app)
     app.rems_cache = RemsCache(app)
+    app.qvain_dir_cache = QvainDirectoryCache(app)
+    app.dir_prefetcher = Prefetcher(app, DirectoryListingCache.CACHE_NAME)
+    app.qvain_dir_prefetcher = Prefetcher(app, QvainDirectoryCache.CACHE_NAME)
+    app.stats_reporter = StatsReporter(app, [
+        app.cr_cache, app.cr_summary_cache, app.dir_cache, app.response_cache, app.rems_cache, app.qvain_dir_cache
+    ], [app.dir_prefetcher, app.qvain_dir_prefetcher])
+    app.before_request(app.stats_reporter.ensure_started)
 
     return app
 
@@ -59,7 +77,8 @@ def add_restful_resources(app):
     :return:
     """
     api = Api(app)
-    from etsin_finder.resources import REMSApplyForPermission, Contact, Dataset, User, Session, Files, Download
+    from etsin_finder.resources import \
+        REMSApplyForPermission, Contact, Dataset, DatasetFiles, User, Session, Files, FileSearch, Download
     from etsin_finder.qvain_light_resources import (
         ProjectFiles, FileDirectory, FileCharacteristics, UserDatasets,
         QvainDataset, QvainDatasetEdit, QvainDatasetDelete
@@ -70,7 +89,9 @@ def add_restful_resources(app):
     )
 
     api.add_resource(Dataset, '/api/dataset/<string:cr_id>')
+    api.add_resource(DatasetFiles, '/api/dataset/<string:cr_id>/files')
     api.add_resource(Files, '/api/files/<string:cr_id>')
+    api.add_resource(FileSearch, '/api/files/<string:cr_id>/search')
     api.add_resource(Contact, '/api/email/<string:cr_id>')
     api.add_resource(User, '/api/user')
     api.add_resource(Session, '/api/session')
@@ -0,0 +1,62 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2020 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""Shared keep-alive HTTP connection pools for upstream services"""
+
+import threading
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from etsin_finder.app_config import get_http_pool_config
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_pooled_session(host, is_testing):
+    """
+    Get the shared requests session used for all calls to the given upstream host.
+
+    One session, and thus one urllib3 connection pool, is created per host per worker process, so that
+    TCP connections and TLS sessions are kept alive and reused between requests. urllib3 pools are
+    guarded by locks, which gevent monkey patches, so the session can be shared between greenlets.
+
+    The session is shared by the requests of all users, so its cookie jar accepts no cookies. Cookies
+    set by one upstream response would otherwise be sent along with the calls made for other users.
+
+    :param host: Upstream host the session is used for
+    :param is_testing:
+    :return: requests.Session
+    """
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = _create_session(get_http_pool_config(is_testing))
+            _sessions[host] = session
+    return session
+
+
+def close_pooled_sessions():
+    """Close all pooled sessions and their keep-alive connections."""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def _create_session(pool_config):
+    adapter = HTTPAdapter(pool_connections=pool_config['POOL_CONNECTIONS'],
+                          pool_maxsize=pool_config['POOL_MAXSIZE'],
+                          pool_block=pool_config['POOL_BLOCK'],
+                          max_retries=pool_config['MAX_RETRIES'])
+    session = requests.Session()
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
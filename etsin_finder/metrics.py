@@ -0,0 +1,71 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2020 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""Lightweight per-worker counters for caches and upstream calls"""
+
+import threading
+from collections import Counter
+
+
+class Counters:
+    """Thread-safe named counters. Counter names are dot separated, e.g. 'cache.cr.l1.hit'"""
+
+    def __init__(self):
+        """Init counters"""
+        self._lock = threading.Lock()
+        self._counters = Counter()
+
+    def incr(self, name, amount=1):
+        """
+        Increment counter by amount.
+
+        :param name:
+        :param amount:
+        """
+        with self._lock:
+            self._counters[name] += amount
+
+    def get(self, name):
+        """
+        Get current value of a counter.
+
+        :param name:
+        :return:
+        """
+        with self._lock:
+            return self._counters[name]
+
+    def snapshot(self, prefix=''):
+        """
+        Get a copy of all counters whose name starts with prefix.
+
+        :param prefix:
+        :return: dict
+        """
+        with self._lock:
+            return {name: value for name, value in self._counters.items() if name.startswith(prefix)}
+
+    def ratio(self, hits_name, misses_name):
+        """
+        Get hits / (hits + misses) for two counters, or None if neither has been incremented.
+
+        :param hits_name:
+        :param misses_name:
+        :return:
+        """
+        with self._lock:
+            hits = self._counters[hits_name]
+            total = hits + self._counters[misses_name]
+        return hits / total if total else None
+
+    def reset(self):
+        """Reset all counters."""
+        with self._lock:
+            self._counters.clear()
+
+
+metrics = Counters()
@@ -0,0 +1,93 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2020 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""
+Compact index of the file and directory names of a dataset, for searching its directory tree by name.
+
+The index is a plain dict of lists, so that it can be cached with the same serializers as Metax responses.
+Files and directories are stored as columns. Names are indexed in 'keys', sorted and casefolded, with 'refs'
+pointing to the file (i >= 0) or directory (-i - 1) of each name. Prefix queries are answered with a binary
+search and substring queries with a scan of the names only.
+"""
+
+from bisect import bisect_left
+
+FILE_COLUMNS = ('identifier', 'file_name', 'file_path', 'byte_size')
+DIRECTORY_COLUMNS = ('identifier', 'directory_name', 'directory_path')
+
+
+def build_path_index(files):
+    """
+    Build path index from the files of a dataset.
+
+    Directories are derived from the paths of the files. Identifiers are known for the directories that
+    directly contain files of the dataset.
+
+    :param files: File objects from Metax with file_name, file_path and parent_directory
+    :return: Path index
+    """
+    file_columns = {column: [] for column in FILE_COLUMNS}
+    directory_ids = {}
+    for file in files:
+        path = file.get('file_path') or ''
+        for column in FILE_COLUMNS:
+            file_columns[column].append(file.get(column))
+        parent_path = path.rsplit('/', 1)[0]
+        parent_id = (file.get('parent_directory') or {}).get('identifier')
+        while parent_path and parent_path not in directory_ids:
+            directory_ids[parent_path] = parent_id
+            parent_id = None
+            parent_path = parent_path.rsplit('/', 1)[0]
+        if parent_path and parent_id and not directory_ids[parent_path]:
+            directory_ids[parent_path] = parent_id
+
+    directory_columns = {column: [] for column in DIRECTORY_COLUMNS}
+    for path, identifier in directory_ids.items():
+        directory_columns['identifier'].append(identifier)
+        directory_columns['directory_name'].append(path.rsplit('/', 1)[-1])
+        directory_columns['directory_path'].append(path)
+
+    names = [(name or '', i) for i, name in enumerate(file_columns['file_name'])]
+    names.extend((name, -i - 1) for i, name in enumerate(directory_columns['directory_name']))
+    names.sort(key=lambda name_ref: (name_ref[0].casefold(), name_ref[0]))
+    return {
+        'files': file_columns,
+        'directories': directory_columns,
+        'keys': [name.casefold() for name, _ in names],
+        'refs': [ref for _, ref in names]
+    }
+
+
+def search_path_index(index, query, prefix_only=False):
+    """
+    Search path index for files and directories by name, case-insensitively.
+
+    :param index: Path index
+    :param query: Part of the name
+    :param prefix_only: Match only names starting with the query
+    :return: Directory listing of the matching 'directories' and 'files', sorted by name
+    """
+    query = query.casefold()
+    keys = index['keys']
+    if prefix_only:
+        start = bisect_left(keys, query)
+        end = start
+        while end < len(keys) and keys[end].startswith(query):
+            end += 1
+        matches = index['refs'][start:end]
+    else:
+        refs = index['refs']
+        matches = [refs[i] for i, key in enumerate(keys) if query in key]
+
+    files = index['files']
+    directories = index['directories']
+    return {
+        'directories': [
+            {column: directories[column][-ref - 1] for column in DIRECTORY_COLUMNS} for ref in matches if ref < 0
+        ],
+        'files': [{column: files[column][ref] for column in FILE_COLUMNS} for ref in matches if ref >= 0]
+    }
@@ -0,0 +1,104 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2020 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""Opt-in background prefetch of child directory listings"""
+
+import threading
+import time
+
+from etsin_finder.app_config import get_prefetch_config
+from etsin_finder.concurrency import spawn_background
+from etsin_finder.metrics import metrics
+from etsin_finder.utils import FlaskService
+
+
+class Prefetcher(FlaskService):
+    """
+    Prefetch of listings into a cache in the background, per worker.
+
+    After a directory has been served, prefetch() fetches its first CHILDREN subdirectories into the cache the
+    listings are served from, so that the next click is served from cache. Prefetches are skipped instead of
+    queued when MAX_CONCURRENT prefetches are already running or MAX_BYTES_PER_MINUTE has been prefetched
+    within the current minute.
+
+    The cache counts a hit in 'prefetch.<name>.hit' when it serves a prefetched listing for the first time,
+    so that the hit rate tells how many prefetches were worth their Metax load.
+    """
+
+    WINDOW = 60
+
+    def __init__(self, app, name):
+        """
+        Setup prefetcher.
+
+        :param app:
+        :param name: Name of the cache the listings are prefetched into
+        """
+        super().__init__(app)
+        config = get_prefetch_config(self.is_testing)
+        self.ENABLED = config is not None
+        self.name = name
+        self.children = config['CHILDREN'] if config else 0
+        self.max_bytes = config['MAX_BYTES_PER_MINUTE'] if config else 0
+        self._slots = threading.BoundedSemaphore(config['MAX_CONCURRENT']) if config else None
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+
+    def prefetch(self, fetch, keys):
+        """
+        Prefetch listings in the background.
+
+        :param fetch: Function fetching the listing of a key into the cache. Returns the size of the listing
+            in bytes, or None if nothing was fetched, e.g. because the listing was already cached.
+        :param keys: Keys of the listings in order of preference. Only the first CHILDREN are prefetched.
+        """
+        if not self.ENABLED:
+            return
+        for key in keys[:self.children]:
+            if not self._within_byte_budget() or not self._slots.acquire(blocking=False):
+                self._count('skipped')
+                continue
+            self._count('queued')
+            spawn_background(self._run, fetch, key)
+
+    def get_stats(self):
+        """
+        Get prefetch counters and hit rate in this worker.
+
+        :return: dict
+        """
+        prefix = 'prefetch.{0}.'.format(self.name)
+        fetched = metrics.get(prefix + 'fetched')
+        return {
+            'hit_ratio': metrics.get(prefix + 'hit') / fetched if fetched else None,
+            'counters': metrics.snapshot(prefix)
+        }
+
+    def _run(self, fetch, key):
+        try:
+            size = fetch(key)
+        finally:
+            self._slots.release()
+        if size is None:
+            self._count('not_needed')
+            return
+        self._count('fetched')
+        self._count('bytes', size)
+        with self._lock:
+            self._window_bytes += size
+
+    def _within_byte_budget(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= self.WINDOW:
+                self._window_start = now
+                self._window_bytes = 0
+            return self._window_bytes < self.max_bytes
+
+    def _count(self, counter, amount=1):
+        metrics.incr('prefetch.{0}.{1}'.format(self.name, counter), amount)
@@ -12,7 +12,7 @@ import inspect
 from marshmallow import ValidationError
 from flask import request, session
 from flask_mail import Message
-from flask_restful import abort, reqparse, Resource
+from flask_restful import abort, inputs, reqparse, Resource
 
 from etsin_finder.app_config import get_app_config
 from etsin_finder import authentication
@@ -21,7 +21,6 @@ from etsin_finder import cr_service
 from etsin_finder import qvain_light_service
 from etsin_finder.finder import app
 from etsin_finder.utils import \
-    sort_array_of_obj_by_key, \
     slice_array_on_limit, \
     datetime_to_header, \
     SAML_ATTRIBUTES
@@ -69,38 +68,57 @@ def log_request(f):
     return func
 
 
+def _get_directory_page_parser():
+    """
+    Get parser for the paging arguments of directory listings.
+
+    :return:
+    """
+    parser = reqparse.RequestParser()
+    parser.add_argument('offset', required=False, type=inputs.natural)
+    parser.add_argument('limit', required=False, type=inputs.positive)
+    return parser
+
+
+def _prefetch_subdirectories(dir_obj):
+    """
+    Fetch subdirectories the user is likely to open next into cache in the background.
+
+    :param dir_obj: Directory listing page
+    """
+    app.qvain_dir_prefetcher.prefetch(
+        qvain_light_service.prefetch_directory,
+        [directory['identifier'] for directory in dir_obj.get('directories', []) if directory.get('identifier')])
+
+
 class ProjectFiles(Resource):
     """File/directory related REST endpoints for getting project directory"""
 
     def __init__(self):
         """Setup file endpoints"""
+        self.parser = _get_directory_page_parser()
 
     @log_request
     def get(self, pid):
         """
         Get files and directory objects for frontend.
 
+        Directories and files are paged as one sequence with offset and limit, see get_directory_page.
+
         :param pid:
         :return:
         """
         # Return data only if user is a member of the project
         user_ida_projects = get_user_ida_projects() or []
         if pid in user_ida_projects:
-            project_dir_obj = qvain_light_service.get_directory_for_project(pid)
+            args = self.parser.parse_args()
+            project_dir_obj = qvain_light_service.get_directory_page_for_project(
+                pid, args.get('offset'), args.get('limit'), TOTAL_ITEM_LIMIT)
         else:
             project_dir_obj = None
 
         if project_dir_obj:
-            # Sort the items
-            sort_array_of_obj_by_key(project_dir_obj.get('directories', []), 'directory_name')
-            sort_array_of_obj_by_key(project_dir_obj.get('files', []), 'file_name')
-
-            # Limit the amount of items to be sent to the frontend
-            if 'directories' in project_dir_obj:
-                project_dir_obj['directories'] = slice_array_on_limit(project_dir_obj['directories'], TOTAL_ITEM_LIMIT)
-            if 'files' in project_dir_obj:
-                project_dir_obj['files'] = slice_array_on_limit(project_dir_obj['files'], TOTAL_ITEM_LIMIT)
-
+            _prefetch_subdirectories(project_dir_obj)
             return project_dir_obj, 200
         log.warning('User is missing project or project_dir_obj is invalid\npid: {0}'.format(pid))
         return '', 404
@@ -111,28 +129,27 @@ class FileDirectory(Resource):
 
     def __init__(self):
         """Setup file endpoints"""
+        self.parser = _get_directory_page_parser()
 
     @log_request
     def get(self, dir_id):
         """
         Get files and directory objects for frontend.
 
+        Directories and files are paged as one sequence with offset and limit, see get_directory_page.
+
         :param dir_id:
         :return:
         """
-        dir_obj = qvain_light_service.get_directory(dir_id)
-
         # Return data only if authenticated
-        if dir_obj and authentication.is_authenticated():
-            # Sort the items
-            sort_array_of_obj_by_key(dir_obj.get('directories', []), 'directory_name')
-            sort_array_of_obj_by_key(dir_obj.get('files', []), 'file_name')
+        if authentication.is_authenticated():
+            args = self.parser.parse_args()
+            dir_obj = qvain_light_service.get_directory_page(dir_id, args.get('offset'), args.get('limit'), TOTAL_ITEM_LIMIT)
+        else:
+            dir_obj = None
 
-            # Limit the amount of items to be sent to the frontend
-            if 'directories' in dir_obj:
-                dir_obj['directories'] = slice_array_on_limit(dir_obj['directories'], TOTAL_ITEM_LIMIT)
-            if 'files' in dir_obj:
-                dir_obj['files'] = slice_array_on_limit(dir_obj['files'], TOTAL_ITEM_LIMIT)
+        if dir_obj:
+            _prefetch_subdirectories(dir_obj)
             return dir_obj, 200
         log.warning('User not authenticated or dir_obj is invalid\ndir_id: {0}'.format(dir_id))
         return '', 404
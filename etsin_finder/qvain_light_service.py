@@ -12,7 +12,9 @@ from flask import jsonify
 
 from etsin_finder.finder import app
 from etsin_finder.app_config import get_metax_qvain_api_config
-from etsin_finder.utils import json_or_empty, FlaskService
+from etsin_finder.cr_service import invalidate_catalog_record
+from etsin_finder.http_pool import get_pooled_session
+from etsin_finder.utils import json_or_empty, paginate_directory_listing, sort_directory_listing, FlaskService
 import json
 
 log = app.logger
@@ -55,6 +57,7 @@ class MetaxQvainLightAPIService(FlaskService):
             self.user = metax_qvain_api_config['USER']
             self.pw = metax_qvain_api_config['PASSWORD']
             self.verify_ssl = metax_qvain_api_config.get('VERIFY_SSL', True)
+            self.session = get_pooled_session(metax_qvain_api_config['HOST'], self.is_testing)
         elif not self.is_testing:
             log.error("Unable to initialize MetaxAPIService due to missing config")
 
@@ -68,11 +71,11 @@ class MetaxQvainLightAPIService(FlaskService):
         req_url = self.METAX_GET_DIRECTORY_FOR_PROJECT_URL.format(project_identifier)
 
         try:
-            metax_qvain_api_response = requests.get(req_url,
-                                                    headers={'Accept': 'application/json'},
-                                                    auth=(self.user, self.pw),
-                                                    verify=self.verify_ssl,
-                                                    timeout=10)
+            metax_qvain_api_response = self.session.get(req_url,
+                                                        headers={'Accept': 'application/json'},
+                                                        auth=(self.user, self.pw),
+                                                        verify=self.verify_ssl,
+                                                        timeout=10)
             metax_qvain_api_response.raise_for_status()
         except Exception as e:
             if isinstance(e, requests.HTTPError):
@@ -99,11 +102,11 @@ class MetaxQvainLightAPIService(FlaskService):
         req_url = self.METAX_GET_DIRECTORY.format(dir_identifier)
 
         try:
-            metax_qvain_api_response = requests.get(req_url,
-                                                    headers={'Accept': 'application/json'},
-                                                    auth=(self.user, self.pw),
-                                                    verify=self.verify_ssl,
-                                                    timeout=10)
+            metax_qvain_api_response = self.session.get(req_url,
+                                                        headers={'Accept': 'application/json'},
+                                                        auth=(self.user, self.pw),
+                                                        verify=self.verify_ssl,
+                                                        timeout=10)
             metax_qvain_api_response.raise_for_status()
         except Exception as e:
             if isinstance(e, requests.HTTPError):
@@ -130,11 +133,11 @@ class MetaxQvainLightAPIService(FlaskService):
         req_url = self.METAX_GET_FILE.format(file_identifier)
 
         try:
-            metax_qvain_api_response = requests.get(req_url,
-                                                    headers={'Accept': 'application/json'},
-                                                    auth=(self.user, self.pw),
-                                                    verify=self.verify_ssl,
-                                                    timeout=10)
+            metax_qvain_api_response = self.session.get(req_url,
+                                                        headers={'Accept': 'application/json'},
+                                                        auth=(self.user, self.pw),
+                                                        verify=self.verify_ssl,
+                                                        timeout=10)
             metax_qvain_api_response.raise_for_status()
         except Exception as e:
             if isinstance(e, requests.HTTPError):
@@ -171,12 +174,12 @@ class MetaxQvainLightAPIService(FlaskService):
         req_url = self.METAX_GET_FILE.format(file_identifier)
 
         try:
-            metax_qvain_api_response = requests.patch(req_url,
-                                                      headers={'Accept': 'application/json', 'Content-Type': 'application/json'},
-                                                      data=json.dumps(data),
-                                                      auth=(self.user, self.pw),
-                                                      verify=self.verify_ssl,
-                                                      timeout=10)
+            metax_qvain_api_response = self.session.patch(req_url,
+                                                          headers={'Accept': 'application/json', 'Content-Type': 'application/json'},
+                                                          data=json.dumps(data),
+                                                          auth=(self.user, self.pw),
+                                                          verify=self.verify_ssl,
+                                                          timeout=10)
             metax_qvain_api_response.raise_for_status()
         except Exception as e:
             if isinstance(e, requests.HTTPError):
@@ -210,11 +213,11 @@ class MetaxQvainLightAPIService(FlaskService):
             req_url = req_url + "&offset={}".format(offset[0])
 
         try:
-            metax_api_response = requests.get(req_url,
-                                              headers={'Accept': 'application/json'},
-                                              auth=(self.user, self.pw),
-                                              verify=self.verify_ssl,
-                                              timeout=10)
+            metax_api_response = self.session.get(req_url,
+                                                  headers={'Accept': 'application/json'},
+                                                  auth=(self.user, self.pw),
+                                                  verify=self.verify_ssl,
+                                                  timeout=10)
             metax_api_response.raise_for_status()
         except Exception as e:
             if isinstance(e, requests.HTTPError):
@@ -252,13 +255,13 @@ class MetaxQvainLightAPIService(FlaskService):
             req_url += '&pid_type=doi'
         headers = {'Accept': 'application/json'}
         try:
-            metax_api_response = requests.post(req_url,
-                                               params=params,
-                                               json=data,
-                                               headers=headers,
-                                               auth=(self.user, self.pw),
-                                               verify=self.verify_ssl,
-                                               timeout=30)
+            metax_api_response = self.session.post(req_url,
+                                                   params=params,
+                                                   json=data,
+                                                   headers=headers,
+                                                   auth=(self.user, self.pw),
+                                                   verify=self.verify_ssl,
+                                                   timeout=30)
             metax_api_response.raise_for_status()
         except Exception as e:
             if isinstance(e, requests.HTTPError):
@@ -293,13 +296,13 @@ class MetaxQvainLightAPIService(FlaskService):
         headers = {'Accept': 'application/json', 'If-Unmodified-Since': last_modified}
         log.debug('Request URL: {0}\nHeaders: {1}\nData: {2}'.format(req_url, headers, data))
         try:
-            metax_api_response = requests.patch(req_url,
-                                                params=params,
-                                                json=data,
-                                                headers=headers,
-                                                auth=(self.user, self.pw),
-                                                verify=self.verify_ssl,
-                                                timeout=30)
+            metax_api_response = self.session.patch(req_url,
+                                                    params=params,
+                                                    json=data,
+                                                    headers=headers,
+                                                    auth=(self.user, self.pw),
+                                                    verify=self.verify_ssl,
+                                                    timeout=30)
             metax_api_response.raise_for_status()
         except Exception as e:
             if isinstance(e, requests.HTTPError):
@@ -335,11 +338,11 @@ class MetaxQvainLightAPIService(FlaskService):
         req_url = self.METAX_GET_DATASET.format(cr_id)
         headers = {'Accept': 'application/json'}
         try:
-            metax_api_response = requests.get(req_url,
-                                              headers=headers,
-                                              auth=(self.user, self.pw),
-                                              verify=self.verify_ssl,
-                                              timeout=10)
+            metax_api_response = self.session.get(req_url,
+                                                  headers=headers,
+                                                  auth=(self.user, self.pw),
+                                                  verify=self.verify_ssl,
+                                                  timeout=10)
             metax_api_response.raise_for_status()
         except Exception as e:
             if isinstance(e, requests.HTTPError):
@@ -368,11 +371,11 @@ class MetaxQvainLightAPIService(FlaskService):
         req_url = self.METAX_DELETE_DATASET.format(cr_id)
         headers = {'Accept': 'application/json'}
         try:
-            metax_api_response = requests.delete(req_url,
-                                                 headers=headers,
-                                                 auth=(self.user, self.pw),
-                                                 verify=self.verify_ssl,
-                                                 timeout=10)
+            metax_api_response = self.session.delete(req_url,
+                                                     headers=headers,
+                                                     auth=(self.user, self.pw),
+                                                     verify=self.verify_ssl,
+                                                     timeout=10)
             metax_api_response.raise_for_status()
         except Exception as e:
             if isinstance(e, requests.HTTPError):
@@ -407,12 +410,12 @@ class MetaxQvainLightAPIService(FlaskService):
         }
         headers = {'Accept': 'application/json'}
         try:
-            metax_api_response = requests.post( req_url,
-                                                headers=headers,
-                                                auth=(self.user, self.pw),
-                                                verify=self.verify_ssl,
-                                                params=params,
-                                                timeout=10)
+            metax_api_response = self.session.post(req_url,
+                                                   headers=headers,
+                                                   auth=(self.user, self.pw),
+                                                   verify=self.verify_ssl,
+                                                   params=params,
+                                                   timeout=10)
             metax_api_response.raise_for_status()
         except Exception as e:
             if isinstance(e, requests.HTTPError):
@@ -447,12 +450,12 @@ class MetaxQvainLightAPIService(FlaskService):
         }
         headers = {'Accept': 'application/json'}
         try:
-            metax_api_response = requests.post( req_url,
-                                                headers=headers,
-                                                auth=(self.user, self.pw),
-                                                verify=self.verify_ssl,
-                                                params=params,
-                                                timeout=10)
+            metax_api_response = self.session.post(req_url,
+                                                   headers=headers,
+                                                   auth=(self.user, self.pw),
+                                                   verify=self.verify_ssl,
+                                                   params=params,
+                                                   timeout=10)
             metax_api_response.raise_for_status()
         except Exception as e:
             if isinstance(e, requests.HTTPError):
@@ -487,12 +490,12 @@ class MetaxQvainLightAPIService(FlaskService):
         }
         headers = {'Accept': 'application/json'}
         try:
-            metax_api_response = requests.post( req_url,
-                                                headers=headers,
-                                                auth=(self.user, self.pw),
-                                                verify=self.verify_ssl,
-                                                params=params,
-                                                timeout=10)
+            metax_api_response = self.session.post(req_url,
+                                                   headers=headers,
+                                                   auth=(self.user, self.pw),
+                                                   verify=self.verify_ssl,
+                                                   params=params,
+                                                   timeout=10)
             metax_api_response.raise_for_status()
         except Exception as e:
             if isinstance(e, requests.HTTPError):
@@ -511,15 +514,54 @@ class MetaxQvainLightAPIService(FlaskService):
 
 _metax_api = MetaxQvainLightAPIService(app)
 
+def _invalidate_modified_records(cr_id, metax_response=None):
+    """
+    Drop catalog records modified by a Qvain Light request from Etsin caches.
+
+    The record is invalidated regardless of the outcome, since Metax may have applied a request that
+    failed e.g. due to a timeout. Records created by the request are invalidated as well, since they may
+    have been cached as not found.
+
+    Arguments:
+        cr_id {string} -- The identifier of the modified dataset.
+        metax_response {tuple} -- Response returned by MetaxQvainLightAPIService.
+
+    """
+    invalidate_catalog_record(cr_id)
+    body = metax_response[0] if isinstance(metax_response, tuple) else None
+    if isinstance(body, dict):
+        new_version = body.get('new_version_created')
+        if isinstance(new_version, dict):
+            invalidate_catalog_record(new_version.get('identifier'))
+
 def get_directory(dir_id):
     """
-    Get directory from metax.
+    Get directory from metax, or a prefetched listing from cache when prefetch is enabled.
 
     :param dir_id:
     :return:
     """
+    if app.qvain_dir_prefetcher.ENABLED:
+        dir_obj = app.qvain_dir_cache.pop(dir_id)
+        if dir_obj is not None:
+            return dir_obj
     return _metax_api.get_directory(dir_id)
 
+def prefetch_directory(dir_id):
+    """
+    Fetch directory from metax into cache, unless it is cached already.
+
+    :param dir_id:
+    :return: Size of the fetched listing in bytes, or None if nothing was fetched
+    """
+    if app.qvain_dir_cache.is_cached(dir_id):
+        return None
+    dir_obj = _metax_api.get_directory(dir_id)
+    if not dir_obj:
+        return None
+    app.qvain_dir_cache.update_cache(dir_id, dir_obj)
+    return len(json.dumps(dir_obj))
+
 def get_directory_for_project(project_id):
     """
     Get project root file directory from metax.
@@ -529,6 +571,51 @@ def get_directory_for_project(project_id):
     """
     return _metax_api.get_directory_for_project(project_id)
 
+def get_directory_page(dir_id, offset, limit, item_limit):
+    """
+    Get one page of a directory listing, see paginate_directory_listing.
+
+    The first page is always fetched from metax. If the listing has more pages, it is cached sorted by name,
+    and the following pages are cut from the cached listing while it lasts.
+
+    :param dir_id:
+    :param offset:
+    :param limit:
+    :param item_limit:
+    :return: Listing page, or None if not found
+    """
+    return _get_listing_page('dir_{0}'.format(dir_id), get_directory, dir_id, offset, limit, item_limit)
+
+def get_directory_page_for_project(project_id, offset, limit, item_limit):
+    """
+    Get one page of the project root directory listing, as get_directory_page.
+
+    :param project_id:
+    :param offset:
+    :param limit:
+    :param item_limit:
+    :return: Listing page, or None if not found
+    """
+    return _get_listing_page('project_{0}'.format(project_id), get_directory_for_project, project_id,
+                             offset, limit, item_limit)
+
+def _get_listing_page(listing_id, fetch, identifier, offset, limit, item_limit):
+    if offset:
+        dir_obj = app.qvain_dir_cache.get_sorted_listing(listing_id)
+        if dir_obj is not None:
+            return paginate_directory_listing(dir_obj, offset, limit, item_limit)
+
+    dir_obj = fetch(identifier)
+    if not dir_obj:
+        return dir_obj
+    item_count = len(dir_obj.get('directories') or []) + len(dir_obj.get('files') or [])
+    if (offset is None and limit is None) or item_count <= (offset or 0) + min(limit or item_limit, item_limit):
+        # Nothing to read after this page, so only the items on the page are ordered
+        return paginate_directory_listing(dir_obj, offset, limit, item_limit, is_sorted=False)
+
+    app.qvain_dir_cache.update_sorted_listing(listing_id, sort_directory_listing(dir_obj))
+    return paginate_directory_listing(dir_obj, offset, limit, item_limit)
+
 def get_file(file_identifier):
     """
     Get a specific file with file's id
@@ -568,7 +655,11 @@ def create_dataset(form_data, params=None, use_doi=False):
         [type] -- Metax response.
 
     """
-    return _metax_api.create_dataset(form_data, params, use_doi)
+    response = _metax_api.create_dataset(form_data, params, use_doi)
+    body = response[0]
+    if isinstance(body, dict) and body.get('identifier'):
+        _invalidate_modified_records(body['identifier'], response)
+    return response
 
 def update_dataset(form_data, cr_id, last_modified, params=None):
     """
@@ -584,7 +675,9 @@ def update_dataset(form_data, cr_id, last_modified, params=None):
         [type] -- Metax response.
 
     """
-    return _metax_api.update_dataset(form_data, cr_id, last_modified, params)
+    response = _metax_api.update_dataset(form_data, cr_id, last_modified, params)
+    _invalidate_modified_records(cr_id, response)
+    return response
 
 def get_dataset(cr_id):
     """
@@ -611,7 +704,9 @@ def delete_dataset(cr_id):
         [type] -- Metax response.
 
     """
-    return _metax_api.delete_dataset(cr_id)
+    response = _metax_api.delete_dataset(cr_id)
+    _invalidate_modified_records(cr_id)
+    return response
 
 def change_cumulative_state(cr_id, cumulative_state):
     """
@@ -625,7 +720,9 @@ def change_cumulative_state(cr_id, cumulative_state):
         [type] -- Metax response.
 
     """
-    return _metax_api.change_cumulative_state(cr_id, cumulative_state)
+    response = _metax_api.change_cumulative_state(cr_id, cumulative_state)
+    _invalidate_modified_records(cr_id, response)
+    return response
 
 def refresh_directory_content(cr_identifier, dir_identifier):
     """
@@ -639,7 +736,9 @@ def refresh_directory_content(cr_identifier, dir_identifier):
         [type] -- Metax response.
 
     """
-    return _metax_api.refresh_directory_content(cr_identifier, dir_identifier)
+    response = _metax_api.refresh_directory_content(cr_identifier, dir_identifier)
+    _invalidate_modified_records(cr_identifier, response)
+    return response
 
 def fix_deprecated_dataset(cr_id):
     """
@@ -652,4 +751,6 @@ def fix_deprecated_dataset(cr_id):
         [type] -- Metax response.
 
     """
-    return _metax_api.fix_deprecated_dataset(cr_id)
+    response = _metax_api.fix_deprecated_dataset(cr_id)
+    _invalidate_modified_records(cr_id, response)
+    return response
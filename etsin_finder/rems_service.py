@@ -7,28 +7,35 @@
 
 """Used for performing operations related to Fairdata Rems"""
 
-from requests import request, HTTPError
+from urllib.parse import quote
+
+from requests import HTTPError
 from flask import session
-from datetime import datetime
 
 from etsin_finder.cr_service import get_catalog_record_preferred_identifier, get_catalog_record, is_rems_catalog_record
 from etsin_finder.app_config import get_fairdata_rems_api_config
+from etsin_finder.http_pool import get_pooled_session
 from etsin_finder.utils import json_or_empty, FlaskService
 from etsin_finder.finder import app
 
 log = app.logger
 class RemsAPIService(FlaskService):
-    """Rems Service"""
+    """
+    Rems Service
+
+    A single instance is shared by all requests of a worker, so the identity of the user is given
+    to each call instead of being stored in the service.
+    """
 
-    def __init__(self, app, user):
+    def __init__(self, app):
         """Setup Rems API Service"""
         super().__init__(app)
 
         rems_api_config = get_fairdata_rems_api_config(app.testing)
+        self.CONFIGURED = rems_api_config is not None
 
         if rems_api_config:
             self.ENABLED = rems_api_config.get('ENABLED', False)
-            self.USER_ID = user
             self.API_KEY = str(rems_api_config.get('API_KEY'))
             self.HOST = rems_api_config.get('HOST')
             self.HEADERS = {
@@ -36,12 +43,13 @@ class RemsAPIService(FlaskService):
                 'x-rems-api-key': self.API_KEY,
                 'x-rems-user-id': 'RDowner@funet.fi'
             }
-            self.REMS_URL = 'https://{0}'.format(self.HOST) + '/api/entitlements?resource={0}'
             self.REMS_ENTITLEMENTS = 'https://{0}'.format(self.HOST) + '/api/entitlements'
+            self.REMS_USER_ENTITLEMENTS = 'https://{0}'.format(self.HOST) + '/api/entitlements?user={0}'
             self.REMS_CREATE_USER = 'https://{0}'.format(self.HOST) + '/api/users/create'
             self.REMS_GET_MY_APPLICATIONS = 'https://{0}'.format(self.HOST) + '/api/my-applications/'
             self.REMS_CATALOGUE_ITEMS = 'https://{0}'.format(self.HOST) + '/api/catalogue-items?resource={0}'
             self.REMS_CREATE_APPLICATION = 'https://{0}'.format(self.HOST) + '/api/applications/create'
+            self.session = get_pooled_session(self.HOST, self.is_testing)
         elif self.is_testing:
             self.ENABLED = False
         else:
@@ -66,14 +74,15 @@ class RemsAPIService(FlaskService):
         if not self.ENABLED:
             return False
 
-        self.HEADERS['x-rems-user-id'] = user_id
+        headers = dict(self.HEADERS)
+        headers['x-rems-user-id'] = user_id
         assert method in ['GET', 'POST'], 'Method attribute must be one of [GET, POST].'
         log.info('Sending {0} request to {1}'.format(method, url))
         try:
             if json:
-                rems_api_response = request(method=method, headers=self.HEADERS, url=url, json=json, verify=False, timeout=3)
+                rems_api_response = self.session.request(method=method, headers=headers, url=url, json=json, verify=False, timeout=3)
             else:
-                rems_api_response = request(method=method, headers=self.HEADERS, url=url, verify=False, timeout=3)
+                rems_api_response = self.session.request(method=method, headers=headers, url=url, verify=False, timeout=3)
             rems_api_response.raise_for_status()
         except Exception as e:
             log.warning(err_message)
@@ -86,9 +95,12 @@ class RemsAPIService(FlaskService):
         log.info('rems_api_response: {0}'.format(rems_api_response.json()))
         return rems_api_response.json()
 
-    def get_user_applications(self):
+    def get_user_applications(self, user_id):
         """Get all applications which the current user can see
 
+        Arguments:
+            user_id [string] -- The user id
+
         Returns:
             [list] -- List of application dicts
 
@@ -100,13 +112,14 @@ class RemsAPIService(FlaskService):
         method = 'GET'
         url = self.REMS_GET_MY_APPLICATIONS
         err_message = 'Failed to get applications from Fairdata REMS'
-        return self.rems_request(method, url, err_message, user_id=self.USER_ID)
+        return self.rems_request(method, url, err_message, user_id=user_id)
 
-    def create_application(self, id):
+    def create_application(self, id, user_id):
         """Creates application in REMS
 
         Arguments:
             id [int] -- Catalogue item id
+            user_id [string] -- The user id
 
         Returns:
             [dict] -- Dict with info if the operation was successful
@@ -122,7 +135,7 @@ class RemsAPIService(FlaskService):
         url = self.REMS_CREATE_APPLICATION
         err_message = 'Failed to create application'
         json = {'catalogue-item-ids': [id]}
-        return self.rems_request(method, url, err_message, json=json, user_id=self.USER_ID)
+        return self.rems_request(method, url, err_message, json=json, user_id=user_id)
 
     def get_catalogue_item_for_resource(self, resource):
         """Get catalogue item for resource from REMS
@@ -167,8 +180,11 @@ class RemsAPIService(FlaskService):
         json = userdata
         return self.rems_request(method, url, err_message, json=json)
 
-    def entitlements(self):
-        """Get all approved catalog records.
+    def entitlements(self, user_id):
+        """Get all approved catalog records of the user.
+
+        Arguments:
+            user_id [string] -- The user id
 
         Returns:
             [list] -- List of dicts with entitlements.
@@ -177,37 +193,31 @@ class RemsAPIService(FlaskService):
         if not self.ENABLED:
             return False
 
-        log.info('Get all approved catalog records')
+        log.info('Get all approved catalog records of the user')
         method = 'GET'
-        url = self.REMS_ENTITLEMENTS
-        err_message = 'Failed to get entitlement data from Fairdata REMS for user_id: {0}'.format(self.USER_ID)
+        url = self.REMS_USER_ENTITLEMENTS.format(quote(user_id, safe=''))
+        err_message = 'Failed to get entitlement data from Fairdata REMS for user_id: {0}'.format(user_id)
         return self.rems_request(method, url, err_message)
 
-    def get_rems_permission(self, rems_resource):
-        """Check if user is entitled for a REMS resource.
 
-        Arguments:
-            rems_resource [string] -- The resource
+_rems_api = RemsAPIService(app)
 
-        Returns:
-            [boolean] -- True/False if user is entitled.
 
-        """
-        if not self.ENABLED:
-            return False
+def get_rems_api():
+    """Get the Rems API Service shared by the requests of this worker.
 
-        assert rems_resource, 'rems_resource should be string, rems_resource: {0}'.format(rems_resource)
+    Returns:
+        [RemsAPIService] -- The service.
 
-        log.info('Get entitlements for resource: {0}'.format(rems_resource))
-        method = 'GET'
-        url = self.REMS_URL.format(rems_resource)
-        err_message = 'Failed to get entitlement data from Fairdata REMS for user_id: {0}, resource: {1}'.format(self.USER_ID, rems_resource)
-        return len(self.rems_request(method, url, err_message)) > 0
+    """
+    return _rems_api
 
 
 def get_application_state_for_resource(cr, user_id):
     """Get the state of the users applications for resource.
 
+    The id of the application is set to the session, so that REMSApplyForPermission can use it.
+
     Arguments:
         cr [dict] -- Catalog record
         user_id [string] -- The user id
@@ -216,50 +226,157 @@ def get_application_state_for_resource(cr, user_id):
         [string] -- The application state or False.
 
     """
-    _rems_api = RemsAPIService(app, user_id)
+    state, application_id = get_application_for_resource(cr, user_id)
+    set_session_application_id(state, application_id)
+    return state
+
+
+def set_session_application_id(state, application_id):
+    """Set the id of the users application for a resource to the session.
+
+    The id is set only when the application state could be resolved. Must be called in the request thread.
+
+    Arguments:
+        state [string] -- The application state or False, from get_application_for_resource
+        application_id [int] -- The application id or None, from get_application_for_resource
+
+    """
+    if state not in (False, 'disabled'):
+        # Set the application id to the session so it can be used directly
+        # by REMSApplyForPermission if the users has already created applications
+        session['REMS_application_id'] = application_id
+
+
+def get_application_for_resource(cr, user_id):
+    """Get the state and id of the users newest application for resource.
+
+    The session is not touched, so this can be called outside the request thread.
+
+    Arguments:
+        cr [dict] -- Catalog record
+        user_id [string] -- The user id
+
+    Returns:
+        [tuple] -- The application state or False, and the application id or None.
+
+    """
     if _rems_api.ENABLED:
         state = 'apply'
     else:
-        return 'disabled'
+        return 'disabled', None
     if not user_id or not cr:
         log.error('Failed to get user application state')
-        return False
+        return False, None
 
     pref_id = get_catalog_record_preferred_identifier(cr)
     if not pref_id:
         log.error('Could not get preferred identifier.')
-        return False
+        return False, None
 
-    user_applications = _rems_api.get_user_applications()
-    if not isinstance(user_applications, list) or not user_applications:
+    application_index = get_user_application_index(user_id)
+    if not application_index:
         log.warning('Could not get any applications belonging to user.')
-        return False
-    log.info('Got {0} applications for the user.'.format(len(user_applications)))
+        return False, None
+    log.info('Got applications for {0} resources for the user.'.format(len(application_index)))
+
+    application = application_index.get(pref_id)
+    if application:
+        return application.get('state').split('/')[1], application.get('id')
+    # No application for the resource is found
+    return state, None
+
+
+def get_user_application_index(user_id):
+    """Get the newest application of the user for each resource.
+
+    The index is cached for a short while, since it is needed on every view of a permit dataset.
 
-    # Sort applications to get the newest first
-    user_applications.sort(reverse=True, key=lambda x: datetime.strptime(x['application/last-activity'], '%Y-%m-%dT%H:%M:%S.%fZ'))
+    Arguments:
+        user_id [string] -- The user id
+
+    Returns:
+        [dict] -- Dict from resource ext-id to dict with application id and state, or None on error.
+
+    """
+    application_index = app.rems_cache.get_applications(user_id)
+    if application_index is not None:
+        return application_index
 
+    user_applications = _rems_api.get_user_applications(user_id)
+    if not isinstance(user_applications, list):
+        return None
+
+    # Timestamps are in the same ISO 8601 format, so they can be compared as strings
+    newest = {}
     for application in user_applications:
-        resources = application.get('application/resources')
-        for resource in resources:
-            if resource.get('resource/ext-id') == pref_id:
-                state = application.get('application/state').split('/')[1]
-                # Set the application id to the session so it can be used directly
-                # by REMSApplyForPermission if the users has already created applications
-                session['REMS_application_id'] = application.get('application/id')
-                return state
-    # Set the value to None if no application for the resource is found
-    session['REMS_application_id'] = None
-    return state
+        last_activity = application.get('application/last-activity', '')
+        for resource in application.get('application/resources', []):
+            ext_id = resource.get('resource/ext-id')
+            if ext_id not in newest or last_activity > newest[ext_id][0]:
+                newest[ext_id] = (last_activity, application)
+
+    application_index = {ext_id: {'id': application.get('application/id'), 'state': application.get('application/state')}
+                         for ext_id, (last_activity, application) in newest.items()}
+    return app.rems_cache.update_applications(user_id, application_index)
+
+
+def create_user(userdata):
+    """Create user in REMS, unless the user has already been created with the same data.
 
+    Arguments:
+        userdata [dict] -- Dict with name, user_id and email.
+
+    Returns:
+        [dict] -- Information if the creation succeeded.
+
+    """
+    if app.rems_cache.is_user_created(userdata):
+        return {'success': True}
+    res = _rems_api.create_user(userdata)
+    if isinstance(res, dict) and res.get('success', None):
+        app.rems_cache.update_user_created(userdata)
+    return res
+
+
+def get_catalogue_item_for_resource(resource):
+    """Get catalogue item for resource, from cache if available.
+
+    Arguments:
+        resource [string] -- The REMS identifier of the resource
+
+    Returns:
+        [list] -- List containing dict of catalogue item
 
-def get_user_rems_permission_for_catalog_record(cr_id, user_id):
+    """
+    catalogue_items = app.rems_cache.get_catalogue_items(resource)
+    if catalogue_items is not None:
+        return catalogue_items
+    res = _rems_api.get_catalogue_item_for_resource(resource)
+    if isinstance(res, list) and res and res[0].get('id', None):
+        app.rems_cache.update_catalogue_items(resource, res)
+    return res
+
+
+def invalidate_user_applications(user_id):
+    """Drop cached applications of the user after they have changed.
+
+    Arguments:
+        user_id [string] -- The user id
+
+    """
+    app.rems_cache.delete_applications(user_id)
+
+
+def get_user_rems_permission_for_catalog_record(cr_id, user_id, cr=None):
     """Get info about whether user is entitled for a catalog record.
 
     Arguments:
         cr_id [string] -- The catalog record identifier.
         user_id [string] -- The user id.
 
+    Keyword Arguments:
+        cr [dict] -- The catalog record, fetched if not given (default: {None})
+
     Returns:
         [boolean] -- Returns True/False if user is entitled.
 
@@ -268,13 +385,47 @@ def get_user_rems_permission_for_catalog_record(cr_id, user_id):
         log.error('Failed to get rems permission for catalog record. user_id: {0} or cr_id: {1} is invalid'.format(user_id, cr_id))
         return False
 
-    cr = get_catalog_record(cr_id, False, False)
+    if cr is None:
+        cr = get_catalog_record(cr_id, False, False, file_details=False)
     if cr and is_rems_catalog_record(cr):
         pref_id = get_catalog_record_preferred_identifier(cr)
         if not pref_id:
             log.error('Could not get cr_id: {0} preferred identifier.'.format(cr_id))
             return False
-        _rems_api = RemsAPIService(app, user_id)
-        return _rems_api.get_rems_permission(pref_id)
+        return pref_id in get_user_entitled_resources(user_id)
     log.warning('Invalid catalog record or not a REMS catalog record. cr_id: {0}'.format(cr_id))
     return False
+
+
+def get_user_entitled_resources(user_id):
+    """Get the resources the user is entitled to.
+
+    All entitlements of the user are fetched from REMS at once and cached, so that checking
+    entitlements for several catalog records needs only one request.
+
+    Arguments:
+        user_id [string] -- The user id.
+
+    Returns:
+        [set] -- Preferred identifiers of the entitled resources.
+
+    """
+    resources = app.rems_cache.get_entitlements(user_id)
+    if resources is not None:
+        return resources
+
+    if not _rems_api.ENABLED:
+        return set()
+    entitlements = _rems_api.entitlements(user_id)
+    if not isinstance(entitlements, list):
+        log.warning('Could not get entitlements of user: {0}'.format(user_id))
+        return set()
+
+    resources = set()
+    for entitlement in entitlements:
+        user = entitlement.get('user', {}).get('userid', entitlement.get('userid'))
+        if user is not None and user != user_id:
+            continue
+        resources.add(entitlement.get('resource'))
+    resources.discard(None)
+    return app.rems_cache.update_entitlements(user_id, resources)
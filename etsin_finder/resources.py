@@ -7,16 +7,19 @@
 
 """RESTful API endpoints, meant to be used by the frontend"""
 
-from functools import wraps
+from functools import lru_cache, wraps
+import gzip
 import logging
-from flask import request, session
+from flask import request, session, Response
 from flask_mail import Message
-from flask_restful import abort, reqparse, Resource
+from flask_restful import abort, inputs, reqparse, Resource
+from flask_restful.representations.json import output_json
 
 from etsin_finder.app_config import get_app_config
 from etsin_finder import authentication
 from etsin_finder import authorization
 from etsin_finder import cr_service
+from etsin_finder.concurrency import fan_out
 from etsin_finder.download_service import download_data
 from etsin_finder.email_utils import \
     create_email_message_body, \
@@ -26,14 +29,16 @@ from etsin_finder.email_utils import \
     get_harvest_info, \
     validate_send_message_request
 from etsin_finder.finder import app
+from etsin_finder.path_index import search_path_index
+from etsin_finder.stripping import compile_projection
 from etsin_finder.utils import \
-    sort_array_of_obj_by_key, \
-    slice_array_on_limit
+    paginate_directory_listing, \
+    sort_array_of_obj_by_key
 from etsin_finder import rems_service
-from etsin_finder.rems_service import RemsAPIService
-from etsin_finder.app_config import get_fairdata_rems_api_config
 
 TOTAL_ITEM_LIMIT = 1000
+# Seconds to wait for concurrent upstream calls made by an endpoint
+UPSTREAM_TIMEOUT = 15
 log = app.logger
 
 def log_request(f):
@@ -63,37 +68,213 @@ def log_request(f):
         return f(*args, **kwargs)
     return func
 
+def _get_cached_view(cr_id, view_key, is_authd):
+    """
+    Get cached response of a view of a catalog record that is the same for all users in the same authentication state.
+
+    The cached body is sent gzip compressed as is to clients accepting gzip. Views of catalog records known
+    not to be cached are not looked up.
+
+    :param cr_id:
+    :param view_key: json serializable key identifying the view, including the authentication state
+    :param is_authd: Is the user authenticated
+    :return: Tuple of the response, or None if not cached, and the generation to cache the response with,
+        or None if the view is not to be cached
+    """
+    if app.response_cache.is_uncacheable(cr_id, is_authd):
+        return None, None
+    generation = app.response_cache.get_generation(cr_id)
+    entry = app.response_cache.get_from_cache(cr_id, generation, view_key)
+    if not entry:
+        return None, generation
+
+    body = entry['body']
+    response = Response(status=200, mimetype='application/json')
+    if entry['gzip']:
+        if 'gzip' in request.accept_encodings:
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            body = gzip.decompress(body)
+    response.set_data(body)
+    response.vary.add('Accept-Encoding')
+    return response, generation
+
+def _cache_view(cr_id, generation, view_key, data, cr, is_authd, file_details=True):
+    """
+    Cache response of a view of a catalog record, serialized the same way as flask_restful serializes it.
+
+    The view is cached only if it is the same for all users in the same authentication state, and only until
+    the catalog record it was built from becomes stale.
+
+    :param cr_id:
+    :param generation: Generation returned by _get_cached_view
+    :param view_key:
+    :param data: Response data
+    :param cr: Catalog record the view was built from
+    :param is_authd: Is the user authenticated
+    :param file_details: Was the catalog record got with file details
+    :return:
+    """
+    if not authorization.is_view_public(cr, is_authd):
+        app.response_cache.mark_uncacheable(cr_id, is_authd)
+        return
+    if generation is None:
+        return
+    ttl = cr_service.get_remaining_soft_ttl(cr_id, file_details)
+    app.response_cache.update_cache(cr_id, generation, view_key, output_json(data, 200).get_data(), ttl)
+
+# Fields of a catalog record that need the record to be fetched with file_details
+FILE_DETAILS_FIELDS = ('research_dataset.files', 'research_dataset.directories')
+
+def _parse_fields(fields):
+    """
+    Parse comma separated list of dot separated paths.
+
+    :param fields:
+    :return: Sorted list of unique paths, or None if no fields were given
+    """
+    if not fields:
+        return None
+    return sorted(set(field.strip() for field in fields.split(',') if field.strip())) or None
+
+def _includes_section(fields, section):
+    """
+    Do the fields of a catalog record include any part of a section.
+
+    :param fields: Paths, or None for all fields
+    :param section: Dot separated path of the section
+    :return:
+    """
+    if fields is None:
+        return True
+    return any(
+        section.startswith(field + '.') or field == section or field.startswith(section + '.') for field in fields
+    )
+
+def _needs_file_details(fields):
+    """
+    Do the fields of a catalog record include details of its files or directories.
+
+    :param fields: Paths, or None for all fields
+    :return:
+    """
+    return any(_includes_section(fields, section) for section in FILE_DETAILS_FIELDS)
+
+@lru_cache(maxsize=128)
+def _get_projection(fields):
+    return compile_projection(fields)
+
 class Dataset(Resource):
     """Dataset related REST endpoints for frontend"""
 
+    def __init__(self):
+        """Setup dataset endpoints"""
+        self.parser = reqparse.RequestParser()
+        self.parser.add_argument('fields', required=False, type=str, location='args')
+
     @log_request
     def get(self, cr_id):
         """
         Get dataset from metax and strip it from having sensitive information
 
+        With fields, only the given comma separated, dot separated paths of the catalog record are returned,
+        e.g. fields=identifier,research_dataset.title. When the fields do not include the file or directory
+        sections, the record is fetched without file details. The sections are available in pages from
+        DatasetFiles.
+
         :param cr_id: id to use to fetch the record from metax
         :return:
         """
+        fields = _parse_fields(self.parser.parse_args().get('fields'))
         is_authd = authentication.is_authenticated()
-        cr = cr_service.get_catalog_record(cr_id, True, True)
+        view_key = ['dataset', is_authd, fields]
+        response, generation = _get_cached_view(cr_id, view_key, is_authd)
+        if response is not None:
+            return response
+
+        file_details = _needs_file_details(fields)
+        cr = cr_service.get_catalog_record(cr_id, True, False, file_details)
         if not cr:
             abort(400, message="Unable to get catalog record from Metax")
 
-        # Sort data items
-        sort_array_of_obj_by_key(cr.get('research_dataset', {}).get('remote_resources', []), 'title')
-        sort_array_of_obj_by_key(cr.get('research_dataset', {}).get('directories', []), 'details', 'directory_name')
-        sort_array_of_obj_by_key(cr.get('research_dataset', {}).get('files', []), 'details', 'file_name')
-
-        ret_obj = {'catalog_record': authorization.strip_information_from_catalog_record(cr, is_authd),
-                   'email_info': get_email_info(cr)}
-        if cr_service.is_rems_catalog_record(cr) and is_authd and get_fairdata_rems_api_config(app.testing) is not None:
-            state = rems_service.get_application_state_for_resource(cr, authentication.get_user_id())
+        # Sort data items that are included in the response
+        if _includes_section(fields, 'research_dataset.remote_resources'):
+            sort_array_of_obj_by_key(cr.get('research_dataset', {}).get('remote_resources', []), 'title')
+        if _includes_section(fields, 'research_dataset.directories'):
+            sort_array_of_obj_by_key(cr.get('research_dataset', {}).get('directories', []), 'details', 'directory_name')
+        if _includes_section(fields, 'research_dataset.files'):
+            sort_array_of_obj_by_key(cr.get('research_dataset', {}).get('files', []), 'details', 'file_name')
+
+        calls = [(authorization.strip_information_from_catalog_record, cr, is_authd)]
+        is_rems_applicable = cr_service.is_rems_catalog_record(cr) and is_authd and rems_service.get_rems_api().CONFIGURED
+        if is_rems_applicable:
+            calls.append((rems_service.get_application_for_resource, cr, authentication.get_user_id()))
+
+        # Application state is fetched from REMS while the record is being stripped
+        results = fan_out(calls, UPSTREAM_TIMEOUT)
+        if results[0] is None:
+            abort(500, message="Unable to check access to catalog record")
+
+        catalog_record = _get_projection(tuple(fields))(results[0]) if fields else results[0]
+        ret_obj = {'catalog_record': catalog_record, 'email_info': get_email_info(cr)}
+        if is_rems_applicable:
+            # The session can only be changed in the request thread
+            state, application_id = results[1] or (False, None)
+            rems_service.set_session_application_id(state, application_id)
             ret_obj['application_state'] = state
             ret_obj['has_permit'] = state == 'approved'
+            app.response_cache.mark_uncacheable(cr_id, is_authd)
+        else:
+            _cache_view(cr_id, generation, view_key, ret_obj, cr, is_authd, file_details)
 
         return ret_obj, 200
 
 
+class DatasetFiles(Resource):
+    """Paginated file and directory sections of a dataset for frontend"""
+
+    def __init__(self):
+        """Setup dataset file endpoints"""
+        self.parser = reqparse.RequestParser()
+        self.parser.add_argument('offset', required=False, type=inputs.natural, location='args')
+        self.parser.add_argument('limit', required=False, type=inputs.positive, location='args')
+
+    @log_request
+    def get(self, cr_id):
+        """
+        Get research_dataset files and directories of a dataset, stripped as in Dataset.
+
+        Directories and files are ordered by name and paged as one sequence, see paginate_directory_listing.
+        Sections the user may not see are neither returned nor counted.
+
+        :param cr_id:
+        :return:
+        """
+        args = self.parser.parse_args()
+        offset, limit = args.get('offset'), args.get('limit')
+        cr = cr_service.get_catalog_record(cr_id, True, False)
+        if not cr:
+            abort(400, message="Unable to get catalog record from Metax")
+
+        research_dataset = cr.get('research_dataset', {})
+        sections = {section: research_dataset.get(section) or [] for section in ('directories', 'files')}
+        page = paginate_directory_listing(dict(sections), offset, limit, TOTAL_ITEM_LIMIT, False, 'details')
+
+        # Only the items on the page are stripped
+        page_cr = dict(cr, research_dataset=dict(research_dataset, directories=page['directories'], files=page['files']))
+        stripped = authorization.strip_information_from_catalog_record(page_cr, authentication.is_authenticated())
+        stripped_research_dataset = stripped.get('research_dataset', {})
+        if any(section not in stripped_research_dataset for section in sections):
+            visible = {section: items if section in stripped_research_dataset else [] for section, items in sections.items()}
+            page['pagination'] = paginate_directory_listing(
+                visible, offset, limit, TOTAL_ITEM_LIMIT, False, 'details')['pagination']
+        return {
+            'directories': stripped_research_dataset.get('directories', []),
+            'files': stripped_research_dataset.get('files', []),
+            'pagination': page['pagination']
+        }, 200
+
+
 class Files(Resource):
     """File/directory related REST endpoints for frontend"""
 
@@ -103,12 +284,16 @@ class Files(Resource):
         self.parser.add_argument('dir_id', required=True, type=str)
         self.parser.add_argument('file_fields', required=False, type=str)
         self.parser.add_argument('directory_fields', required=False, type=str)
+        self.parser.add_argument('offset', required=False, type=inputs.natural)
+        self.parser.add_argument('limit', required=False, type=inputs.positive)
 
     @log_request
     def get(self, cr_id):
         """
         Get files and directory objects for frontend.
 
+        Directories and files are paged as one sequence with offset and limit, see paginate_directory_listing.
+
         :param cr_id:
         :return:
         """
@@ -116,26 +301,74 @@ class Files(Resource):
         dir_id = args['dir_id']
         file_fields = args.get('file_fields', None)
         directory_fields = args.get('directory_fields', None)
+        offset = args.get('offset', None)
+        limit = args.get('limit', None)
+        is_authd = authentication.is_authenticated()
+        view_key = ['files', dir_id, file_fields, directory_fields, offset, limit, is_authd]
+        response, generation = _get_cached_view(cr_id, view_key, is_authd)
+        if response is not None:
+            return response
 
-        cr = cr_service.get_catalog_record(cr_id, False, False)
-        dir_api_obj = cr_service.get_directory_data_for_catalog_record(cr_id, dir_id, file_fields, directory_fields)
+        cr, dir_api_obj = fan_out([
+            (cr_service.get_catalog_record, cr_id, False, False, False),
+            (cr_service.get_directory_data_for_catalog_record, cr_id, dir_id, file_fields, directory_fields)
+        ], UPSTREAM_TIMEOUT)
 
         if cr and dir_api_obj:
-            # Sort the items
-            sort_array_of_obj_by_key(dir_api_obj.get('directories', []), 'directory_name')
-            sort_array_of_obj_by_key(dir_api_obj.get('files', []), 'file_name')
-
-            # Limit the amount of items to be sent to the frontend
-            if 'directories' in dir_api_obj:
-                dir_api_obj['directories'] = slice_array_on_limit(dir_api_obj['directories'], TOTAL_ITEM_LIMIT)
-            if 'files' in dir_api_obj:
-                dir_api_obj['files'] = slice_array_on_limit(dir_api_obj['files'], TOTAL_ITEM_LIMIT)
+            # The listing is cached sorted, so only the requested page is cut out of it
+            paginate_directory_listing(dir_api_obj, offset, limit, TOTAL_ITEM_LIMIT)
 
             # Strip the items of sensitive data
-            authorization.strip_dir_api_object(dir_api_obj, authentication.is_authenticated(), cr)
+            authorization.strip_dir_api_object(dir_api_obj, is_authd, cr)
+            _cache_view(cr_id, generation, view_key, dir_api_obj, cr, is_authd, False)
+
+            # Subdirectories the user is likely to open next are fetched into cache in the background
+            app.dir_prefetcher.prefetch(
+                lambda child_id: cr_service.prefetch_directory_data_for_catalog_record(
+                    cr_id, child_id, file_fields, directory_fields),
+                [directory['identifier'] for directory in dir_api_obj.get('directories', [])
+                 if directory.get('identifier')])
             return dir_api_obj, 200
         return '', 404
 
+class FileSearch(Resource):
+    """File/directory name search REST endpoint for frontend"""
+
+    def __init__(self):
+        """Setup file search endpoint"""
+        self.parser = reqparse.RequestParser()
+        self.parser.add_argument('q', required=True, type=str, location='args', help='q cannot be empty')
+        self.parser.add_argument('match', required=False, type=str, location='args', choices=('prefix', 'substring'),
+                                 default='substring')
+        self.parser.add_argument('offset', required=False, type=inputs.natural, location='args')
+        self.parser.add_argument('limit', required=False, type=inputs.positive, location='args')
+
+    @log_request
+    def get(self, cr_id):
+        """
+        Search files and directories of a dataset by name.
+
+        Matching directories and files are returned sorted by name and paged like directory listings, see
+        paginate_directory_listing.
+
+        :param cr_id:
+        :return:
+        """
+        args = self.parser.parse_args()
+        if not args['q']:
+            abort(400, message='q cannot be empty')
+
+        cr, index = fan_out([
+            (cr_service.get_catalog_record, cr_id, False, False, False),
+            (cr_service.get_path_index, cr_id)
+        ], UPSTREAM_TIMEOUT)
+        if not cr or index is None:
+            return '', 404
+
+        result = search_path_index(index, args['q'], args['match'] == 'prefix')
+        paginate_directory_listing(result, args.get('offset'), args.get('limit'), TOTAL_ITEM_LIMIT)
+        return authorization.strip_dir_api_object(result, authentication.is_authenticated(), cr), 200
+
 class Contact(Resource):
     """Contact form related REST endpoints for frontend"""
 
@@ -180,7 +413,7 @@ class Contact(Resource):
             abort(400, message=message)
 
         # Get the full catalog record from Metax
-        cr = cr_service.get_catalog_record(cr_id, False, False)
+        cr = cr_service.get_catalog_record(cr_id, False, False, file_details=False)
 
         # Ensure dataset is not harvested
         harvested = get_harvest_info(cr)
@@ -265,31 +498,29 @@ class REMSApplyForPermission(Resource):
 
         if not user_id and not firstname and not lastname and not email:
             return 'Unauthorized request', 401
-        _rems_api = RemsAPIService(app, user_id)
+        _rems_api = rems_service.get_rems_api()
         userdata = {
             'userid': user_id,
             'name': "{0} {1}".format(firstname, lastname),
             'email': email
         }
-        res_create_user = _rems_api.create_user(userdata)
+        # User is created in REMS while the catalogue item of the resource is looked up
+        res_create_user, catalogue_item = fan_out([
+            (rems_service.create_user, userdata),
+            (self._get_catalogue_item, cr_id)
+        ], UPSTREAM_TIMEOUT)
         log.debug('res_create_user: {0}'.format(res_create_user))
 
-        if not res_create_user or not res_create_user.get('success', None):
+        if not isinstance(res_create_user, dict) or not res_create_user.get('success', None):
             log.error('Could not create user, res: {}'.format(res_create_user))
             return 'Could not create user', 500
 
-        # Get catalog item id
-        cr = cr_service.get_catalog_record(cr_id, False, False)
-        if cr and cr_service.is_rems_catalog_record(cr):
-            pref_id = cr_service.get_catalog_record_preferred_identifier(cr)
-            rems_identifier = cr_service.get_catalog_record_REMS_identifier(cr)
-
+        pref_id, rems_identifier, res_get_catalogue_item = catalogue_item or (None, None, None)
         log.info('Get catalog item id for resource: {0}'.format(pref_id))
         log.info('rems_identifier: {0}'.format(rems_identifier))
         if not rems_identifier:
             log.warning('No rems_identifier found for resource: {0}'.format(pref_id))
             return 'No rems_identifier found for resource', 500
-        res_get_catalogue_item = _rems_api.get_catalogue_item_for_resource(rems_identifier)
         log.debug('res_get_catalogue_item: {0}'.format(res_get_catalogue_item))
 
         if not res_get_catalogue_item:
@@ -313,7 +544,7 @@ class REMSApplyForPermission(Resource):
         else:
             # Create Application
             log.info('No application id in session, creating new application for resource: {0}'.format(pref_id))
-            res_create_application = _rems_api.create_application(catalog_item_id)
+            res_create_application = _rems_api.create_application(catalog_item_id, user_id)
             if not res_create_application.get('success', None):
                 if res_create_application.get('errers', None) is None:
                     log.error('Error in creating application for resource: {0}'.format(pref_id))
@@ -327,9 +558,30 @@ class REMSApplyForPermission(Resource):
                 log.error('Failed to get application_id')
                 return 'Failed to get application_id', 500
             log.info('Created application for user with application-id: {0}'.format(application_id))
+            rems_service.invalidate_user_applications(user_id)
 
             return application_id, 200
 
+    @staticmethod
+    def _get_catalogue_item(cr_id):
+        """Get catalogue item for the REMS resource of a catalog record.
+
+        Arguments:
+            cr_id [string] -- Catalog record identifier
+
+        Returns:
+            [tuple] -- Preferred identifier, REMS identifier and catalogue item response.
+
+        """
+        pref_id = rems_identifier = res_get_catalogue_item = None
+        cr = cr_service.get_catalog_record(cr_id, False, False, file_details=False)
+        if cr and cr_service.is_rems_catalog_record(cr):
+            pref_id = cr_service.get_catalog_record_preferred_identifier(cr)
+            rems_identifier = cr_service.get_catalog_record_REMS_identifier(cr)
+        if rems_identifier:
+            res_get_catalogue_item = rems_service.get_catalogue_item_for_resource(rems_identifier)
+        return pref_id, rems_identifier, res_get_catalogue_item
+
 
 class Session(Resource):
     """Session related endpoints"""
@@ -378,7 +630,7 @@ class Download(Resource):
         args = self.parser.parse_args()
         cr_id = args['cr_id']
 
-        cr = cr_service.get_catalog_record(cr_id, False, False)
+        cr = cr_service.get_catalog_record(cr_id, False, False, file_details=False)
         if not cr:
             abort(400, message="Unable to get catalog record")
 
@@ -0,0 +1,84 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2020 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""Opt-in periodic logging of the per-worker cache statistics"""
+
+import json
+import os
+import threading
+import time
+
+from etsin_finder.app_config import get_stats_log_config
+from etsin_finder.concurrency import spawn_background
+from etsin_finder.metrics import metrics
+from etsin_finder.utils import FlaskService
+
+# Prefixes of the counters reported with the statistics of their cache or prefetcher
+_REPORTED_PREFIXES = ('cache.', 'prefetch.')
+
+
+class StatsReporter(FlaskService):
+    """
+    Log the statistics of the caches and prefetchers of a worker every INTERVAL seconds.
+
+    Counters are kept per worker process, see metrics, so each worker logs its own statistics. The logging
+    loop is started by the first request a worker serves, as workers may be forked after the app is created.
+    """
+
+    def __init__(self, app, caches, prefetchers=()):
+        """
+        Setup stats reporter.
+
+        :param app:
+        :param caches: Caches whose statistics are logged
+        :param prefetchers: Prefetchers whose statistics, including the prefetch hit rate, are logged
+        """
+        super().__init__(app)
+        config = get_stats_log_config(self.is_testing)
+        self.ENABLED = config is not None
+        self.interval = config['INTERVAL'] if config else None
+        self.app = app
+        self.caches = caches
+        self.prefetchers = prefetchers
+        self._lock = threading.Lock()
+        self._started_pid = None
+
+    def ensure_started(self):
+        """Start logging in this worker, unless already started."""
+        if not self.ENABLED:
+            return
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+        spawn_background(self._run)
+
+    def collect(self):
+        """
+        Get the statistics of this worker.
+
+        :return: dict with the statistics of each cache in 'caches', of each prefetcher in 'prefetch' and the
+            other counters in 'counters'
+        """
+        return {
+            'caches': {cache.CACHE_NAME: cache.get_stats() for cache in self.caches},
+            'prefetch': {prefetcher.name: prefetcher.get_stats() for prefetcher in self.prefetchers},
+            'counters': {name: value for name, value in metrics.snapshot().items()
+                         if not name.startswith(_REPORTED_PREFIXES)}
+        }
+
+    def report(self):
+        """Log the statistics of this worker."""
+        self.app.logger.info('Stats of worker {0}: {1}'.format(os.getpid(), json.dumps(self.collect(), sort_keys=True)))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.report()
+            except Exception as e:
+                self.app.logger.error('Logging stats failed\n{0}'.format(e))
@@ -0,0 +1,170 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2020 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""
+Compiled single-pass stripping of json objects.
+
+A Rule describes which keys are kept in the dicts at a position of a json object. Rules are compiled once
+into a plan, a function that applies the rules and removes a set of keys everywhere in the object in a single
+traversal. Subtrees dropped by the rules are not traversed at all.
+"""
+
+# Values of these types are never traversed. Checking the exact type is cheaper than isinstance checks.
+_SCALAR_TYPES = frozenset([str, int, float, bool, type(None)])
+
+
+class Rule:
+    """Stripping rule for the dicts, or items of lists, at one position of a json object"""
+
+    def __init__(self, keep=None, children=None, items=None):
+        """
+        Init Rule.
+
+        :param keep: Keys to keep in dicts, None to keep all keys
+        :param children: dict from key to the Rule for its value
+        :param items: Rule for the items of a list
+        """
+        self.keep = frozenset(keep) if keep is not None else None
+        self.children = children or {}
+        self.items = items
+
+
+def compile_plan(rule, remove_keys=(), in_place=False):
+    """
+    Compile a stripping plan.
+
+    Keys in remove_keys are removed from dicts everywhere in the object. As with
+    utils.remove_keys_recursively, strings equal to one of the keys are also removed from lists.
+
+    A plan that is not in place returns a stripped copy and leaves the object untouched. Parts of the object
+    the plan has nothing to remove from may be shared with the copy.
+
+    :param rule: Rule for the root of the object
+    :param remove_keys: Keys to remove everywhere
+    :param in_place: Modify the object in place instead of copying it
+    :return: Function taking the object and returning it stripped
+    """
+    remove = frozenset(remove_keys)
+    compile_node = _compile_node_in_place if in_place else _compile_node
+    default = _compile_default_in_place(remove) if in_place else _compile_default(remove)
+
+    def compile_rule(rule):
+        if rule is None:
+            return default
+        children = {key: compile_rule(child) for key, child in rule.children.items()}
+        return compile_node(remove, rule.keep, children, compile_rule(rule.items), default)
+
+    return compile_rule(rule)
+
+
+def _identity(obj):
+    return obj
+
+
+def _compile_default(remove):
+    if not remove:
+        return _identity
+
+    def strip(obj):
+        if isinstance(obj, dict):
+            return {
+                key: value if type(value) in _SCALAR_TYPES else strip(value)
+                for key, value in obj.items() if key not in remove
+            }
+        if isinstance(obj, list):
+            return [
+                item if type(item) in _SCALAR_TYPES else strip(item)
+                for item in obj if not (isinstance(item, str) and item in remove)
+            ]
+        return obj
+    return strip
+
+
+def _compile_node(remove, keep, children, items, default):
+    def strip(obj):
+        if isinstance(obj, dict):
+            stripped = {}
+            for key, value in obj.items():
+                if key in remove or (keep is not None and key not in keep):
+                    continue
+                stripped[key] = value if type(value) in _SCALAR_TYPES else children.get(key, default)(value)
+            return stripped
+        if isinstance(obj, list):
+            return [
+                item if type(item) in _SCALAR_TYPES else items(item)
+                for item in obj if not (isinstance(item, str) and item in remove)
+            ]
+        return obj
+    return strip
+
+
+def _compile_default_in_place(remove):
+    if not remove:
+        return _identity
+
+    def strip(obj):
+        if isinstance(obj, dict):
+            for key in [key for key in obj if key in remove]:
+                del obj[key]
+            for value in obj.values():
+                if type(value) not in _SCALAR_TYPES:
+                    strip(value)
+        elif isinstance(obj, list):
+            obj[:] = [item for item in obj if not (isinstance(item, str) and item in remove)]
+            for item in obj:
+                if type(item) not in _SCALAR_TYPES:
+                    strip(item)
+        return obj
+    return strip
+
+
+def _compile_node_in_place(remove, keep, children, items, default):
+    def strip(obj):
+        if isinstance(obj, dict):
+            for key in [key for key in obj if key in remove or (keep is not None and key not in keep)]:
+                del obj[key]
+            for key, value in obj.items():
+                if type(value) not in _SCALAR_TYPES:
+                    children.get(key, default)(value)
+        elif isinstance(obj, list):
+            if remove:
+                obj[:] = [item for item in obj if not (isinstance(item, str) and item in remove)]
+            for item in obj:
+                if type(item) not in _SCALAR_TYPES:
+                    items(item)
+        return obj
+    return strip
+
+
+def compile_projection(paths):
+    """
+    Compile a plan keeping only the given paths of a json object.
+
+    A path is a dot separated list of keys, e.g. 'research_dataset.title'. A path keeps the whole value at its
+    end. Lists on the way are projected item by item. The plan returns a projected copy.
+
+    :param paths: Paths to keep
+    :return: Function taking the object and returning it projected
+    """
+    # Nested dicts of the keys to keep, with None for keys whose whole value is kept
+    tree = {}
+    for path in paths:
+        *parents, last = path.split('.')
+        node = tree
+        for key in parents:
+            if key in node and node[key] is None:
+                break
+            node = node.setdefault(key, {})
+        else:
+            node[last] = None
+
+    def rule_for(node):
+        keep = list(node)
+        children = {key: rule_for(child) for key, child in node.items() if child is not None}
+        return Rule(keep=keep, children=children, items=Rule(keep=keep, children=children))
+
+    return compile_plan(rule_for(tree))
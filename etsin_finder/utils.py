@@ -7,11 +7,13 @@
 
 """Various utils and constants"""
 
+import heapq
 import json
 import os
 from datetime import datetime
 import pytz
 from dateutil import parser
+from flask import g, has_request_context
 
 
 ACCESS_TYPES = {
@@ -221,6 +223,128 @@ def slice_array_on_limit(array, limit):
     return array
 
 
+def _name_collation_key(name):
+    """Collate names case-insensitively, breaking ties by the exact name. Missing names come first."""
+    if isinstance(name, str):
+        return (name.casefold(), name)
+    return ('', '')
+
+
+def first_by_name(items, name_key, count=None, details_key=None):
+    """
+    Get the first items of a list of objects ordered by the name in name_key.
+
+    Sort keys are computed once per item, and items with equal names keep their order. When only count items
+    of a longer list are needed, they are selected with a heap instead of sorting the whole list.
+
+    :param items: List of dicts
+    :param name_key: Key of the name to order by
+    :param count: Number of items to return, None for all
+    :param details_key: Key of a nested dict holding the name, such as 'details' in catalog records
+    :return: New list
+    """
+    def key(item):
+        if details_key:
+            item = item.get(details_key) or {}
+        return _name_collation_key(item.get(name_key))
+
+    if count is not None and count < len(items):
+        return heapq.nsmallest(count, items, key=key)
+    return sorted(items, key=key)
+
+
+def sort_directory_listing(dir_obj):
+    """
+    Sort the directories and files of a directory listing by name, in place.
+
+    :param dir_obj: Directory listing
+    :return: dir_obj
+    """
+    if dir_obj.get('directories'):
+        dir_obj['directories'] = first_by_name(dir_obj['directories'], 'directory_name')
+    if dir_obj.get('files'):
+        dir_obj['files'] = first_by_name(dir_obj['files'], 'file_name')
+    return dir_obj
+
+
+def paginate_directory_listing(dir_obj, offset, limit, item_limit, is_sorted=True, details_key=None):
+    """
+    Limit a directory listing to one page, in place.
+
+    Directories and files are paged as one sequence, directories first. Without offset and limit, directories
+    and files are both limited to item_limit items. Sizes of the whole listing and the offset of the next page,
+    None on the last page, are added to the listing under 'pagination'.
+
+    An unsorted listing is ordered as sort_directory_listing orders it, but only up to the end of the page.
+
+    :param dir_obj: Directory listing with 'directories' and 'files'
+    :param offset: Index of the first item of the page, or None
+    :param limit: Maximum number of items on the page, or None. Limited to item_limit.
+    :param item_limit: Maximum number of items on a page
+    :param is_sorted: Are the directories and files of the listing sorted by name already
+    :param details_key: Key of a nested dict holding the names, see first_by_name
+    :return: dir_obj
+    """
+    directories = dir_obj.get('directories') or []
+    files = dir_obj.get('files') or []
+    pagination = {'directory_count': len(directories), 'file_count': len(files)}
+
+    if offset is None and limit is None:
+        if not is_sorted:
+            directories = first_by_name(directories, 'directory_name', item_limit, details_key)
+            files = first_by_name(files, 'file_name', item_limit, details_key)
+        page_directories = slice_array_on_limit(directories, item_limit)
+        page_files = slice_array_on_limit(files, item_limit)
+        pagination.update({'offset': 0, 'limit': None, 'next_offset': None})
+    else:
+        offset = offset or 0
+        limit = min(limit or item_limit, item_limit)
+        end = offset + limit
+        if not is_sorted:
+            files = first_by_name(files, 'file_name', max(end - len(directories), 0), details_key)
+            directories = first_by_name(directories, 'directory_name', end, details_key)
+        directory_count = pagination['directory_count']
+        page_directories = directories[offset:end]
+        page_files = files[max(offset - directory_count, 0):max(end - directory_count, 0)]
+        next_offset = end if end < directory_count + pagination['file_count'] else None
+        pagination.update({'offset': offset, 'limit': limit, 'next_offset': next_offset})
+
+    if 'directories' in dir_obj:
+        dir_obj['directories'] = page_directories
+    if 'files' in dir_obj:
+        dir_obj['files'] = page_files
+    dir_obj['pagination'] = pagination
+    return dir_obj
+
+
+def get_request_memo():
+    """
+    Get the dict storing the results memoized for the current request.
+
+    :return: dict
+    """
+    return g.setdefault('request_memo', {})
+
+
+def memoize_for_request(key, fn, *args, **kwargs):
+    """
+    Call function only once per request for each key, returning the stored result on subsequent calls.
+
+    Results are stored in flask.g, so they are dropped at the end of the request. Outside of a request
+    the function is always called.
+
+    :param key: Hashable key identifying the call
+    :param fn: Function to call
+    :return: Result of the function
+    """
+    if not has_request_context():
+        return fn(*args, **kwargs)
+    memo = get_request_memo()
+    if key not in memo:
+        memo[key] = fn(*args, **kwargs)
+    return memo[key]
+
+
 class FlaskService:
     """Use as base class for external dependency services"""
 
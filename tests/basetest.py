@@ -77,7 +77,7 @@ class BaseTest():
         :return:
         """
         from etsin_finder import cr_service
-        monkeypatch.setattr(cr_service, 'get_catalog_record', lambda x, y, z: None)
+        monkeypatch.setattr(cr_service, 'get_catalog_record', lambda x, y, z, file_details=True: None)
 
     @pytest.fixture
     def open_catalog_record(self, monkeypatch):
@@ -88,7 +88,7 @@ class BaseTest():
         :return:
         """
         from etsin_finder import cr_service
-        monkeypatch.setattr(cr_service, 'get_catalog_record', lambda x, y, z: get_test_catalog_record('open'))
+        monkeypatch.setattr(cr_service, 'get_catalog_record', lambda x, y, z, file_details=True: get_test_catalog_record('open'))
 
     @pytest.fixture
     def login_catalog_record(self, monkeypatch):
@@ -99,7 +99,7 @@ class BaseTest():
         :return:
         """
         from etsin_finder import cr_service
-        monkeypatch.setattr(cr_service, 'get_catalog_record', lambda x, y, z: get_test_catalog_record('login'))
+        monkeypatch.setattr(cr_service, 'get_catalog_record', lambda x, y, z, file_details=True: get_test_catalog_record('login'))
 
     @pytest.fixture
     def permit_catalog_record(self, monkeypatch):
@@ -110,7 +110,7 @@ class BaseTest():
         :return:
         """
         from etsin_finder import cr_service
-        monkeypatch.setattr(cr_service, 'get_catalog_record', lambda x, y, z: get_test_catalog_record('permit'))
+        monkeypatch.setattr(cr_service, 'get_catalog_record', lambda x, y, z, file_details=True: get_test_catalog_record('permit'))
 
     @pytest.fixture
     def embargo_passed_catalog_record(self, monkeypatch):
@@ -121,7 +121,7 @@ class BaseTest():
         :return:
         """
         from etsin_finder import cr_service
-        monkeypatch.setattr(cr_service, 'get_catalog_record', lambda x, y, z: get_test_catalog_record('embargo', True))
+        monkeypatch.setattr(cr_service, 'get_catalog_record', lambda x, y, z, file_details=True: get_test_catalog_record('embargo', True))
 
     @pytest.fixture
     def embargo_not_passed_catalog_record(self, monkeypatch):
@@ -132,7 +132,7 @@ class BaseTest():
         :return:
         """
         from etsin_finder import cr_service
-        monkeypatch.setattr(cr_service, 'get_catalog_record', lambda x, y, z: get_test_catalog_record('embargo', False))
+        monkeypatch.setattr(cr_service, 'get_catalog_record', lambda x, y, z, file_details=True: get_test_catalog_record('embargo', False))
 
     @pytest.fixture
     def restricted_catalog_record(self, monkeypatch):
@@ -143,7 +143,7 @@ class BaseTest():
         :return:
         """
         from etsin_finder import cr_service
-        monkeypatch.setattr(cr_service, 'get_catalog_record', lambda x, y, z: get_test_catalog_record('restricted'))
+        monkeypatch.setattr(cr_service, 'get_catalog_record', lambda x, y, z, file_details=True: get_test_catalog_record('restricted'))
 
     @pytest.fixture
     def has_rems_permit(self, monkeypatch):
@@ -154,7 +154,7 @@ class BaseTest():
         :return:
         """
         from etsin_finder import rems_service
-        monkeypatch.setattr(rems_service, 'get_user_rems_permission_for_catalog_record', lambda x, y: True)
+        monkeypatch.setattr(rems_service, 'get_user_rems_permission_for_catalog_record', lambda x, y, z=None: True)
 
     @pytest.fixture
     def no_rems_permit(self, monkeypatch):
@@ -165,7 +165,7 @@ class BaseTest():
         :return:
         """
         from etsin_finder import rems_service
-        monkeypatch.setattr(rems_service, 'get_user_rems_permission_for_catalog_record', lambda x, y: False)
+        monkeypatch.setattr(rems_service, 'get_user_rems_permission_for_catalog_record', lambda x, y, z=None: False)
 
     if __name__ == '__main__':
         pytest.main()
@@ -0,0 +1,398 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2020 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""Test cache functionalities"""
+
+import pickle
+
+import pytest
+from pymemcache.client.base import PooledClient
+from pymemcache.client.hash import HashClient
+
+from .basetest import BaseTest
+from .utils import get_test_catalog_record
+from etsin_finder.cache import BackendHealth, BaseCache, DirectoryListingCache, LRUCache
+from etsin_finder.cache_serde import CompactSerializer, JSONSerializer, PickleSerializer, UnknownFormatError
+
+
+class FakeMemcacheClient:
+    """Dict backed stand-in for pymemcache client"""
+
+    def __init__(self):
+        """Init client"""
+        self.data = {}
+
+    def get(self, key, default=None):
+        """Get value"""
+        return self.data.get(key, default)
+
+    def get_many(self, keys):
+        """Get values of keys found"""
+        return {key: self.data[key] for key in keys if key in self.data}
+
+    def set(self, key, value, expire=0):
+        """Set value"""
+        self.data[key] = value
+        return True
+
+    def set_many(self, values, expire=0):
+        """Set values"""
+        self.data.update(values)
+        return []
+
+    def delete(self, key):
+        """Delete value"""
+        self.data.pop(key, None)
+
+
+class TestLRUCache(BaseTest):
+    """Test in-process L1 cache"""
+
+    def test_evicts_least_recently_used_entry(self):
+        """Entry count is bounded and least recently used entry is evicted first"""
+        lru = LRUCache(2, 1000, 60)
+        lru.set('a', 1, 10)
+        lru.set('b', 2, 10)
+        assert lru.get('a') == 1
+        lru.set('c', 3, 10)
+        assert lru.get('b') is None
+        assert lru.get('a') == 1
+        assert lru.get('c') == 3
+
+    def test_bounded_by_size(self):
+        """Total size is bounded and too large values are not cached"""
+        lru = LRUCache(10, 100, 60)
+        lru.set('a', 1, 60)
+        lru.set('b', 2, 60)
+        assert lru.get('a') is None
+        assert lru.get('b') == 2
+        assert lru.size == 60
+        lru.set('c', 3, 101)
+        assert lru.get('c') is None
+        assert lru.size == 60
+
+    def test_expired_entry_is_not_returned(self):
+        """Entries are dropped after TTL"""
+        lru = LRUCache(10, 100, -1)
+        lru.set('a', 1, 10)
+        assert lru.get('a') is None
+        assert len(lru) == 0
+
+    def test_delete(self):
+        """Deleted entry is not returned"""
+        lru = LRUCache(10, 100, 60)
+        lru.set('a', 1, 10)
+        lru.delete('a')
+        assert lru.get('a') is None
+        assert lru.size == 0
+
+
+class TestCacheSerializers(BaseTest):
+    """Test cache serialization formats"""
+
+    def test_round_trip(self):
+        """Catalog record, boolean and bytes values survive a round trip"""
+        cr = get_test_catalog_record('open')
+        for serializer in [CompactSerializer(), JSONSerializer(), PickleSerializer()]:
+            for value in [cr, True, b'bytes']:
+                assert serializer.loads(serializer.dumps(value)) == value
+
+    def test_large_values_are_compressed(self):
+        """Bodies over the threshold are compressed and report their uncompressed size"""
+        serializer = CompactSerializer(compress_threshold=100)
+        value = {'files': [{'file_name': 'file_{0}.csv'.format(i)} for i in range(100)]}
+        data, size = serializer.encode(value)
+        assert len(data) < size
+        assert serializer.decode(data) == (value, size)
+
+    def test_formats_are_interchangeable(self):
+        """Payloads written by one serializer can be read by the other"""
+        cr = get_test_catalog_record('open')
+        serializers = [CompactSerializer(), JSONSerializer(), PickleSerializer()]
+        for writer in serializers:
+            for reader in serializers:
+                assert reader.loads(writer.dumps(cr)) == cr
+
+    def test_unknown_format_is_rejected(self):
+        """Payloads in another format, such as plain pickle, raise UnknownFormatError"""
+        with pytest.raises(UnknownFormatError):
+            CompactSerializer().loads(pickle.dumps({'a': 1}))
+
+
+class TestChunkedStorage(BaseTest):
+    """Test storing values larger than memcached item size"""
+
+    @pytest.fixture
+    def cache(self, app):
+        """
+        Cache using a fake memcached client with a small item size
+
+        :param app:
+        :return:
+        """
+        cache = BaseCache(app)
+        cache.is_testing = False
+        cache.cache = FakeMemcacheClient()
+        cache.serializer = CompactSerializer(compress_threshold=10 ** 9)
+        cache.max_item_size = 1000
+        return cache
+
+    def test_large_value_is_chunked(self, cache):
+        """Large value is split into chunks and read back through the manifest"""
+        cr = get_test_catalog_record('open')
+        cache.do_update('cr_1', cr, 60)
+        assert cache.cache.data['cr_1'].startswith(BaseCache.CHUNK_MANIFEST_PREFIX)
+        assert len(cache.cache.data) > 2
+        assert cache.do_get('cr_1') == cr
+
+    def test_small_value_is_not_chunked(self, cache):
+        """Value under item size is stored under its key"""
+        cache.do_update('a', {'a': 1}, 60)
+        assert list(cache.cache.data) == ['a']
+        assert cache.do_get('a') == {'a': 1}
+
+    def test_missing_chunk_is_a_miss(self, cache):
+        """Value with a missing chunk is not returned"""
+        cache.do_update('cr_1', get_test_catalog_record('open'), 60)
+        chunk_key = next(key for key in cache.cache.data if key != 'cr_1')
+        cache.cache.delete(chunk_key)
+        assert cache.do_get('cr_1') is None
+
+    def test_too_large_value_is_not_cached(self, cache):
+        """Value needing more than MAX_CHUNKS chunks is not stored"""
+        cache.max_item_size = 10
+        cache.do_update('cr_1', get_test_catalog_record('open'), 60)
+        assert cache.cache.data == {}
+
+
+class TestL1Cache(BaseTest):
+    """Test values read through the L1 cache"""
+
+    def test_l1_hit_is_a_copy(self, app):
+        """Modifying a value read from the L1 cache does not modify the cached value"""
+        cache = BaseCache(app)
+        cache.is_testing = False
+        cache.cache = FakeMemcacheClient()
+        cache.serializer = CompactSerializer()
+        cache.l1 = LRUCache(10, 10 ** 6, 60)
+        cr = get_test_catalog_record('open')
+        cache.do_update('cr_1', cr, 60)
+        cache.cache.data.clear()
+
+        first = cache.do_get('cr_1')
+        first['research_dataset']['title'] = None
+        second = cache.do_get('cr_1')
+        assert second == cr
+        assert second is not first
+
+
+class TestMemcachedClients(BaseTest):
+    """Test memcached configuration and client construction"""
+
+    def test_servers_are_parsed(self):
+        """Servers are given as 'host:port' strings or HOST and PORT dicts, invalid entries are skipped"""
+        from etsin_finder.app_config import _parse_memcached_servers
+        assert _parse_memcached_servers(['cache1:11211', {'HOST': 'cache2', 'PORT': '11212'}]) == [
+            ('cache1', 11211), ('cache2', 11212)]
+        assert _parse_memcached_servers(['cache1', {'HOST': 'cache2'}, 11211]) == []
+        assert _parse_memcached_servers('cache1:11211') == []
+
+    def test_single_node_config(self, monkeypatch):
+        """HOST and PORT are used when SERVERS is not given"""
+        from etsin_finder import app_config
+        monkeypatch.setattr(app_config, 'executing_travis', lambda: False)
+        monkeypatch.setattr(app_config, 'get_app_config', lambda is_testing: {
+            'MEMCACHED': {'HOST': 'localhost', 'PORT': '11211'}})
+        assert app_config.get_memcached_config(False)['SERVERS'] == [('localhost', 11211)]
+        monkeypatch.setattr(app_config, 'get_app_config', lambda is_testing: {
+            'MEMCACHED': {'HOST': 'localhost', 'PORT': 11211, 'SERVERS': ['cache1:11211', 'cache2:11211']}})
+        assert app_config.get_memcached_config(False)['SERVERS'] == [('cache1', 11211), ('cache2', 11211)]
+
+    def _create_cache(self, app, monkeypatch, servers):
+        from etsin_finder import cache
+        monkeypatch.setattr(cache, 'get_memcached_config', lambda is_testing: {'SERVERS': servers})
+        return BaseCache(app)
+
+    def test_single_node_uses_pooled_client(self, app, monkeypatch):
+        """Single node is used with a pooled client and its health is tracked"""
+        cache = self._create_cache(app, monkeypatch, [('localhost', 11211)])
+        assert isinstance(cache.cache, PooledClient)
+        assert cache.health is not None
+
+    def test_several_nodes_use_hash_client(self, app, monkeypatch):
+        """Keys are distributed to several nodes with a hash client, which tracks the health of each node"""
+        cache = self._create_cache(app, monkeypatch, [('cache1', 11211), ('cache2', 11211)])
+        assert isinstance(cache.cache, HashClient)
+        assert sorted(cache.cache.clients) == ['cache1:11211', 'cache2:11211']
+        assert cache.health is None
+
+
+class TestL1Exclusions(BaseTest):
+    """Test caches invalidated across workers are not kept in the L1 cache"""
+
+    def test_catalog_records_are_not_kept_in_l1(self, app, monkeypatch):
+        """Record caches do not use the L1 cache even when it is enabled"""
+        from etsin_finder import cache
+        monkeypatch.setattr(cache, 'get_cache_l1_config',
+                            lambda is_testing: {'MAX_ENTRIES': 10, 'MAX_BYTES': 10 ** 6, 'TTL': 10})
+        assert BaseCache(app).l1 is not None
+        assert cache.CatalogRecordCache(app).l1 is None
+        assert cache.CatalogRecordSummaryCache(app).l1 is None
+
+    def test_rems_cache_is_not_kept_in_l1(self, app, monkeypatch):
+        """Applications deleted in one worker are not served from the L1 cache of another"""
+        from etsin_finder import cache
+        monkeypatch.setattr(cache, 'get_cache_l1_config',
+                            lambda is_testing: {'MAX_ENTRIES': 10, 'MAX_BYTES': 10 ** 6, 'TTL': 10})
+        assert cache.RemsCache(app).l1 is None
+        assert cache.QvainDirectoryCache(app).l1 is None
+        assert cache.DirectoryListingCache(app).l1 is not None
+
+
+class TestBackendHealth(BaseTest):
+    """Test skipping memcached while it is down"""
+
+    @pytest.fixture
+    def health(self, app, monkeypatch):
+        """
+        Backend health running probes synchronously
+
+        :param app:
+        :param monkeypatch:
+        :return:
+        """
+        from etsin_finder import cache
+        monkeypatch.setattr(cache, 'spawn_background', lambda fn: fn())
+        self.probe_fails = True
+
+        def probe():
+            if self.probe_fails:
+                raise ConnectionRefusedError()
+
+        return cache.BackendHealth('test', probe)
+
+    def test_marked_down_after_consecutive_failures(self, health):
+        """Backend is skipped only after FAILURE_THRESHOLD consecutive failures"""
+        health.record_failure()
+        health.record_failure()
+        health.record_success()
+        health.record_failure()
+        health.record_failure()
+        assert health.is_available()
+        health.record_failure()
+        assert not health.available
+
+    def test_probe_reenables_backend(self, health):
+        """Failed probe doubles the backoff, successful probe marks backend available"""
+        for i in range(BackendHealth.FAILURE_THRESHOLD):
+            health.record_failure()
+        assert not health.is_available()
+
+        health.retry_at = 0
+        assert not health.is_available()
+        assert health.backoff == BackendHealth.MIN_BACKOFF * 2
+
+        self.probe_fails = False
+        health.retry_at = 0
+        health.is_available()
+        assert health.is_available()
+
+
+class TestDirectoryListingCache(BaseTest):
+    """Test caching of directory listings"""
+
+    @pytest.fixture
+    def cache(self, app):
+        """
+        Directory listing cache using a fake memcached client with the L1 cache enabled
+
+        :param app:
+        :return:
+        """
+        cache = DirectoryListingCache(app)
+        client = FakeMemcacheClient()
+        for c in [cache, cache.generations]:
+            c.is_testing = False
+            c.cache = client
+            c.serializer = CompactSerializer()
+        cache.l1 = LRUCache(10, 10 ** 6, 60)
+        return cache
+
+    def test_listing_is_cached_per_parameters(self, cache):
+        """Listings are cached separately for each directory and field selection"""
+        generation = cache.get_generation('123')
+        cache.update_cache('123', generation, 'dir1', 'file_name', None, {'files': [1]})
+        assert cache.get_from_cache('123', generation, 'dir1', 'file_name', None) == {'files': [1]}
+        assert cache.get_from_cache('123', generation, 'dir1', None, None) is None
+        assert cache.get_from_cache('123', generation, 'dir2', 'file_name', None) is None
+
+    def test_invalidate_drops_listings(self, cache):
+        """Invalidating a record drops its listings, also from the L1 cache"""
+        generation = cache.get_generation('123')
+        cache.update_cache('123', generation, 'dir1', None, None, {'files': [1]})
+        cache.update_cache('456', cache.get_generation('456'), 'dir1', None, None, {'files': [2]})
+        cache.invalidate('123')
+        new_generation = cache.get_generation('123')
+        assert new_generation != generation
+        assert cache.get_from_cache('123', new_generation, 'dir1', None, None) is None
+        assert cache.get_from_cache('456', cache.get_generation('456'), 'dir1', None, None) == {'files': [2]}
+
+    def test_cached_listing_is_not_shared(self, cache):
+        """Modifying a listing read from the L1 cache does not modify the cached listing"""
+        generation = cache.get_generation('123')
+        cache.update_cache('123', generation, 'dir1', None, None, {'files': [1, 2]})
+        cache.get_from_cache('123', generation, 'dir1', None, None)['files'].pop()
+        assert cache.get_from_cache('123', generation, 'dir1', None, None) == {'files': [1, 2]}
+
+
+class TestQvainDirectoryPages(BaseTest):
+    """Test reading Qvain directory listings in pages"""
+
+    @pytest.fixture
+    def qvain_light_service(self, app, monkeypatch):
+        """
+        qvain_light_service with a fake memcached client and a counting fake Metax
+
+        :param app:
+        :param monkeypatch:
+        :return:
+        """
+        from etsin_finder import qvain_light_service
+        cache = app.qvain_dir_cache
+        monkeypatch.setattr(cache, 'is_testing', False)
+        monkeypatch.setattr(cache, 'cache', FakeMemcacheClient(), raising=False)
+        monkeypatch.setattr(cache, 'serializer', CompactSerializer(), raising=False)
+        self.metax_calls = []
+
+        def get_directory(dir_id):
+            self.metax_calls.append(dir_id)
+            return {
+                'directories': [{'directory_name': name} for name in ['b', 'A']],
+                'files': [{'file_name': name} for name in ['d', 'C', 'e']]
+            }
+        monkeypatch.setattr(qvain_light_service, 'get_directory', get_directory)
+        return qvain_light_service
+
+    @staticmethod
+    def _names(page):
+        return [item.get('directory_name') or item.get('file_name') for item in page['directories'] + page['files']]
+
+    def test_following_pages_are_cut_from_cached_listing(self, qvain_light_service):
+        """First page is fetched from Metax and the following pages from the cached sorted listing"""
+        pages = [qvain_light_service.get_directory_page('dir1', offset, 2, 1000) for offset in [0, 2, 4]]
+        assert [self._names(page) for page in pages] == [['A', 'b'], ['C', 'd'], ['e']]
+        assert pages[-1]['pagination']['next_offset'] is None
+        assert self.metax_calls == ['dir1']
+
+        qvain_light_service.get_directory_page('dir1', None, 2, 1000)
+        assert self.metax_calls == ['dir1', 'dir1']
+
+    def test_single_page_listing_is_not_cached(self, app, qvain_light_service):
+        """Listing that fits on one page is not cached"""
+        page = qvain_light_service.get_directory_page('dir1', 0, 10, 1000)
+        assert self._names(page) == ['A', 'b', 'C', 'd', 'e']
+        assert app.qvain_dir_cache.get_sorted_listing('dir_dir1') is None
@@ -0,0 +1,164 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2020 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""Test concurrency helpers"""
+
+import threading
+import time
+
+import pytest
+
+from .basetest import BaseTest
+from etsin_finder.concurrency import SingleFlight, fan_out
+from etsin_finder.metrics import metrics
+
+
+class TestSingleFlight(BaseTest):
+    """Test request coalescing"""
+
+    def test_concurrent_calls_share_result(self):
+        """Concurrent calls with the same key execute the function once"""
+        flight = SingleFlight('test_share')
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {'identifier': '123'}
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do('123', fetch)))
+        leader.start()
+        started.wait(5)
+        waiters = [threading.Thread(target=lambda: results.append(flight.do('123', fetch))) for i in range(5)]
+        for waiter in waiters:
+            waiter.start()
+        deadline = time.time() + 5
+        while metrics.get('singleflight.test_share.shared') < 5 and time.time() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in [leader] + waiters:
+            thread.join(5)
+
+        assert len(calls) == 1
+        assert len(results) == 6
+        assert all(result is results[0] for result in results)
+        assert not flight.in_flight('123')
+
+    def test_waiters_get_copies(self):
+        """With copy_result, concurrent callers do not share the result object"""
+        flight = SingleFlight('test_copy', copy_result=True)
+        started = threading.Event()
+        release = threading.Event()
+
+        def fetch():
+            started.set()
+            release.wait(5)
+            return {'files': [1, 2]}
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do('123', fetch)))
+        leader.start()
+        started.wait(5)
+        waiters = [threading.Thread(target=lambda: results.append(flight.do('123', fetch))) for i in range(2)]
+        for waiter in waiters:
+            waiter.start()
+        deadline = time.time() + 5
+        while metrics.get('singleflight.test_copy.shared') < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in [leader] + waiters:
+            thread.join(5)
+
+        assert len(results) == 3
+        assert len({id(result) for result in results}) == 3
+        assert len({id(result['files']) for result in results}) == 3
+        results[0]['files'].pop()
+        assert results[1] == results[2] == {'files': [1, 2]}
+
+    def test_sequential_calls_are_not_cached(self):
+        """Completed calls are not remembered"""
+        flight = SingleFlight('test')
+        assert flight.do('a', lambda: 1) == 1
+        assert flight.do('a', lambda: 2) == 2
+
+    def test_exception_is_propagated(self):
+        """Exception raised by the function is raised to the caller and the key is released"""
+        flight = SingleFlight('test')
+
+        def fail():
+            raise ValueError('failed')
+
+        with pytest.raises(ValueError):
+            flight.do('a', fail)
+        assert not flight.in_flight('a')
+
+
+class TestFanOut(BaseTest):
+    """Test running independent calls concurrently"""
+
+    def test_calls_run_concurrently(self):
+        """Calls waiting for each other complete only when run at the same time"""
+        barrier = threading.Barrier(3, timeout=5)
+
+        def call(value):
+            barrier.wait()
+            return value
+        assert fan_out([(call, 1), (call, 2), (call, 3)], 5) == [1, 2, 3]
+
+    def test_request_memo_is_shared(self, app):
+        """Results memoized in the calls are seen by the request"""
+        from etsin_finder.utils import memoize_for_request
+        calls = []
+
+        def decide():
+            calls.append(1)
+            return True
+        with app.test_request_context():
+            assert fan_out([(memoize_for_request, 'key', decide)], 5) == [True]
+            assert memoize_for_request('key', decide) is True
+        assert calls == [1]
+
+    def test_concurrency_is_bounded(self):
+        """No more than max_workers calls run at the same time"""
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def call():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.pop()
+        fan_out([(call,)] * 6, 5, max_workers=2)
+        assert len(peak) == 6
+        assert max(peak) <= 2
+
+    def test_timed_out_call_returns_none(self):
+        """Result of a call not completed in time is None"""
+        release = threading.Event()
+        assert fan_out([(release.wait, 5), (lambda: 'done',)], 0.05) == [None, 'done']
+        release.set()
+
+    def test_exception_is_propagated(self):
+        """Exception raised by a call is raised to the caller"""
+        def fail():
+            raise ValueError('failed')
+
+        with pytest.raises(ValueError):
+            fan_out([(fail,), (lambda: 1,)])
+
+    def test_request_context_is_available(self, app):
+        """Calls made during a request can use the request context"""
+        from flask import request
+        with app.test_request_context('/api/test'):
+            assert fan_out([(lambda: request.path,)]) == ['/api/test']
@@ -0,0 +1,302 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2020 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""Test catalog record fetching and caching"""
+
+import threading
+import time
+
+import pytest
+
+from .basetest import BaseTest
+from .utils import get_test_catalog_record
+
+
+class CatalogRecordServiceTest(BaseTest):
+    """Base class for tests using cr_service with fake cache and Metax"""
+
+    @pytest.fixture
+    def cr_service(self, app, monkeypatch):
+        """
+        cr_service with an in-memory catalog record cache and a counting fake Metax
+
+        :param app:
+        :param monkeypatch:
+        :return:
+        """
+        from etsin_finder import cr_service
+        store = {}
+        for cache in (app.cr_cache, app.cr_summary_cache):
+            monkeypatch.setattr(cache, 'do_get', lambda key: store.get(key))
+            monkeypatch.setattr(cache, 'do_update', lambda key, value, ttl: store.__setitem__(key, value))
+            monkeypatch.setattr(cache, 'do_delete', lambda key: store.pop(key, None))
+        return cr_service
+
+    def _fake_metax(self, cr_service, monkeypatch, response, removed_response=None):
+        self.metax_calls = []
+        self.removed_calls = []
+
+        def get_cr(identifier, if_modified_since=None):
+            self.metax_calls.append(if_modified_since)
+            return response
+
+        def get_removed_cr(identifier, if_modified_since=None):
+            self.removed_calls.append(if_modified_since)
+            return removed_response
+        monkeypatch.setattr(cr_service._metax_api, 'get_catalog_record_with_file_details', get_cr)
+        monkeypatch.setattr(cr_service._metax_api, 'get_removed_catalog_record', get_removed_cr)
+
+
+class TestCatalogRecordRevalidation(CatalogRecordServiceTest):
+    """Test conditional revalidation of cached catalog records"""
+
+    def test_uncached_record_is_fetched(self, cr_service, monkeypatch):
+        """Record not in cache is fetched without conditional header and cached"""
+        cr = get_test_catalog_record('open')
+        self._fake_metax(cr_service, monkeypatch, cr)
+        assert cr_service.get_catalog_record('123', True, True) == cr
+        assert self.metax_calls == [None]
+        assert cr_service.get_catalog_record('123', False, False) == cr
+        assert len(self.metax_calls) == 1
+
+    def test_not_modified_record_is_served_from_cache(self, app, cr_service, monkeypatch):
+        """Cached record is revalidated with If-Modified-Since and kept when not modified"""
+        cr = get_test_catalog_record('open')
+        cr['date_modified'] = '2020-01-27T07:21:35+02:00'
+        app.cr_cache.update_cache('123', cr)
+        self._fake_metax(cr_service, monkeypatch, cr_service.NOT_MODIFIED)
+        assert cr_service.get_catalog_record('123', True, True) == cr
+        assert self.metax_calls == ['Mon, 27 Jan 2020 05:21:35 GMT']
+
+    def test_validation_keeps_hard_expiry(self, app, cr_service, monkeypatch):
+        """Not modified record is marked validated without extending the time it is kept"""
+        cr = get_test_catalog_record('open')
+        app.cr_cache.update_cache('123', cr)
+        entry = app.cr_cache.get_cache_entry('123')
+        entry['fetched_at'] -= 1000
+        entry['validated_at'] -= 1500
+        self._fake_metax(cr_service, monkeypatch, cr_service.NOT_MODIFIED)
+        assert cr_service.get_catalog_record('123', False, True) == cr
+        entry = app.cr_cache.get_cache_entry('123')
+        assert not app.cr_cache.is_stale(entry)
+        assert time.time() - entry['fetched_at'] >= 1000
+
+    def test_expired_record_is_downloaded_again(self, app, cr_service, monkeypatch):
+        """Record past hard expiry is downloaded without conditional header, as file changes give no 200"""
+        cr = get_test_catalog_record('open')
+        cr['date_modified'] = '2020-01-27T07:21:35+02:00'
+        app.cr_cache.update_cache('123', cr)
+        entry = app.cr_cache.get_cache_entry('123')
+        entry['fetched_at'] -= app.cr_cache.CACHE_ITEM_TTL + 1
+        entry['validated_at'] -= app.cr_cache.CACHE_ITEM_SOFT_TTL + 1
+        changed_cr = get_test_catalog_record('open')
+        changed_cr['date_modified'] = cr['date_modified']
+        changed_cr['research_dataset']['files'][0]['details']['byte_size'] = 1
+        self.metax_calls = []
+
+        def get_cr(identifier, if_modified_since=None):
+            self.metax_calls.append(if_modified_since)
+            return cr_service.NOT_MODIFIED if if_modified_since else changed_cr
+        monkeypatch.setattr(cr_service._metax_api, 'get_catalog_record_with_file_details', get_cr)
+
+        assert cr_service.get_catalog_record('123', False, True) == changed_cr
+        assert self.metax_calls == [None]
+        entry = app.cr_cache.get_cache_entry('123')
+        assert entry['catalog_record'] == changed_cr
+        assert not app.cr_cache.is_expired(entry)
+
+    def test_modified_record_replaces_cached(self, app, cr_service, monkeypatch):
+        """Modified record returned by Metax replaces the cached one"""
+        cr = get_test_catalog_record('open')
+        app.cr_cache.update_cache('123', cr)
+        modified_cr = get_test_catalog_record('login')
+        self._fake_metax(cr_service, monkeypatch, modified_cr)
+        assert cr_service.get_catalog_record('123', True, True) == modified_cr
+        assert app.cr_cache.get_from_cache('123') == modified_cr
+
+    def test_deleted_record_is_dropped_from_cache(self, app, cr_service, monkeypatch):
+        """Record no longer found in Metax is removed from cache"""
+        app.cr_cache.update_cache('123', get_test_catalog_record('open'))
+        self._fake_metax(cr_service, monkeypatch, cr_service.NOT_FOUND, cr_service.NOT_FOUND)
+        assert cr_service.get_catalog_record('123', True, True) is None
+        assert app.cr_cache.get_from_cache('123') is None
+
+    def test_remaining_soft_ttl_is_remembered_for_request(self, app, cr_service, monkeypatch):
+        """Seconds until the record got during the request becomes stale are known to the request"""
+        cr = get_test_catalog_record('open')
+        app.cr_cache.update_cache('123', cr)
+        entry = app.cr_cache.get_cache_entry('123')
+        entry['validated_at'] -= 1000
+        self._fake_metax(cr_service, monkeypatch, cr)
+        with app.test_request_context():
+            assert cr_service.get_remaining_soft_ttl('123') is None
+            cr_service.get_catalog_record('123', False, False)
+            remaining = cr_service.get_remaining_soft_ttl('123')
+            assert app.cr_cache.CACHE_ITEM_SOFT_TTL - 1001 < remaining <= app.cr_cache.CACHE_ITEM_SOFT_TTL - 1000
+            assert cr_service.get_remaining_soft_ttl('123', file_details=False) is None
+
+    def test_failed_revalidation_keeps_cached_record(self, app, cr_service, monkeypatch):
+        """Record is kept in cache and revalidated again later when Metax cannot be reached"""
+        cr = get_test_catalog_record('open')
+        app.cr_cache.update_cache('123', cr)
+        invalidated = []
+        monkeypatch.setattr(app.dir_cache, 'invalidate', invalidated.append)
+        monkeypatch.setattr(app.response_cache, 'invalidate', invalidated.append)
+        self._fake_metax(cr_service, monkeypatch, None)
+
+        assert cr_service.get_catalog_record('123', False, True) == cr
+        entry = app.cr_cache.get_cache_entry('123')
+        assert entry['catalog_record'] == cr
+        assert not app.cr_cache.is_stale(entry)
+        assert time.time() - entry['validated_at'] >= app.cr_cache.CACHE_ITEM_SOFT_TTL - app.cr_cache.REVALIDATE_RETRY_INTERVAL
+        assert len(self.metax_calls) == 1
+        assert invalidated == []
+
+    def test_stale_record_is_served_and_revalidated_in_background(self, app, cr_service, monkeypatch):
+        """Record past soft expiry is returned from cache and revalidated in the background"""
+        cr = get_test_catalog_record('open')
+        app.cr_cache.update_cache('123', cr)
+        monkeypatch.setattr(app.cr_cache, 'CACHE_ITEM_SOFT_TTL', -1)
+        modified_cr = get_test_catalog_record('login')
+        self._fake_metax(cr_service, monkeypatch, modified_cr)
+        threads = []
+        monkeypatch.setattr(cr_service, 'spawn_background', lambda fn, *args: threads.append(threading.Thread(target=fn, args=args)))
+
+        assert cr_service.get_catalog_record('123', False, False) == cr
+        assert len(threads) == 1
+        threads[0].start()
+        threads[0].join(5)
+        assert app.cr_cache.get_from_cache('123') == modified_cr
+
+
+class TestCatalogRecordNegativeCaching(CatalogRecordServiceTest):
+    """Test caching of missing and removed catalog records"""
+
+    def test_missing_record_is_cached(self, cr_service, monkeypatch):
+        """Record not found in Metax is looked up only once"""
+        self._fake_metax(cr_service, monkeypatch, cr_service.NOT_FOUND, cr_service.NOT_FOUND)
+        assert cr_service.get_catalog_record('123', True) is None
+        assert cr_service.get_catalog_record('123', True) is None
+        assert cr_service.get_catalog_record('123', False, True) is None
+        assert len(self.metax_calls) == 1
+        assert len(self.removed_calls) == 1
+
+    def test_missing_record_checks_only_removed(self, cr_service, monkeypatch):
+        """Record cached as missing without removed check is then looked up only from removed records"""
+        removed_cr = get_test_catalog_record('open')
+        removed_cr['removed'] = True
+        self._fake_metax(cr_service, monkeypatch, cr_service.NOT_FOUND, removed_cr)
+        assert cr_service.get_catalog_record('123', False) is None
+        assert self.removed_calls == []
+        assert cr_service.get_catalog_record('123', True) == removed_cr
+        assert len(self.metax_calls) == 1
+        assert len(self.removed_calls) == 1
+
+    def test_failed_fetch_is_not_cached(self, cr_service, monkeypatch):
+        """Record that could not be fetched because of an error is fetched again"""
+        self._fake_metax(cr_service, monkeypatch, None, cr_service.NOT_FOUND)
+        assert cr_service.get_catalog_record('123', True) is None
+        assert cr_service.get_catalog_record('123', True) is None
+        assert len(self.metax_calls) == 2
+
+    def test_removed_record_is_served_only_when_requested(self, app, cr_service, monkeypatch):
+        """Cached removed record is returned only when removed records are checked"""
+        removed_cr = get_test_catalog_record('open')
+        removed_cr['removed'] = True
+        app.cr_cache.update_cache('123', removed_cr)
+        self._fake_metax(cr_service, monkeypatch, cr_service.NOT_FOUND, removed_cr)
+        assert cr_service.get_catalog_record('123', True) == removed_cr
+        assert cr_service.get_catalog_record('123', False) is None
+        assert cr_service.get_catalog_record('123', False, True) is None
+        assert self.metax_calls == []
+        assert self.removed_calls == []
+
+
+class TestCatalogRecordInvalidation(CatalogRecordServiceTest):
+    """Test invalidation of cached catalog records modified through Qvain Light"""
+
+    def test_versions_are_invalidated(self, app, cr_service):
+        """Invalidating a record drops the other cached versions of the dataset"""
+        cr = get_test_catalog_record('open')
+        cr['dataset_version_set'] = [{'identifier': '123'}, {'identifier': '456'}]
+        app.cr_cache.update_cache('123', cr)
+        app.cr_cache.update_cache('456', get_test_catalog_record('login'))
+        app.cr_cache.update_cache('789', get_test_catalog_record('login'))
+        cr_service.invalidate_catalog_record('123')
+        assert app.cr_cache.get_from_cache('123') is None
+        assert app.cr_cache.get_from_cache('456') is None
+        assert app.cr_cache.get_from_cache('789') is not None
+
+    def test_qvain_mutation_invalidates_record_and_new_version(self, app, cr_service, monkeypatch):
+        """Records modified and created by Qvain Light RPCs are dropped from cache"""
+        from etsin_finder import qvain_light_service
+        app.cr_cache.update_cache('123', get_test_catalog_record('open'))
+        app.cr_cache.update_cache_not_found('456', True)
+        response = ({'new_version_created': {'identifier': '456'}}, 200)
+        monkeypatch.setattr(qvain_light_service._metax_api, 'change_cumulative_state', lambda *args: response)
+        assert qvain_light_service.change_cumulative_state('123', 1) == response
+        assert app.cr_cache.get_cache_entry('123') is None
+        assert app.cr_cache.get_cache_entry('456') is None
+
+    def _fake_metax_modified_during_fetch(self, cr_service, monkeypatch, first_response, modified_cr):
+        self.metax_calls = []
+
+        def get_cr(identifier, if_modified_since=None):
+            self.metax_calls.append(if_modified_since)
+            if len(self.metax_calls) == 1:
+                cr_service.invalidate_catalog_record(identifier)
+                return first_response
+            return modified_cr
+        monkeypatch.setattr(cr_service._metax_api, 'get_catalog_record_with_file_details', get_cr)
+
+    def test_fetch_in_flight_does_not_write_back(self, app, cr_service, monkeypatch):
+        """Record invalidated while it is being fetched is fetched again instead of caching the old one"""
+        cr = get_test_catalog_record('open')
+        modified_cr = get_test_catalog_record('login')
+        self._fake_metax_modified_during_fetch(cr_service, monkeypatch, cr, modified_cr)
+        assert cr_service.get_catalog_record('123', False, False) == modified_cr
+        assert self.metax_calls == [None, None]
+        assert app.cr_cache.get_from_cache('123') == modified_cr
+
+    def test_revalidation_in_flight_does_not_write_back(self, app, cr_service, monkeypatch):
+        """Record invalidated while it is being revalidated is not marked validated"""
+        cr = get_test_catalog_record('open')
+        cr['date_modified'] = '2020-01-27T07:21:35+02:00'
+        app.cr_cache.update_cache('123', cr)
+        modified_cr = get_test_catalog_record('login')
+        self._fake_metax_modified_during_fetch(cr_service, monkeypatch, cr_service.NOT_MODIFIED, modified_cr)
+        assert cr_service.get_catalog_record('123', False, True) == modified_cr
+        assert self.metax_calls == ['Mon, 27 Jan 2020 05:21:35 GMT', None]
+        assert app.cr_cache.get_from_cache('123') == modified_cr
+
+
+class TestCatalogRecordSummary(CatalogRecordServiceTest):
+    """Test catalog records fetched without file details"""
+
+    def test_summary_is_cached_separately(self, app, cr_service, monkeypatch):
+        """Records without file details are fetched and cached apart from the records with them"""
+        cr = get_test_catalog_record('open')
+        summary = {'identifier': '123', 'research_dataset': {'title': {'en': 'Title'}}}
+        self._fake_metax(cr_service, monkeypatch, cr)
+        summary_calls = []
+
+        def get_summary(identifier, if_modified_since=None):
+            summary_calls.append(if_modified_since)
+            return summary
+        monkeypatch.setattr(cr_service._metax_api, 'get_catalog_record_without_file_details', get_summary)
+
+        assert cr_service.get_catalog_record('123', False, False, file_details=False) == summary
+        assert cr_service.get_catalog_record('123', False, False, file_details=False) == summary
+        assert cr_service.get_catalog_record('123', False, False) == cr
+        assert summary_calls == [None]
+        assert self.metax_calls == [None]
+
+    def test_invalidation_drops_summary(self, app, cr_service):
+        """Invalidating a record drops it from both caches"""
+        app.cr_summary_cache.update_cache('123', get_test_catalog_record('open'))
+        cr_service.invalidate_catalog_record('123')
+        assert app.cr_summary_cache.get_from_cache('123') is None
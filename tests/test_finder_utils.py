@@ -8,7 +8,7 @@
 """Basic app tests"""
 
 from .basetest import BaseTest
-from etsin_finder.utils import datetime_to_header
+from etsin_finder.utils import datetime_to_header, first_by_name, paginate_directory_listing
 
 
 class TestFinderUtils(BaseTest):
@@ -25,3 +25,55 @@ class TestFinderUtils(BaseTest):
         assert datetime_to_header(test_randome_string) is False
         assert datetime_to_header(test4_datetime_wrong_format) == "Mon, 27 Jan 2020 05:21:35 GMT"
         assert datetime_to_header(test_ISO_8601) == "Mon, 27 Jan 2020 05:21:35 GMT"
+
+    def test_paginate_directory_listing(self):
+        """Directories and files are paged as one sequence, directories first"""
+        def listing():
+            return {'directories': ['d0', 'd1', 'd2'], 'files': ['f0', 'f1', 'f2', 'f3']}
+
+        page = paginate_directory_listing(listing(), 2, 3, 1000)
+        assert page['directories'] == ['d2']
+        assert page['files'] == ['f0', 'f1']
+        assert page['pagination'] == {
+            'directory_count': 3, 'file_count': 4, 'offset': 2, 'limit': 3, 'next_offset': 5
+        }
+
+        page = paginate_directory_listing(listing(), 5, None, 1000)
+        assert page['directories'] == []
+        assert page['files'] == ['f2', 'f3']
+        assert page['pagination']['next_offset'] is None
+
+        page = paginate_directory_listing(listing(), 0, 100, 2)
+        assert page['directories'] == ['d0', 'd1']
+        assert page['files'] == []
+        assert page['pagination']['limit'] == 2
+
+    def test_paginate_directory_listing_without_paging(self):
+        """Without offset and limit, directories and files are both limited to the item limit"""
+        page = paginate_directory_listing({'directories': ['d0', 'd1', 'd2'], 'files': ['f0', 'f1']}, None, None, 2)
+        assert page['directories'] == ['d0', 'd1']
+        assert page['files'] == ['f0', 'f1']
+        assert page['pagination']['directory_count'] == 3
+
+    def test_first_by_name(self):
+        """Names are collated case-insensitively and only the requested number of items is returned"""
+        items = [{'file_name': 'b'}, {'file_name': 'B'}, {'file_name': 'a'}, {}, {'file_name': 'C'}]
+        assert first_by_name(items, 'file_name') == [{}, {'file_name': 'a'}, {'file_name': 'B'},
+                                                     {'file_name': 'b'}, {'file_name': 'C'}]
+        assert first_by_name(items, 'file_name', 2) == [{}, {'file_name': 'a'}]
+
+    def test_first_by_nested_name(self):
+        """Names nested in details, as in catalog records, are collated the same way"""
+        items = [{'details': {'file_name': 'b'}}, {'details': {'file_name': 'A'}}, {}]
+        assert first_by_name(items, 'file_name', 2, 'details') == [{}, {'details': {'file_name': 'A'}}]
+
+    def test_paginate_unsorted_directory_listing(self):
+        """Unsorted listing is ordered up to the end of the page"""
+        listing = {
+            'directories': [{'directory_name': 'y'}, {'directory_name': 'x'}],
+            'files': [{'file_name': 'c'}, {'file_name': 'a'}, {'file_name': 'b'}]
+        }
+        page = paginate_directory_listing(listing, 1, 2, 1000, is_sorted=False)
+        assert page['directories'] == [{'directory_name': 'y'}]
+        assert page['files'] == [{'file_name': 'a'}]
+        assert page['pagination']['next_offset'] == 3
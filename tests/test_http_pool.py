@@ -0,0 +1,91 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2020 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""Test shared keep-alive HTTP connection pools"""
+
+from http.client import HTTPMessage
+
+import pytest
+import requests
+from requests.cookies import MockRequest, MockResponse
+
+from .basetest import BaseTest
+from etsin_finder import app_config, http_pool
+
+
+class TestPooledSession(BaseTest):
+    """Test sessions shared between requests"""
+
+    @pytest.fixture(autouse=True)
+    def sessions(self):
+        """
+        Start and end each test without pooled sessions
+
+        :return:
+        """
+        http_pool.close_pooled_sessions()
+        yield
+        http_pool.close_pooled_sessions()
+
+    def test_session_is_shared_per_host(self):
+        """Same session is returned for a host, and a separate one for another host"""
+        session = http_pool.get_pooled_session('metax.fd-test.csc.fi', True)
+        assert http_pool.get_pooled_session('metax.fd-test.csc.fi', True) is session
+        assert http_pool.get_pooled_session('rems.fd-test.csc.fi', True) is not session
+
+    def test_adapter_uses_pool_config(self):
+        """Mounted adapters are configured from HTTP pool config"""
+        session = http_pool.get_pooled_session('metax.fd-test.csc.fi', True)
+        adapter = session.get_adapter('https://metax.fd-test.csc.fi/rest/datasets')
+        assert adapter._pool_maxsize == app_config.get_http_pool_config(True)['POOL_MAXSIZE']
+        assert adapter is session.get_adapter('http://metax.fd-test.csc.fi/rest/datasets')
+
+    def test_cookies_are_not_stored(self):
+        """Cookies set by upstream responses are not kept in the shared session"""
+        session = http_pool.get_pooled_session('metax.fd-test.csc.fi', True)
+        request = requests.Request('GET', 'https://metax.fd-test.csc.fi/rest/datasets').prepare()
+        headers = HTTPMessage()
+        headers['Set-Cookie'] = 'sessionid=abc; Path=/'
+        session.cookies.extract_cookies(MockResponse(headers), MockRequest(request))
+        assert len(session.cookies) == 0
+
+    def test_close_drops_sessions(self):
+        """Closed sessions are replaced with new ones"""
+        session = http_pool.get_pooled_session('metax.fd-test.csc.fi', True)
+        http_pool.close_pooled_sessions()
+        assert http_pool.get_pooled_session('metax.fd-test.csc.fi', True) is not session
+
+
+class TestHttpPoolConfig(BaseTest):
+    """Test HTTP pool configuration"""
+
+    def test_defaults_when_testing(self):
+        """Defaults are used in tests"""
+        assert app_config.get_http_pool_config(True) == {
+            'POOL_CONNECTIONS': 4,
+            'POOL_MAXSIZE': 20,
+            'POOL_BLOCK': False,
+            'MAX_RETRIES': 0
+        }
+
+    def test_config_overrides_defaults(self, monkeypatch):
+        """Known keys of HTTP_POOL in app config override the defaults, unknown keys are ignored"""
+        monkeypatch.setattr(app_config, 'executing_travis', lambda: False)
+        monkeypatch.setattr(app_config, 'get_app_config', lambda is_testing: {
+            'HTTP_POOL': {'POOL_MAXSIZE': 50, 'POOL_BLOCK': True, 'UNKNOWN': 1}
+        })
+        pool_config = app_config.get_http_pool_config(False)
+        assert pool_config['POOL_MAXSIZE'] == 50
+        assert pool_config['POOL_BLOCK'] is True
+        assert pool_config['POOL_CONNECTIONS'] == 4
+        assert 'UNKNOWN' not in pool_config
+
+    def test_invalid_config_is_ignored(self, monkeypatch):
+        """HTTP_POOL that is not a dict leaves the defaults in place"""
+        monkeypatch.setattr(app_config, 'executing_travis', lambda: False)
+        monkeypatch.setattr(app_config, 'get_app_config', lambda is_testing: {'HTTP_POOL': 'yes'})
+        assert app_config.get_http_pool_config(False)['POOL_MAXSIZE'] == 20
@@ -0,0 +1,96 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2020 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""Test searching the directory tree of a dataset by name"""
+
+import json
+
+import pytest
+
+from .basetest import BaseTest
+from etsin_finder.path_index import build_path_index, search_path_index
+
+
+def _file(identifier, path, parent_id):
+    return {
+        'identifier': identifier,
+        'file_name': path.rsplit('/', 1)[-1],
+        'file_path': path,
+        'byte_size': 10,
+        'parent_directory': {'identifier': parent_id}
+    }
+
+
+FILES = [
+    _file('f1', '/data/raw/Survey.csv', 'd_raw'),
+    _file('f2', '/data/raw/survey_notes.txt', 'd_raw'),
+    _file('f3', '/data/processed/results.csv', 'd_processed'),
+    _file('f4', '/readme.txt', 'd_root'),
+]
+
+
+class TestPathIndex(BaseTest):
+    """Test building and searching path indexes"""
+
+    def test_directories_derived_from_paths(self):
+        """Directories are derived from file paths, with identifiers from the files directly in them"""
+        result = search_path_index(build_path_index(FILES), '')
+        assert result['directories'] == [
+            {'identifier': None, 'directory_name': 'data', 'directory_path': '/data'},
+            {'identifier': 'd_processed', 'directory_name': 'processed', 'directory_path': '/data/processed'},
+            {'identifier': 'd_raw', 'directory_name': 'raw', 'directory_path': '/data/raw'},
+        ]
+        assert [file['identifier'] for file in result['files']] == ['f4', 'f3', 'f1', 'f2']
+
+    def test_prefix_search(self):
+        """Prefix search is case-insensitive"""
+        result = search_path_index(build_path_index(FILES), 'SUR', prefix_only=True)
+        assert result['directories'] == []
+        assert [file['file_name'] for file in result['files']] == ['Survey.csv', 'survey_notes.txt']
+
+    def test_substring_search(self):
+        """Substring search matches anywhere in file and directory names"""
+        result = search_path_index(build_path_index(FILES), 'es')
+        assert [directory['directory_name'] for directory in result['directories']] == ['processed']
+        assert [file['file_name'] for file in result['files']] == ['results.csv', 'survey_notes.txt']
+
+    def test_index_is_json_serializable(self):
+        """Index is cached with the same serializers as Metax responses"""
+        index = build_path_index(FILES)
+        assert json.loads(json.dumps(index)) == index
+
+
+class TestFileSearchResource(BaseTest):
+    """Test file search API endpoint"""
+
+    @pytest.fixture
+    def path_index(self, monkeypatch):
+        """
+        Path index of the test files
+
+        :param monkeypatch:
+        :return:
+        """
+        from etsin_finder import cr_service
+        monkeypatch.setattr(cr_service, 'get_path_index', lambda cr_id: build_path_index(FILES))
+
+    def test_search(self, unauthd_client, open_catalog_record, path_index):
+        """Search results are paged like directory listings"""
+        r = unauthd_client.get('/api/files/123/search?q=.csv&limit=1')
+        assert r.status_code == 200
+        r_json = json.loads(r.get_data())
+        assert [file['identifier'] for file in r_json['files']] == ['f3']
+        assert r_json['pagination']['file_count'] == 2
+        assert r_json['pagination']['next_offset'] == 1
+
+    def test_search_requires_query(self, unauthd_client, open_catalog_record, path_index):
+        """Empty query is rejected"""
+        assert unauthd_client.get('/api/files/123/search?q=').status_code == 400
+
+    def test_search_nonexisting_dataset(self, unauthd_client, nonexisting_catalog_record, path_index):
+        """Files of missing datasets are not searched"""
+        assert unauthd_client.get('/api/files/123/search?q=a').status_code == 404
@@ -0,0 +1,93 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2020 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""Test background prefetch of directory listings"""
+
+import threading
+
+import pytest
+
+from .basetest import BaseTest
+from .test_cache import FakeMemcacheClient
+from etsin_finder import prefetch
+from etsin_finder.cache import DirectoryListingCache
+from etsin_finder.cache_serde import CompactSerializer
+from etsin_finder.metrics import metrics
+
+
+class TestPrefetcher(BaseTest):
+    """Test prefetch budgets and hit counting"""
+
+    @pytest.fixture
+    def prefetcher(self, app, monkeypatch):
+        """
+        Enabled prefetcher prefetching two children at most two at a time
+
+        :param app:
+        :param monkeypatch:
+        :return:
+        """
+        monkeypatch.setattr(prefetch, 'get_prefetch_config', lambda is_testing: {
+            'CHILDREN': 2, 'MAX_CONCURRENT': 2, 'MAX_BYTES_PER_MINUTE': 100
+        })
+        metrics.reset()
+        return prefetch.Prefetcher(app, 'dir')
+
+    def test_prefetches_first_children(self, prefetcher, monkeypatch):
+        """Only the first CHILDREN keys are prefetched and already cached ones are not counted as fetched"""
+        monkeypatch.setattr(prefetch, 'spawn_background', lambda fn, *args: fn(*args))
+        fetched = []
+
+        def fetch(key):
+            fetched.append(key)
+            return None if key == 'b' else 10
+        prefetcher.prefetch(fetch, ['a', 'b', 'c'])
+        assert fetched == ['a', 'b']
+        assert prefetcher.get_stats()['counters'] == {
+            'prefetch.dir.queued': 2, 'prefetch.dir.fetched': 1, 'prefetch.dir.not_needed': 1, 'prefetch.dir.bytes': 10
+        }
+
+    def test_byte_budget(self, prefetcher, monkeypatch):
+        """Prefetches are skipped once the bytes prefetched within the minute reach the budget"""
+        monkeypatch.setattr(prefetch, 'spawn_background', lambda fn, *args: fn(*args))
+        prefetcher.prefetch(lambda key: 100, ['a', 'b'])
+        assert metrics.get('prefetch.dir.fetched') == 1
+        assert metrics.get('prefetch.dir.skipped') == 1
+
+    def test_concurrency_budget(self, prefetcher):
+        """Prefetches are skipped instead of queued while MAX_CONCURRENT prefetches are running"""
+        release = threading.Event()
+
+        def fetch(key):
+            release.wait(5)
+            return 1
+        prefetcher.prefetch(fetch, ['a', 'b'])
+        prefetcher.prefetch(fetch, ['c'])
+        assert metrics.get('prefetch.dir.skipped') == 1
+        release.set()
+
+    def test_disabled_by_default(self, app):
+        """Prefetch is opt-in"""
+        prefetcher = prefetch.Prefetcher(app, 'dir')
+        prefetcher.prefetch(lambda key: pytest.fail('prefetched'), ['a'])
+        assert not prefetcher.ENABLED
+
+    def test_prefetch_hit_counted_once(self, prefetcher, app):
+        """The listing cache counts a hit when a prefetched listing is served for the first time"""
+        cache = DirectoryListingCache(app)
+        client = FakeMemcacheClient()
+        for c in [cache, cache.generations]:
+            c.is_testing = False
+            c.cache = client
+            c.serializer = CompactSerializer()
+        generation = cache.get_generation('123')
+        cache.update_cache('123', generation, 'dir1', None, None, {'files': [1]}, prefetched=True)
+        metrics.incr('prefetch.dir.fetched')
+        assert cache.is_cached('123', generation, 'dir1', None, None)
+        assert cache.get_from_cache('123', generation, 'dir1', None, None) == {'files': [1]}
+        assert cache.get_from_cache('123', generation, 'dir1', None, None) == {'files': [1]}
+        assert prefetcher.get_stats()['hit_ratio'] == 1
@@ -0,0 +1,288 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2020 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""Test REMS entitlement checks"""
+
+import pytest
+
+from .basetest import BaseTest
+from .utils import get_test_catalog_record
+
+
+@pytest.fixture
+def rems_cache_ttls(app, monkeypatch):
+    """
+    Replace the REMS cache with an in-memory dict
+
+    :param app:
+    :param monkeypatch:
+    :return: TTLs of the stored entries by key
+    """
+    store = {}
+    ttls = {}
+
+    def do_update(key, value, ttl):
+        store[key] = value
+        ttls[key] = ttl
+    monkeypatch.setattr(app.rems_cache, 'do_get', lambda key: store.get(key))
+    monkeypatch.setattr(app.rems_cache, 'do_update', do_update)
+    monkeypatch.setattr(app.rems_cache, 'do_delete', lambda key: store.pop(key, None))
+    return ttls
+
+
+@pytest.fixture
+def rems_enabled(monkeypatch):
+    """
+    Configure REMS as enabled for the Rems API Services created in the test
+
+    :param monkeypatch:
+    :return:
+    """
+    from etsin_finder import rems_service
+    monkeypatch.setattr(rems_service, 'get_fairdata_rems_api_config',
+                        lambda is_testing: {'ENABLED': True, 'HOST': 'rems.test', 'API_KEY': 'key'})
+
+
+class TestRemsEntitlements(BaseTest):
+    """Test entitlement checks served from the per-user entitlement cache"""
+
+    @pytest.fixture
+    def rems_service(self, app, monkeypatch, rems_cache_ttls, rems_enabled):
+        """
+        rems_service with a fake permit record and a counting fake REMS entitlements API
+
+        :param app:
+        :param monkeypatch:
+        :param rems_cache_ttls:
+        :param rems_enabled:
+        :return:
+        """
+        from etsin_finder import rems_service
+        self.ttls = rems_cache_ttls
+        self.cr_file_details = []
+
+        def get_cr(cr_id, check_removed_if_not_exist, refresh_cache, file_details=True):
+            self.cr_file_details.append(file_details)
+            cr = get_test_catalog_record('permit')
+            cr['research_dataset']['preferred_identifier'] = 'pid_' + cr_id
+            return cr
+        monkeypatch.setattr(rems_service, 'get_catalog_record', get_cr)
+
+        self.rems_calls = []
+
+        def entitlements(service, user_id):
+            self.rems_calls.append(user_id)
+            return [{'resource': 'pid_1', 'user': {'userid': 'user'}},
+                    {'resource': 'pid_2', 'user': {'userid': 'other_user'}}]
+        monkeypatch.setattr(rems_service.RemsAPIService, 'entitlements', entitlements)
+        monkeypatch.setattr(rems_service, '_rems_api', rems_service.RemsAPIService(app))
+        return rems_service
+
+    def test_entitlements_are_fetched_once(self, rems_service):
+        """Entitlement checks for several datasets make one REMS request"""
+        assert rems_service.get_user_rems_permission_for_catalog_record('1', 'user') is True
+        assert rems_service.get_user_rems_permission_for_catalog_record('2', 'user') is False
+        assert rems_service.get_user_rems_permission_for_catalog_record('3', 'user') is False
+        assert self.rems_calls == ['user']
+        assert self.cr_file_details == [False, False, False]
+
+    def test_entitlements_are_cached_per_user(self, rems_service):
+        """Entitlements of other users are not used"""
+        assert rems_service.get_user_rems_permission_for_catalog_record('1', 'user') is True
+        assert rems_service.get_user_rems_permission_for_catalog_record('2', 'other_user') is True
+        assert rems_service.get_user_rems_permission_for_catalog_record('1', 'other_user') is False
+        assert self.rems_calls == ['user', 'other_user']
+
+    def test_empty_entitlements_are_cached_briefly(self, app, rems_service):
+        """Users without entitlements are checked again from REMS soon, as their application may get approved"""
+        assert rems_service.get_user_rems_permission_for_catalog_record('1', 'new_user') is False
+        assert rems_service.get_user_rems_permission_for_catalog_record('1', 'user') is True
+        assert self.ttls == {
+            'rems_entitlements_new_user': app.rems_cache.EMPTY_ENTITLEMENTS_TTL,
+            'rems_entitlements_user': app.rems_cache.CACHE_ITEM_TTL
+        }
+
+    def test_permission_is_decided_once_per_request(self, app, rems_service, monkeypatch):
+        """Permission checks within a request reuse the decision and the already fetched record"""
+        from etsin_finder import authorization
+        monkeypatch.setattr(authorization, 'is_authenticated', lambda: True)
+        monkeypatch.setattr(authorization, 'get_user_id', lambda: 'user')
+        monkeypatch.setattr(rems_service, 'get_catalog_record', lambda *args: pytest.fail('record fetched'))
+        checks = []
+        get_permission = rems_service.get_user_rems_permission_for_catalog_record
+
+        def count_checks(*args):
+            checks.append(args[0])
+            return get_permission(*args)
+        monkeypatch.setattr(rems_service, 'get_user_rems_permission_for_catalog_record', count_checks)
+        cr = get_test_catalog_record('permit')
+        cr['identifier'] = '1'
+        cr['research_dataset']['preferred_identifier'] = 'pid_1'
+
+        with app.test_request_context():
+            assert authorization.user_has_rems_permission_for_catalog_record('1', cr) is True
+            authorization.strip_information_from_catalog_record(cr, True)
+            assert checks == ['1']
+        with app.test_request_context():
+            assert authorization.user_has_rems_permission_for_catalog_record('1', cr) is True
+        assert checks == ['1', '1']
+
+
+class TestRemsApplicationState(BaseTest):
+    """Test application state served from the per-user application index"""
+
+    @pytest.fixture
+    def rems_service(self, app, monkeypatch, rems_cache_ttls, rems_enabled):
+        """
+        rems_service with a counting fake REMS applications API
+
+        :param app:
+        :param monkeypatch:
+        :param rems_cache_ttls:
+        :param rems_enabled:
+        :return:
+        """
+        from etsin_finder import rems_service
+        self.rems_calls = []
+
+        def get_user_applications(service, user_id):
+            self.rems_calls.append(user_id)
+            return [
+                {'application/id': 1, 'application/state': 'application.state/rejected',
+                 'application/last-activity': '2020-01-01T10:00:00.000Z',
+                 'application/resources': [{'resource/ext-id': 'pid_1'}]},
+                {'application/id': 2, 'application/state': 'application.state/approved',
+                 'application/last-activity': '2020-02-01T10:00:00.000Z',
+                 'application/resources': [{'resource/ext-id': 'pid_1'}, {'resource/ext-id': 'pid_2'}]},
+            ]
+        monkeypatch.setattr(rems_service.RemsAPIService, 'get_user_applications', get_user_applications)
+        monkeypatch.setattr(rems_service, '_rems_api', rems_service.RemsAPIService(app))
+        return rems_service
+
+    def _get_cr(self, pref_id):
+        cr = get_test_catalog_record('permit')
+        cr['research_dataset']['preferred_identifier'] = pref_id
+        return cr
+
+    def test_newest_application_state_is_returned(self, app, rems_service):
+        """State of the newest application for the resource is returned and applications are fetched once"""
+        from flask import session
+        with app.test_request_context():
+            assert rems_service.get_application_state_for_resource(self._get_cr('pid_1'), 'user') == 'approved'
+            assert session['REMS_application_id'] == 2
+            assert rems_service.get_application_state_for_resource(self._get_cr('pid_3'), 'user') == 'apply'
+            assert session['REMS_application_id'] is None
+        assert self.rems_calls == ['user']
+
+    def test_dataset_view_sets_application_id_to_session(self, authd_client, rems_service, has_rems_permit,
+                                                         monkeypatch):
+        """Application id found while the record is being stripped is set to the session of the request"""
+        from etsin_finder import cr_service
+        monkeypatch.setattr(cr_service, 'get_catalog_record',
+                            lambda x, y, z, file_details=True: self._get_cr('pid_1'))
+        with authd_client as client:
+            r = client.get('/api/dataset/123')
+            assert r.status_code == 200
+            assert r.get_json()['application_state'] == 'approved'
+            with client.session_transaction() as sess:
+                assert sess['REMS_application_id'] == 2
+
+    def test_invalidate_user_applications(self, app, rems_service):
+        """Applications are fetched again after invalidation"""
+        with app.test_request_context():
+            rems_service.get_application_state_for_resource(self._get_cr('pid_1'), 'user')
+            rems_service.invalidate_user_applications('user')
+            rems_service.get_application_state_for_resource(self._get_cr('pid_1'), 'user')
+        assert self.rems_calls == ['user', 'user']
+
+
+class TestRemsAPIService(BaseTest):
+    """Test the shared Rems API Service"""
+
+    @pytest.fixture
+    def service(self, app, monkeypatch, rems_enabled):
+        """
+        Rems API Service sending its requests to a fake session that records them
+
+        :param app:
+        :param monkeypatch:
+        :param rems_enabled:
+        :return:
+        """
+        from etsin_finder import rems_service
+        service = rems_service.RemsAPIService(app)
+        self.requests = []
+
+        class FakeResponse:
+            def raise_for_status(self):
+                pass
+
+            def json(self):
+                return []
+
+        def request(method, headers, url, verify, timeout, json=None):
+            self.requests.append((headers['x-rems-user-id'], url))
+            return FakeResponse()
+        monkeypatch.setattr(service.session, 'request', request)
+        return service
+
+    def test_user_is_given_per_request(self, service):
+        """User identity is sent per request without modifying the shared headers"""
+        service.get_user_applications('user_1')
+        service.create_application(1, 'user_2')
+        assert [user for user, url in self.requests] == ['user_1', 'user_2']
+        assert service.HEADERS['x-rems-user-id'] == 'RDowner@funet.fi'
+
+    def test_entitlements_user_is_encoded(self, service):
+        """User id is encoded in the query of the entitlements request"""
+        service.entitlements('user+1@example.com&x=1')
+        assert self.requests[0][1] == 'https://rems.test/api/entitlements?user=user%2B1%40example.com%26x%3D1'
+
+
+class TestRemsApplyCaching(BaseTest):
+    """Test caching of REMS users and catalogue items used when applying for permission"""
+
+    @pytest.fixture
+    def rems_service(self, monkeypatch, rems_cache_ttls):
+        """
+        rems_service with a counting fake REMS for creating users and getting catalogue items
+
+        :param monkeypatch:
+        :param rems_cache_ttls:
+        :return:
+        """
+        from etsin_finder import rems_service
+        self.rems_calls = []
+
+        def create_user(userdata):
+            self.rems_calls.append(('create_user', userdata['email']))
+            return {'success': userdata['email'] is not None}
+
+        def get_catalogue_item_for_resource(resource):
+            self.rems_calls.append(('catalogue_item', resource))
+            return [{'id': 1}] if resource == 'known' else []
+        monkeypatch.setattr(rems_service._rems_api, 'create_user', create_user)
+        monkeypatch.setattr(rems_service._rems_api, 'get_catalogue_item_for_resource', get_catalogue_item_for_resource)
+        return rems_service
+
+    def test_created_user_is_remembered(self, rems_service):
+        """User is created again only when the user data changes or creation failed"""
+        userdata = {'userid': 'user', 'name': 'Test User', 'email': 'user@example.com'}
+        assert rems_service.create_user(userdata) == {'success': True}
+        assert rems_service.create_user(dict(userdata)) == {'success': True}
+        assert rems_service.create_user(dict(userdata, email='new@example.com')) == {'success': True}
+        assert rems_service.create_user(dict(userdata, email=None)) == {'success': False}
+        assert rems_service.create_user(dict(userdata, email=None)) == {'success': False}
+        assert [call[1] for call in self.rems_calls] == ['user@example.com', 'new@example.com', None, None]
+
+    def test_catalogue_item_is_cached(self, rems_service):
+        """Found catalogue items are cached"""
+        assert rems_service.get_catalogue_item_for_resource('known') == [{'id': 1}]
+        assert rems_service.get_catalogue_item_for_resource('known') == [{'id': 1}]
+        assert rems_service.get_catalogue_item_for_resource('unknown') == []
+        assert rems_service.get_catalogue_item_for_resource('unknown') == []
+        assert self.rems_calls == [('catalogue_item', 'known'), ('catalogue_item', 'unknown'), ('catalogue_item', 'unknown')]
@@ -7,8 +7,13 @@
 
 """Test Flask Restful most relevant API endpoints"""
 
-from .basetest import BaseTest
+import gzip
 import json
+import pytest
+
+from .basetest import BaseTest
+from .utils import get_test_catalog_record
+from etsin_finder.cache import LRUCache
 
 
 class TestDatasetResources(BaseTest):
@@ -213,6 +218,190 @@ class TestDatasetResources(BaseTest):
         assert 'project_identifier' not in cr_json['catalog_record']['research_dataset']['directories'][0]['details']
 
 
+class TestDatasetResponseCache(BaseTest):
+    """Test caching of dataset responses that are the same for all users in the same authentication state"""
+
+    @pytest.fixture
+    def response_store(self, app, monkeypatch):
+        """
+        Back the response cache with a dict.
+
+        :param app:
+        :param monkeypatch:
+        :return:
+        """
+        from etsin_finder import cr_service
+        store = {}
+
+        self.ttls = {}
+
+        def do_update(key, value, ttl):
+            store[key] = value
+            self.ttls[key] = ttl
+            return value
+        self.lookups = []
+
+        def do_get(key):
+            self.lookups.append(key)
+            return store.get(key)
+        for cache in (app.response_cache, app.response_cache.generations):
+            monkeypatch.setattr(cache, 'do_get', do_get)
+            monkeypatch.setattr(cache, 'do_update', do_update)
+        monkeypatch.setattr(app.response_cache, 'uncacheable', LRUCache(10, 10, 60))
+        self.cr_calls = []
+        get_catalog_record = cr_service.get_catalog_record
+
+        def counting_get_catalog_record(cr_id, check_removed, refresh, file_details=True):
+            self.cr_calls.append(cr_id)
+            return get_catalog_record(cr_id, check_removed, refresh, file_details)
+        monkeypatch.setattr(cr_service, 'get_catalog_record', counting_get_catalog_record)
+        return store
+
+    def test_public_view_served_from_cache(self, unauthd_client, open_catalog_record, response_store):
+        """Second request is served from cache, gzip compressed when accepted"""
+        r1 = unauthd_client.get('/api/dataset/123')
+        r2 = unauthd_client.get('/api/dataset/123', headers={'Accept-Encoding': 'gzip'})
+        r3 = unauthd_client.get('/api/dataset/123')
+        assert self.cr_calls == ['123']
+        assert r2.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(r2.get_data()) == r1.get_data()
+        assert 'Content-Encoding' not in r3.headers
+        assert json.loads(r3.get_data()) == json.loads(r1.get_data())
+
+    def test_authentication_state_is_part_of_key(self, app, login_catalog_record, monkeypatch, response_store):
+        """Authenticated and unauthenticated users get their own cached views"""
+        from etsin_finder import authentication
+        with app.test_client() as client:
+            monkeypatch.setattr(authentication, 'is_authenticated', lambda: False)
+            unauthd = json.loads(client.get('/api/dataset/123').get_data())
+            monkeypatch.setattr(authentication, 'is_authenticated', lambda: True)
+            authd = json.loads(client.get('/api/dataset/123').get_data())
+        assert self.cr_calls == ['123', '123']
+        assert authd != unauthd
+
+    def test_embargo_not_passed_not_cached(self, unauthd_client, embargo_not_passed_catalog_record, response_store):
+        """Views of datasets under embargo change when the embargo ends"""
+        unauthd_client.get('/api/dataset/123')
+        unauthd_client.get('/api/dataset/123')
+        assert self.cr_calls == ['123', '123']
+
+    def test_invalidation_drops_cached_view(self, unauthd_client, app, open_catalog_record, response_store):
+        """Invalidating a catalog record starts a new generation of its responses"""
+        unauthd_client.get('/api/dataset/123')
+        app.response_cache.invalidate('123')
+        unauthd_client.get('/api/dataset/123')
+        assert self.cr_calls == ['123', '123']
+
+    def test_view_expires_with_catalog_record(self, unauthd_client, open_catalog_record, monkeypatch, response_store):
+        """Views are cached only until the catalog record they were built from becomes stale"""
+        from etsin_finder import cr_service
+        monkeypatch.setattr(cr_service, 'get_remaining_soft_ttl', lambda cr_id, file_details=True: 100.5)
+        unauthd_client.get('/api/dataset/123')
+        assert [ttl for key, ttl in self.ttls.items() if key.startswith('response_123_')] == [100]
+
+        monkeypatch.setattr(cr_service, 'get_remaining_soft_ttl', lambda cr_id, file_details=True: -1)
+        unauthd_client.get('/api/dataset/123?fields=identifier')
+        unauthd_client.get('/api/dataset/123?fields=identifier')
+        assert self.cr_calls == ['123', '123', '123']
+
+    def test_uncacheable_view_is_not_looked_up(self, authd_client, permit_catalog_record, response_store):
+        """Views of permit datasets for authenticated users are not looked up after the first request"""
+        authd_client.get('/api/dataset/123')
+        lookups = len(self.lookups)
+        authd_client.get('/api/dataset/123')
+        assert len(self.lookups) == lookups
+        assert self.cr_calls == ['123', '123']
+        assert not any(key.startswith('response_123_') for key in response_store)
+
+
+class TestDatasetFieldsAndFiles(BaseTest):
+    """Test field projection of datasets and the paginated file sections"""
+
+    @pytest.fixture
+    def file_details_calls(self, monkeypatch):
+        """
+        Record whether the catalog record was requested with file details
+
+        :param monkeypatch:
+        :return:
+        """
+        from etsin_finder import cr_service
+        calls = []
+
+        def get_catalog_record(cr_id, check_removed, refresh, file_details=True):
+            calls.append(file_details)
+            return get_test_catalog_record('login')
+        monkeypatch.setattr(cr_service, 'get_catalog_record', get_catalog_record)
+        return calls
+
+    def test_fields_projection(self, unauthd_client, file_details_calls):
+        """Only the requested fields are returned and file details are not fetched for them"""
+        r = unauthd_client.get('/api/dataset/123?fields=identifier,research_dataset.title')
+        assert r.status_code == 200
+        r_json = json.loads(r.get_data())
+        assert set(r_json['catalog_record']) == {'identifier', 'research_dataset'}
+        assert list(r_json['catalog_record']['research_dataset']) == ['title']
+        assert file_details_calls == [False]
+
+    def test_file_sections_need_file_details(self, unauthd_client, file_details_calls):
+        """File details are fetched when the file sections are requested"""
+        unauthd_client.get('/api/dataset/123?fields=research_dataset.files.details')
+        unauthd_client.get('/api/dataset/123')
+        assert file_details_calls == [True, True]
+
+    def test_files_are_paged_and_stripped(self, unauthd_client, file_details_calls):
+        """Directories and files are paged as one sequence and stripped like the dataset"""
+        r = unauthd_client.get('/api/dataset/123/files?limit=1')
+        assert r.status_code == 200
+        r_json = json.loads(r.get_data())
+        assert len(r_json['directories']) + len(r_json['files']) == 1
+        assert r_json['pagination']['limit'] == 1
+        for item in r_json['directories'] + r_json['files']:
+            assert 'title' not in item
+
+    def test_file_search_needs_no_file_details(self, unauthd_client, file_details_calls, monkeypatch):
+        """Record is fetched without file details for access checks of file searches"""
+        from etsin_finder import cr_service
+        from etsin_finder.path_index import build_path_index
+        index = build_path_index([{'identifier': 'f1', 'file_name': 'a.txt', 'file_path': '/a.txt'}])
+        monkeypatch.setattr(cr_service, 'get_path_index', lambda cr_id: index)
+        r = unauthd_client.get('/api/files/123/search?q=a')
+        assert r.status_code == 200
+        assert file_details_calls == [False]
+
+    def test_files_are_ordered_by_name(self, unauthd_client, monkeypatch):
+        """Files are ordered by their name in details, case-insensitively"""
+        from etsin_finder import cr_service
+        cr = get_test_catalog_record('open')
+        cr['research_dataset']['directories'] = []
+        cr['research_dataset']['files'] = [{'details': {'file_name': name}} for name in ['b', 'C', 'a']]
+        monkeypatch.setattr(cr_service, 'get_catalog_record', lambda x, y, z, file_details=True: cr)
+        r_json = json.loads(unauthd_client.get('/api/dataset/123/files?limit=2').get_data())
+        assert [item['details']['file_name'] for item in r_json['files']] == ['a', 'b']
+        assert r_json['pagination']['file_count'] == 3
+        assert r_json['pagination']['next_offset'] == 2
+
+    def test_stripped_sections_are_not_counted(self, unauthd_client, monkeypatch):
+        """Sections the user may not see are not counted in the pagination"""
+        from etsin_finder import cr_service
+        cr = get_test_catalog_record('open')
+        del cr['research_dataset']['access_rights']['access_type']
+        monkeypatch.setattr(cr_service, 'get_catalog_record', lambda x, y, z, file_details=True: cr)
+        r_json = json.loads(unauthd_client.get('/api/dataset/123/files?limit=1').get_data())
+        assert r_json['directories'] == r_json['files'] == []
+        assert r_json['pagination']['directory_count'] == r_json['pagination']['file_count'] == 0
+        assert r_json['pagination']['next_offset'] is None
+
+    def test_only_included_sections_are_sorted(self, unauthd_client, file_details_calls, monkeypatch):
+        """Sections left out of the response are not sorted"""
+        from etsin_finder import resources
+        sorted_keys = []
+        monkeypatch.setattr(resources, 'sort_array_of_obj_by_key', lambda array, key, nested_key=False:
+                            sorted_keys.append(nested_key or key))
+        unauthd_client.get('/api/dataset/123?fields=identifier,research_dataset.files.details.file_name')
+        assert sorted_keys == ['file_name']
+
+
 class TestUserResources(BaseTest):
     """Test User API endpoints"""
 
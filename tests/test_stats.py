@@ -0,0 +1,74 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2020 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""Test logging of per-worker cache statistics"""
+
+import json
+
+import pytest
+
+from .basetest import BaseTest
+from etsin_finder import stats
+from etsin_finder.metrics import metrics
+
+
+class TestStatsReporter(BaseTest):
+    """Test collecting and logging cache statistics"""
+
+    @pytest.fixture
+    def reporter(self, app, monkeypatch):
+        """
+        Enabled stats reporter for the catalog record cache
+
+        :param app:
+        :param monkeypatch:
+        :return:
+        """
+        monkeypatch.setattr(stats, 'get_stats_log_config', lambda is_testing: {'INTERVAL': 60})
+        metrics.reset()
+        return stats.StatsReporter(app, [app.cr_cache], [app.dir_prefetcher])
+
+    def test_collects_cache_hit_ratios_and_counters(self, reporter):
+        """Hit ratios are reported per cache and the other counters as such"""
+        metrics.incr('cache.cr.l2.hit', 3)
+        metrics.incr('cache.cr.l2.miss')
+        metrics.incr('singleflight.catalog_record.shared', 2)
+        collected = reporter.collect()
+        assert collected['caches']['cr']['l2_hit_ratio'] == 0.75
+        assert collected['counters'] == {'singleflight.catalog_record.shared': 2}
+
+    def test_collects_prefetch_hit_rate(self, app, reporter):
+        """Prefetch hit rate is reported per prefetcher, and its counters are not repeated"""
+        metrics.incr('prefetch.dir.fetched', 4)
+        metrics.incr('prefetch.dir.hit')
+        collected = reporter.collect()
+        assert collected['prefetch']['dir']['hit_ratio'] == 0.25
+        assert collected['counters'] == {}
+
+    def test_report_is_logged(self, app, reporter, monkeypatch):
+        """Statistics are logged as json"""
+        logged = []
+        monkeypatch.setattr(app.logger, 'info', logged.append)
+        metrics.incr('cache.cr.l2.miss')
+        reporter.report()
+        assert len(logged) == 1
+        assert json.loads(logged[0].split(': ', 1)[1])['caches']['cr']['l2_hit_ratio'] == 0.0
+
+    def test_started_once_per_worker(self, reporter, monkeypatch):
+        """Logging loop is started by the first request of a worker only"""
+        started = []
+        monkeypatch.setattr(stats, 'spawn_background', started.append)
+        reporter.ensure_started()
+        reporter.ensure_started()
+        assert started == [reporter._run]
+
+    def test_disabled_by_default(self, app, monkeypatch):
+        """Nothing is started without config"""
+        started = []
+        monkeypatch.setattr(stats, 'spawn_background', started.append)
+        app.stats_reporter.ensure_started()
+        assert started == []
@@ -0,0 +1,89 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2020 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""Test compiled stripping plans"""
+
+from copy import deepcopy
+
+from .basetest import BaseTest
+from .utils import get_test_catalog_record
+from etsin_finder.stripping import Rule, compile_plan, compile_projection
+from etsin_finder.utils import leave_keys_in_dict, remove_keys_recursively
+
+
+class TestStripping(BaseTest):
+    """Test stripping json objects with compiled plans"""
+
+    def test_keys_are_removed_recursively(self):
+        """Plan removes keys like remove_keys_recursively, including strings equal to keys in lists"""
+        obj = {'email': 'a', 'actors': [{'name': 'b', 'email': 'c', 'phone': 'd'}, 'email', 'other'],
+               'nested': {'deep': [[{'phone': 'e', 'x': 1}]]}}
+        original = deepcopy(obj)
+        plan = compile_plan(Rule(), ['email', 'phone'])
+        assert plan(obj) == remove_keys_recursively(obj, ['email', 'phone'])
+        assert obj == original
+
+    def test_rules_leave_keys(self):
+        """Rules leave only the listed keys in dicts at their position"""
+        obj = {'files': [{'identifier': 1, 'title': 't', 'details': {'file_name': 'f', 'checksum': 'c', 'email': 'e'}}],
+               'title': {'email': 'e', 'en': 't'}}
+        plan = compile_plan(Rule(children={'files': Rule(items=Rule(keep=['identifier', 'details'], children={
+            'details': Rule(keep=['file_name', 'email'])}))}), ['email'])
+        assert plan(obj) == {'files': [{'identifier': 1, 'details': {'file_name': 'f'}}], 'title': {'en': 't'}}
+
+    def test_in_place(self):
+        """In place plan modifies the object itself"""
+        obj = {'files': [{'identifier': 1, 'title': 't'}], 'directories': [{'identifier': 2, 'title': 't'}]}
+        plan = compile_plan(Rule(children={'files': Rule(items=Rule(keep=['identifier']))}), in_place=True)
+        assert plan(obj) is obj
+        assert obj == {'files': [{'identifier': 1}], 'directories': [{'identifier': 2, 'title': 't'}]}
+
+    def test_catalog_record_partial_strip_matches_previous(self):
+        """Partially stripped catalog record is the same as with the previous multi-pass stripping"""
+        from etsin_finder.authorization import _CR_STRIP_PLANS
+        cr = get_test_catalog_record('restricted')
+        expected = remove_keys_recursively(cr, ['email', 'telephone', 'phone'])
+        for file in expected['research_dataset'].get('files', []):
+            leave_keys_in_dict(file, {'use_category', 'file_type', 'identifier', 'details'})
+            if 'details' in file:
+                leave_keys_in_dict(file['details'], {'file_name', 'file_path', 'byte_size', 'identifier'})
+        for dir in expected['research_dataset'].get('directories', []):
+            leave_keys_in_dict(dir, {'identifier', 'use_category', 'details'})
+            if 'details' in dir:
+                leave_keys_in_dict(dir['details'], {'directory_name', 'directory_path', 'byte_size', 'file_count',
+                                                    'identifier'})
+        assert _CR_STRIP_PLANS['partial'](cr) == expected
+        assert _CR_STRIP_PLANS['none'](cr) == remove_keys_recursively(
+            cr, ['email', 'telephone', 'phone', 'files', 'directories', 'remote_resources'])
+
+
+class TestProjection(BaseTest):
+    """Test projecting json objects to given paths"""
+
+    def test_paths_are_kept(self):
+        """Only the given paths are kept, lists are projected item by item"""
+        obj = {
+            'identifier': '123',
+            'date_created': '2020-01-01',
+            'research_dataset': {
+                'title': {'en': 'Title', 'fi': 'Otsikko'},
+                'description': {'en': 'Description'},
+                'creator': [{'name': 'Teppo', 'email': 'teppo@example.com'}]
+            }
+        }
+        project = compile_projection(['identifier', 'research_dataset.title', 'research_dataset.creator.name'])
+        assert project(obj) == {
+            'identifier': '123',
+            'research_dataset': {'title': {'en': 'Title', 'fi': 'Otsikko'}, 'creator': [{'name': 'Teppo'}]}
+        }
+        assert 'description' in obj['research_dataset']
+
+    def test_shorter_path_keeps_whole_value(self):
+        """A path keeps the whole value, also when longer paths under it are given"""
+        project = compile_projection(['research_dataset.title.en', 'research_dataset.title'])
+        assert project({'research_dataset': {'title': {'en': 'a', 'fi': 'b'}}}) == \
+            {'research_dataset': {'title': {'en': 'a', 'fi': 'b'}}}